@@ -0,0 +1,471 @@
+#!/usr/bin/python
+# Cross-night archive index.
+#
+# 'archive.db' in the image folder is a SQLite database with a row for every night, every capture session (one camera
+# on one night) and every frame, so questions about the whole archive - "nights with more than 5 hours of data at gain
+# 300", "frames between 02:00 and 03:00 in March" - are one indexed query instead of a walk through every folder.
+#
+#	nights		night ('YYYYMMDD'), state ('kept', 'pruned' once the raw frames are gone, 'deleted'), and what
+#				retention and tlapse need to know about the folder: its mtime, bytes used, whether it's all been
+#				uploaded, and whether its timelapse is done
+#	sessions	folder ('YYYYMMDD', or 'YYYYMMDD/name' for one of several cameras), night, camera, start, finish, hours,
+#				exposure, gain, frames, mean sky level, missed slots and the full capture settings (as JSON)
+#	frames		session, frame number, time, exposure, gain, path (within the image folder), whether it's been uploaded
+#				and its sky level
+#
+# Times are local, as in the manifest ('2024-03-01T02:15:30').  The capture loop adds each frame through an
+# ArchiveWriter, which does its writing in a background thread so capture never waits on the database.  store_data()
+# fills in a session from capture_settings.json and file_info.json, and upload_night() marks what's been sent.
+#
+# The first time the index is opened for an image folder, the nights already there are imported.  Nights that turn
+# up some other way (copied in, or uploaded from the camera) are added with 'import', which skips nights it already
+# has.  The capture loop does this as each night starts, so retention and tlapse never need to list the image
+# folder themselves.  From the command line:
+#
+#	python archive.py import [image_folder]
+#	python archive.py sessions --min-hours 5 --gain 300
+#	python archive.py frames --from 2024-03-01 --to 2024-04-01 --between 02:00 03:00
+#	python archive.py sql "SELECT night, SUM(frames) FROM sessions GROUP BY night"
+
+import argparse, glob, json, os, sqlite3, sys, threading
+import pytz
+from datetime import datetime
+import manifest, uploader
+from workers import WorkerPool
+
+DB_FILE = "archive.db"
+NIGHT_FORMAT = "%Y%m%d"
+BATCH = 100													# Frames written between commits, at most
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS nights (
+	night TEXT PRIMARY KEY,
+	state TEXT NOT NULL DEFAULT 'kept',
+	mtime REAL,
+	raw_bytes INTEGER,
+	summary_bytes INTEGER,
+	uploaded INTEGER NOT NULL DEFAULT 0,
+	timelapse TEXT,
+	timelapse_mtime REAL,
+	frames INTEGER
+);
+CREATE TABLE IF NOT EXISTS sessions (
+	id INTEGER PRIMARY KEY,
+	folder TEXT NOT NULL UNIQUE,
+	night TEXT NOT NULL,
+	camera TEXT,
+	start TEXT,
+	finish TEXT,
+	hours REAL,
+	exposure REAL,
+	gain INTEGER,
+	frames INTEGER NOT NULL DEFAULT 0,
+	sky_level REAL,
+	missed_slots INTEGER,
+	settings TEXT
+);
+CREATE TABLE IF NOT EXISTS frames (
+	session INTEGER NOT NULL,
+	idx INTEGER NOT NULL,
+	time TEXT NOT NULL,
+	exposure REAL,
+	gain INTEGER,
+	path TEXT NOT NULL,
+	uploaded INTEGER NOT NULL DEFAULT 0,
+	sky_level REAL,
+	PRIMARY KEY (session, idx)
+);
+CREATE INDEX IF NOT EXISTS nights_state ON nights (state, night);
+CREATE INDEX IF NOT EXISTS sessions_night ON sessions (night);
+CREATE INDEX IF NOT EXISTS sessions_start ON sessions (start);
+CREATE INDEX IF NOT EXISTS sessions_gain ON sessions (gain, hours);
+CREATE INDEX IF NOT EXISTS frames_time ON frames (time);
+CREATE INDEX IF NOT EXISTS frames_upload ON frames (session, uploaded);
+"""
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+class ArchiveIndex(object):
+	# The index for one image folder.  Each thread gets its own connection.
+
+	def __init__(self, base_dir):
+		self.base_dir = os.path.join(base_dir, "")
+		self.path = self.base_dir + DB_FILE
+		self.local = threading.local()
+		self.lock = threading.RLock()							# One writer at a time from this process
+		created = not os.path.exists(self.path)
+		self.db().executescript(SCHEMA)
+		if created:
+			self.import_nights()
+
+	def db(self):
+		db = getattr(self.local, "db", None)
+		if db is None:
+			db = self.local.db = sqlite3.connect(self.path, timeout=30)
+			db.row_factory = sqlite3.Row
+			db.execute("PRAGMA journal_mode=WAL")				# Readers don't hold up the capture loop's writes
+			db.execute("PRAGMA synchronous=NORMAL")
+		return db
+
+	def write(self, sql, args=()):
+		with self.lock:
+			db = self.db()
+			with db:
+				return db.execute(sql, args)
+
+	def query(self, sql, args=()):
+		return self.db().execute(sql, args).fetchall()
+
+	# Nights:
+
+	def add_night(self, night):
+		self.write("INSERT OR IGNORE INTO nights (night) VALUES (?)", (night,))
+
+	def nights(self, state=None):
+		# Night names in date order - all but deleted ones, or just those in 'state'.
+		if state is None:
+			rows = self.query("SELECT night FROM nights WHERE state != 'deleted' ORDER BY night")
+		else:
+			rows = self.query("SELECT night FROM nights WHERE state = ? ORDER BY night", (state,))
+		return [ row["night"] for row in rows ]
+
+	def night(self, night):
+		rows = self.query("SELECT * FROM nights WHERE night = ?", (night,))
+		return dict(rows[0]) if rows else None
+
+	def sizes(self):
+		# What retention knows about each night that's still there: { night: { mtime, raw_bytes, summary_bytes, uploaded } }
+		rows = self.query("SELECT night, mtime, raw_bytes, summary_bytes, uploaded FROM nights "
+						  "WHERE state != 'deleted' AND mtime IS NOT NULL")
+		return dict((row["night"], { "mtime": row["mtime"], "raw_bytes": row["raw_bytes"],
+									 "summary_bytes": row["summary_bytes"], "uploaded": bool(row["uploaded"]) }) for row in rows)
+
+	def update_sizes(self, index):
+		with self.lock:
+			db = self.db()
+			with db:
+				for night, info in index.items():
+					db.execute("INSERT OR IGNORE INTO nights (night) VALUES (?)", (night,))
+					db.execute("UPDATE nights SET mtime = ?, raw_bytes = ?, summary_bytes = ?, uploaded = ? WHERE night = ?",
+							   (info["mtime"], info["raw_bytes"], info["summary_bytes"], int(info["uploaded"]), night))
+
+	def set_state(self, night, state):
+		self.write("UPDATE nights SET state = ? WHERE night = ?", (state, night))
+
+	def set_timelapse(self, night, status, mtime, frames):
+		self.write("UPDATE nights SET timelapse = ?, timelapse_mtime = ?, frames = ? WHERE night = ?",
+				   (status, mtime, frames, night))
+
+	# Sessions and frames:
+
+	def session(self, folder, camera=None, exposure=None, gain=None):
+		# Id of the session for a capture folder (relative to the image folder), adding it if it's new.
+		night = folder.split("/")[0]
+		with self.lock:
+			db = self.db()
+			with db:
+				db.execute("INSERT OR IGNORE INTO nights (night) VALUES (?)", (night,))
+				db.execute("INSERT OR IGNORE INTO sessions (folder, night, camera, exposure, gain) VALUES (?, ?, ?, ?, ?)",
+						   (folder, night, camera, exposure, gain))
+			return db.execute("SELECT id FROM sessions WHERE folder = ?", (folder,)).fetchone()[0]
+
+	def add_frames(self, session, frames):
+		# 'frames' = (frame number, time, exposure, gain, path, uploaded, sky level) for each frame
+		with self.lock:
+			db = self.db()
+			with db:
+				db.executemany("INSERT OR REPLACE INTO frames (session, idx, time, exposure, gain, path, uploaded, sky_level) "
+							   "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", [ (session,) + tuple(x) for x in frames ])
+				db.execute("UPDATE sessions SET frames = (SELECT COUNT(*) FROM frames WHERE session = ?) WHERE id = ?",
+						   (session, session))
+
+	def record(self, folder, filename, data):
+		# Fills in a session from one of the files store_data() writes in its folder.
+		if filename == "capture_settings.json" and "cameras" not in data:
+			start, finish = parse_time(data.get("start")), parse_time(data.get("finish"))
+			hours = elapsed(start, finish)
+			session = self.session(folder, data.get("camera"), data.get("exposure"), data.get("gain"))
+			self.write("UPDATE sessions SET camera = ?, start = ?, finish = ?, hours = ?, exposure = ?, gain = ?, "
+					   "missed_slots = ?, settings = ?, "
+					   "sky_level = (SELECT AVG(sky_level) FROM frames WHERE session = ?) WHERE id = ?",
+					   (data.get("camera"), iso(local_time(start)), iso(local_time(finish)), hours, data.get("exposure"), data.get("gain"),
+						data.get("missed_slots"), json.dumps(data, default=iso), session, session))
+		elif filename == "file_info.json":
+			self.write("UPDATE sessions SET frames = MAX(frames, ?) WHERE folder = ?", (data.get("image_count", 0), folder))
+
+	def mark_uploaded(self, folder, filenames):
+		# Marks a capture folder's frames as uploaded, given the file names the uploader has confirmed.
+		rows = self.query("SELECT id FROM sessions WHERE folder = ?", (folder,))
+		if not rows:
+			return
+		names = set(filenames)
+		frames = self.query("SELECT idx, path FROM frames WHERE session = ? AND uploaded = 0", (rows[0]["id"],))
+		done = [ (rows[0]["id"], x["idx"]) for x in frames if frame_file(x["path"]) in names ]
+		with self.lock:
+			db = self.db()
+			with db:
+				db.executemany("UPDATE frames SET uploaded = 1 WHERE session = ? AND idx = ?", done)
+
+	# Bulk import:
+
+	def import_nights(self, names=None):
+		# Adds the night folders in the image folder that aren't in the index yet.  Returns the nights added.
+		known = set(row["night"] for row in self.query("SELECT night FROM nights"))
+		if names is None:
+			names = sorted(x for x in os.listdir(self.base_dir) if night_date(x) is not None)
+		added = []
+		for night in names:
+			if night in known or not os.path.isdir(self.base_dir + night):
+				continue
+			self.add_night(night)
+			for folder in capture_folders(self.base_dir + night):
+				self.import_folder(os.path.relpath(folder, self.base_dir))
+			added.append(night)
+		return added
+
+	def import_folder(self, folder):
+		# One capture folder: its settings, its frames from the manifest (or the numbered frame files) and what's
+		# been uploaded.
+		path = self.base_dir + folder + "/"
+		settings = read_json(path + "capture_settings.json") or {}
+		session = self.session(folder, settings.get("camera"), settings.get("exposure"), settings.get("gain"))
+		if settings:
+			self.record(folder, "capture_settings.json", settings)
+		uploaded = set()
+		if os.path.isfile(path + uploader.STATE_FILE):
+			with open(path + uploader.STATE_FILE, 'r') as f:
+				uploaded = set(line.strip() for line in f)
+
+		rows = manifest.read(path)
+		if rows is not None:
+			frames = [ (int(x["index"]), x["timestamp"], float(x["exposure"]), int(float(x["gain"])), frame_path(folder, x["filename"]),
+						int(frame_file(x["filename"]) in uploaded), None) for x in rows ]
+		else:
+			files = sorted(os.path.basename(x) for x in glob.glob(path + "[0-9]*.*") if not x.endswith(".npy"))
+			frames = [ (n + 1, datetime.fromtimestamp(os.path.getmtime(path + x)).replace(microsecond=0).isoformat(),
+						settings.get("exposure"), settings.get("gain"), frame_path(folder, x), int(x in uploaded), None)
+					   for n, x in enumerate(files) ]
+		for n in range(0, len(frames), BATCH * 10):
+			self.add_frames(session, frames[n:n + BATCH * 10])
+		info = read_json(path + "file_info.json")
+		if info:
+			self.record(folder, "file_info.json", info)
+
+
+class ArchiveWriter(object):
+	# Adds a session's frames to the index from a background thread, committing them in batches.
+
+	def __init__(self, index, folder, camera=None, exposure=None, gain=None, name="archive"):
+		self.index = index
+		self.folder = folder
+		self.session = index.session(folder, camera, exposure, gain)
+		self.pending = []
+		self.failed = []
+		self.pool = WorkerPool(self._write, 1, 0, name, self._failed).start()
+
+	def add(self, number, timestamp, exposure, gain, filename, sky_level=None):
+		# Never waits on the database.
+		self.pool.put((number, timestamp.isoformat(), exposure, gain, frame_path(self.folder, filename), 0, sky_level))
+
+	def stop(self):
+		# Writes whatever is still queued.  Returns the pool, for its stats.
+		self.pool.stop()
+		self._commit()
+		return self.pool
+
+	def _write(self, frame):
+		self.pending.append(frame)
+		if len(self.pending) >= BATCH or self.pool.depth() == 0:	# Commit once we've caught up, or every BATCH frames
+			self._commit()
+
+	def _commit(self):
+		if self.pending:
+			frames, self.pending = self.pending, []
+			self.index.add_frames(self.session, frames)
+
+	def _failed(self, frame, error):
+		self.failed.append((frame[0], str(error)))
+
+
+def open_index(base_dir):
+	# The index for an image folder, shared by everything in this process.  Created (and the folder imported) the
+	# first time.
+	key = os.path.abspath(base_dir)
+	with _indexes_lock:
+		index = _indexes.get(key)
+		if index is None:
+			index = _indexes[key] = ArchiveIndex(base_dir)
+	return index
+
+def capture_folders(night_dir):
+	# As sky_capture.capture_folders(): a subfolder for each camera, or just the night folder.
+	night_dir = os.path.join(night_dir, "")
+	cameras = [ night_dir + x for x in sorted(os.listdir(night_dir)) if manifest.exists(night_dir + x) ]
+	return cameras or [ night_dir.rstrip("/") ]
+
+def frame_path(folder, filename):
+	return folder + "/" + filename
+
+def frame_file(path):
+	# The file a frame path is in - the chunk file for a frame store locator ('frames_00000.npy:12').
+	return os.path.basename(path).split(":")[0]
+
+def night_date(name):
+	try:
+		return datetime.strptime(name, NIGHT_FORMAT)
+	except ValueError:
+		return None
+
+def parse_time(value):
+	# An isoformat() time, with or without a UTC offset ('2024-03-01T02:15:30-07:00', as capture_settings.json has it).
+	# Keeps the offset, if there is one, so times either side of a DST change still subtract properly.
+	if value is None or isinstance(value, datetime):
+		return value
+	offset = None
+	if value.endswith("Z"):
+		value, offset = value[:-1], 0
+	elif len(value) > 19 and value[-6] in "+-" and value[-3] == ":":
+		try:
+			offset = (int(value[-5:-3]) * 60 + int(value[-2:])) * (-1 if value[-6] == "-" else 1)
+		except ValueError:
+			return None
+		value = value[:-6]
+	for fmt in ("%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S"):
+		try:
+			time = datetime.strptime(value, fmt)
+		except ValueError:
+			continue
+		return time if offset is None else time.replace(tzinfo=pytz.FixedOffset(offset))
+	return None
+
+def local_time(value):
+	# The local clock time, without its offset, as the index stores times.
+	if isinstance(value, datetime) and value.tzinfo is not None:
+		return value.replace(tzinfo=None)
+	return value
+
+def elapsed(start, finish):
+	# Hours from 'start' to 'finish', or None if either is missing.
+	if not start or not finish:
+		return None
+	if (start.tzinfo is None) != (finish.tzinfo is None):
+		start, finish = local_time(start), local_time(finish)
+	return (finish - start).total_seconds() / 3600.0
+
+def iso(value):
+	return value.isoformat() if isinstance(value, datetime) else value
+
+def read_json(path):
+	try:
+		with open(path, 'r') as f:
+			return json.load(f)
+	except (IOError, ValueError):
+		return None
+
+# Command line queries:
+
+def query_sessions(index, args):
+	sql = "SELECT folder, camera, start, finish, ROUND(hours, 2) AS hours, exposure, gain, frames, ROUND(sky_level, 3) AS sky_level FROM sessions WHERE 1"
+	params = []
+	if args.min_hours is not None:
+		sql += " AND hours >= ?"
+		params.append(args.min_hours)
+	if args.gain is not None:
+		sql += " AND gain = ?"
+		params.append(args.gain)
+	if args.camera is not None:
+		sql += " AND camera = ?"
+		params.append(args.camera)
+	sql, params = date_range(sql, params, "start", args)
+	return index.query(sql + " ORDER BY start", params)
+
+def query_frames(index, args):
+	sql = ("SELECT frames.time, sessions.folder, frames.idx, frames.exposure, frames.gain, frames.path, frames.uploaded, "
+		   "ROUND(frames.sky_level, 3) AS sky_level FROM frames JOIN sessions ON sessions.id = frames.session WHERE 1")
+	params = []
+	sql, params = date_range(sql, params, "frames.time", args)
+	if args.between:
+		first, last = args.between
+		clock_time = "substr(frames.time, 12, 8)"
+		if first <= last:
+			sql += " AND " + clock_time + " >= ? AND " + clock_time + " < ?"
+		else:											# Across midnight
+			sql += " AND (" + clock_time + " >= ? OR " + clock_time + " < ?)"
+		params += [ first, last ]
+	if args.gain is not None:
+		sql += " AND frames.gain = ?"
+		params.append(args.gain)
+	if args.not_uploaded:
+		sql += " AND frames.uploaded = 0"
+	sql += " ORDER BY frames.time"
+	if args.limit:
+		sql += " LIMIT " + str(int(args.limit))
+	return index.query(sql, params)
+
+def date_range(sql, params, column, args):
+	if args.start:
+		sql += " AND " + column + " >= ?"
+		params.append(args.start)
+	if args.end:
+		sql += " AND " + column + " < ?"
+		params.append(args.end)
+	return sql, params
+
+def print_rows(rows):
+	if not rows:
+		print("(no rows)")
+		return
+	print("\t".join(rows[0].keys()))
+	for row in rows:
+		print("\t".join("" if x is None else str(x) for x in row))
+
+def main():
+	parser = argparse.ArgumentParser(description="Query the SkyCam archive index.")
+	parser.add_argument("--folder", help="image folder (default from settings.json)")
+	commands = parser.add_subparsers(dest="command")
+	command = commands.add_parser("import", help="add night folders that aren't in the index yet")
+	command.add_argument("nights", nargs="*", help="just these nights (YYYYMMDD)")
+	command = commands.add_parser("nights", help="list the nights and their state")
+	command = commands.add_parser("sessions", help="list capture sessions")
+	command.add_argument("--min-hours", type=float)
+	command.add_argument("--gain", type=int)
+	command.add_argument("--camera")
+	command.add_argument("--from", dest="start", help="starting on or after this date/time (YYYY-MM-DD[THH:MM])")
+	command.add_argument("--to", dest="end", help="starting before this date/time")
+	command = commands.add_parser("frames", help="list frames")
+	command.add_argument("--from", dest="start", help="taken on or after this date/time (YYYY-MM-DD[THH:MM])")
+	command.add_argument("--to", dest="end", help="taken before this date/time")
+	command.add_argument("--between", nargs=2, metavar=("HH:MM", "HH:MM"), help="taken between these times of night, on any date")
+	command.add_argument("--gain", type=int)
+	command.add_argument("--not-uploaded", action="store_true")
+	command.add_argument("--limit", type=int)
+	command = commands.add_parser("sql", help="run a query of your own")
+	command.add_argument("query")
+	args = parser.parse_args()
+
+	base_dir = args.folder
+	if base_dir is None:
+		this_folder = os.path.abspath(os.path.dirname(__file__))
+		with open(this_folder + '/' + 'settings.json', 'r') as f:
+			base_dir = json.load(f)['image_folder']
+	if not os.path.isdir(base_dir):
+		sys.exit("No such folder: " + base_dir)
+	index = open_index(base_dir)
+
+	if args.command == "import":
+		added = index.import_nights(args.nights or None)
+		print("Imported " + str(len(added)) + " nights" + (": " + ", ".join(added) if added else ""))
+	elif args.command == "nights":
+		print_rows(index.query("SELECT nights.night, state, COUNT(sessions.id) AS sessions, SUM(sessions.frames) AS frames, "
+							   "ROUND(SUM(sessions.hours), 2) AS hours, uploaded, timelapse FROM nights "
+							   "LEFT JOIN sessions ON sessions.night = nights.night GROUP BY nights.night ORDER BY nights.night"))
+	elif args.command == "sessions":
+		print_rows(query_sessions(index, args))
+	elif args.command == "frames":
+		print_rows(query_frames(index, args))
+	else:
+		print_rows(index.query(args.query))
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,110 @@
+# Closed-loop auto exposure.
+#
+# Fixed night settings blow out the frames at the start and end of the night and under a bright moon.  AutoExposure
+# looks at each frame as it comes off the camera and works out the exposure and gain for the next one:
+#
+#	- The sky level is the median of a strided view of the frame - every STRIDE'th pixel of every STRIDE'th row (more
+#	  for big frames, to keep to about SAMPLES pixels), green only for colour.  Only the samples are copied, so it
+#	  takes well under a millisecond for a full frame.
+#	- The exposure is moved part of the way (DAMPING) towards what would bring that level to the target, at most
+#	  MAX_STEP times brighter or darker per frame, and not at all if the next frame's level is expected to be within
+#	  TOLERANCE anyway.
+#	- Exposure time is used up before gain going up, and gain is given up first going down, so the frames stay as
+#	  clean as they can be.  Both stay within the configured bounds.
+#	- With dark calibration, only the exposure / gain pairs there are master darks for are used (see calibration.py)
+#	  - whichever is nearest to what's wanted, without damping - so every frame can still be calibrated.
+#	- Optionally, the change in the sun's altitude since the last frame is fed forward, since the twilight sky gets
+#	  brighter or darker by a fairly steady amount per degree.  The feedback then only has to correct what's left.
+#
+# The exposure and gain used for each frame are recorded in the manifest.
+
+import numpy as np
+
+TARGET = 0.25												# Sky level to aim for, as a fraction of full scale
+STRIDE = 8													# Sample at least every 8th pixel of every 8th row
+SAMPLES = 20000												# Pixels to sample, roughly
+DAMPING = 0.5												# Fraction of the error corrected each frame
+MAX_STEP = 4.0												# Most the exposure can change by in one frame
+TOLERANCE = 0.15											# Leave the exposure alone if the level is within 15% of the target
+SATURATED = 0.98											# A median this high means the frame is blown out and tells us little
+TWILIGHT = (-18.0, 0.0)										# Sun altitudes where the feed-forward applies, degrees
+SKY_MAG_PER_DEGREE = 0.9									# Twilight sky brightness change per degree of sun altitude
+
+class AutoExposure(object):
+
+	def __init__(self, exposure, gain, min_exposure, max_exposure, min_gain, max_gain, target=TARGET, damping=DAMPING,
+				 stride=STRIDE, steps=None):
+		# 'exposure'	=	Starting exposure, in seconds
+		# 'gain'		=	Starting gain, in the camera's units (0.1 dB)
+		# 'steps'		=	Optional list of (exposure, gain) pairs to keep to - any outside the bounds are left out
+		self.min_exposure = min_exposure
+		self.max_exposure = max_exposure
+		self.min_gain = min_gain
+		self.max_gain = max_gain
+		self.target = target
+		self.damping = damping
+		self.stride = stride
+		self.exposure = min(max(exposure, min_exposure), max_exposure)
+		self.gain = min(max(gain, min_gain), max_gain)
+		self.steps = None
+		if steps is not None:
+			self.steps = [ x for x in steps if min_exposure <= x[0] <= max_exposure and min_gain <= x[1] <= max_gain ]
+			if self.steps:
+				self.set_brightness(self.brightness())			# Start on one of them
+		self.level = None										# Sky level of the last frame
+		self.sun_altitude = None
+
+	def measure(self, frame):
+		return sky_level(frame, self.stride)
+
+	def update(self, frame, sun_altitude=None):
+		# Works out the settings for the next frame from this one.  Returns (exposure, gain).
+		self.level = self.measure(frame)
+		sky = 1.0												# How much darker the sky will be for the next frame
+		if sun_altitude is not None:
+			if self.sun_altitude is not None and in_twilight(sun_altitude) and in_twilight(self.sun_altitude):
+				sky = 10 ** (0.4 * SKY_MAG_PER_DEGREE * (self.sun_altitude - sun_altitude))	# Sun going down - sky getting darker
+			self.sun_altitude = sun_altitude
+
+		if self.level >= SATURATED:
+			ratio = 1.0 / MAX_STEP
+		elif abs(self.level / sky / self.target - 1.0) <= TOLERANCE:	# Next frame will be close enough as it is
+			ratio = 1.0
+		else:
+			damping = 1.0 if self.steps else self.damping		# A damped move could fall short of the next step every time
+			ratio = sky * (self.target / max(self.level, 1.0 / 255)) ** damping
+
+		ratio = min(max(ratio, 1.0 / MAX_STEP), MAX_STEP)
+		if ratio != 1.0:
+			self.set_brightness(self.brightness() * ratio)
+		return self.exposure, self.gain
+
+	def brightness(self):
+		return self.exposure * gain_factor(self.gain)
+
+	def set_brightness(self, brightness):
+		# Splits an exposure x gain product into exposure and gain: as much exposure as allowed, then gain.  With
+		# steps, it's the step whose product is nearest - the one with less gain if two are as near.
+		if self.steps:
+			self.exposure, self.gain = min(self.steps, key=lambda x: (round(abs(np.log(x[0] * gain_factor(x[1]) / brightness)), 6), x[1]))
+			return
+		self.exposure = min(max(brightness / gain_factor(self.min_gain), self.min_exposure), self.max_exposure)
+		gain = 200.0 * np.log10(brightness / self.exposure)
+		self.gain = int(round(min(max(gain, self.min_gain), self.max_gain)))
+
+
+def sky_level(frame, stride=STRIDE):
+	# Sky level of a frame, 0 to 1.
+	stride = max(stride, int((frame.shape[0] * frame.shape[1] / SAMPLES) ** 0.5))
+	sample = frame[::stride, ::stride]
+	if sample.ndim == 3:
+		sample = sample[:, :, 1]
+	full_scale = 65535.0 if frame.dtype.itemsize == 2 else 255.0
+	return float(np.median(sample)) / full_scale
+
+def gain_factor(gain):
+	# ASI gain is in 0.1 dB steps.
+	return 10 ** (gain / 200.0)
+
+def in_twilight(altitude):
+	return TWILIGHT[0] <= altitude <= TWILIGHT[1]
@@ -0,0 +1,184 @@
+#!/usr/bin/python
+# Benchmarks the whole night pipeline on a simulated camera - no ASI camera or library needed.
+#
+# Captures a number of synthetic frames through the same CaptureSession used by start_capture(), then runs
+# sort_files, generate_timelapse and trail_videos (if ffmpeg is installed) and star_trails on the result.  Reports
+# frames per hour, wall time for each stage, peak RSS and bytes written, so changes to the capture or post-processing
+# paths can be compared by the numbers.
+#
+# Example:	python benchmark.py --frames 200 --width 3096 --height 2080 --pipelined --startrails
+#			python benchmark.py --frames 100 --cameras 4 --readout 0.2
+
+import argparse, json, os, resource, shutil, tempfile, threading, time
+from collections import OrderedDict
+from datetime import datetime
+from distutils.spawn import find_executable
+
+import sky_capture, skycam, skylog, metrics, calibration
+from startrailer import star_trails, trail_videos
+
+def folder_bytes(path):
+	total = 0
+	for root, dirs, files in os.walk(path):
+		for name in files:
+			total += os.path.getsize(os.path.join(root, name))
+	return total
+
+def configure(args, base_dir):
+	# Point sky_capture at a scratch folder and set the options under test.
+	sky_capture.BASEDIR = base_dir + "/"
+	sky_capture.FILE_EXT = args.ext
+	sky_capture.EXPOSURE_TIME = args.exposure
+	sky_capture.GAIN = 300
+	sky_capture.GAMMA = 50
+	sky_capture.WAIT_BETWEEN = 0
+	sky_capture.TIMELAPSE_FPS = 25
+	sky_capture.TIMELAPSE_SEGMENTS = args.segments
+	sky_capture.PIPELINED = args.pipelined
+	sky_capture.WRITER_THREADS = args.writers
+	sky_capture.STORAGE_MODE = args.storage
+	sky_capture.DARK_CALIBRATION = args.darks > 0
+	sky_capture.DARKS_FOLDER = base_dir + "/darks/"
+	sky_capture.CREATE_STARTRAILS = args.startrails
+	sky_capture.CREATE_KEOGRAM = args.keogram
+	sky_capture.CREATE_PREVIEWS = args.previews
+	sky_capture.DETECT_METEORS = args.meteors is not None
+	sky_capture.CREATE_TIMELAPSE = args.stream_timelapse
+	sky_capture.STREAM_TIMELAPSE = args.stream_timelapse
+	sky_capture.REMOTE_SERVER = None
+	sky_capture.UPLOAD_DURING_CAPTURE = False
+	skylog.configure(echo=args.verbose)
+
+def run(args):
+	base_dir = args.output or tempfile.mkdtemp(prefix="skycam_bench_")
+	night_dir = os.path.join(base_dir, "benchmark") + "/"
+	if os.path.exists(night_dir):
+		shutil.rmtree(night_dir)
+	os.makedirs(night_dir)
+	logfile = night_dir + "capture_log_benchmark.log"
+	configure(args, base_dir)
+
+	# With several cameras, each captures into its own subfolder from its own thread, as in start_capture()
+	sessions = []
+	for n in range(args.cameras):
+		camera = skycam.open_camera(n, True, width=args.width, height=args.height, readout=args.readout,
+									time_scale=1.0 if args.realtime else 0.0, meteors=args.meteors or 0.0)
+		camera.set_controls(sky_capture.GAIN, sky_capture.GAMMA, args.image_type)
+		if args.darks:									# Master dark for this camera before the night starts
+			frames = (camera.capture(long(args.exposure * 1e6), None, dark=True) for x in range(args.darks))
+			calibration.DarkLibrary(sky_capture.darks_folder()).build(frames, args.darks, args.exposure, sky_capture.GAIN,
+																	  camera.temperature(), n)
+		folder = night_dir if args.cameras == 1 else night_dir + "camera" + str(n) + "/"
+		if not os.path.exists(folder):
+			os.makedirs(folder)
+		sessions.append(sky_capture.CaptureSession(folder, folder + os.path.basename(logfile), args.frames, camera))
+
+	stages = OrderedDict()
+
+	def capture(session):
+		for n in range(args.frames):
+			session.capture(datetime.now())
+		session.finish()
+
+	start = time.time()
+	threads = [ threading.Thread(target=capture, args=(session,)) for session in sessions ]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	stages["capture"] = time.time() - start
+
+	folders = sky_capture.capture_folders(night_dir)
+	start = time.time()
+	for folder in folders:
+		sky_capture.sort_files(folder)
+	stages["sort_files"] = time.time() - start
+
+	if not args.stream_timelapse and find_executable("ffmpeg"):
+		start = time.time()
+		for folder in folders:
+			sky_capture.generate_timelapse(folder, 25, args.ext)
+		stages["generate_timelapse"] = time.time() - start
+
+	start = time.time()
+	for folder in folders:
+		star_trails(folder, "star_trails_reprocessed.jpg", args.ext.strip("."))
+	stages["star_trails"] = time.time() - start
+
+	if args.trail_videos and find_executable("ffmpeg"):
+		videos = [ { "name": "star_trails_video", "mode": "cumulative" },
+				   { "name": "comet_trails", "mode": "comet", "length": args.trail_videos } ]
+		start = time.time()
+		for folder in folders:
+			trail_videos(folder, videos, 25, args.ext.strip("."))
+		stages["trail_videos"] = time.time() - start
+
+	skylog.flush()
+
+	results = OrderedDict()
+	results["cameras"] = args.cameras
+	results["frames"] = args.frames * args.cameras
+	results["resolution"] = str(args.width) + "x" + str(args.height)
+	results["image_type"] = args.image_type
+	results["storage"] = args.storage
+	results["darks"] = args.darks
+	results["frames_per_hour"] = round(results["frames"] / stages["capture"] * 3600) if stages["capture"] else None
+	results["stages"] = OrderedDict((k, round(v, 3)) for k, v in stages.items())
+	results["peak_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1)
+	results["peak_child_rss_mb"] = round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.0, 1)
+	results["bytes_written"] = folder_bytes(night_dir)
+	if args.meteors is not None:
+		results["meteors"] = OrderedDict([ ("simulated", sum(len(x.camera.camera.meteor_frames) for x in sessions)) ] +
+										 [ (key, sum(x.meteors.stats()[key] for x in sessions)) for key in ("events", "checked", "skipped") ] +
+										 [ (key, max(x.meteors.stats()[key] for x in sessions)) for key in ("mean_ms", "max_ms", "memory_mb") ])
+	results["spans"] = OrderedDict((name, OrderedDict([ ("count", h["count"]), ("mean", h["mean"]), ("max", h["max"]) ]))
+								   for name, h in metrics.snapshot().items())
+
+	if not args.keep and not args.output:
+		shutil.rmtree(base_dir)
+	return results
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark the SkyCam night pipeline with a simulated camera.")
+	parser.add_argument("--frames", type=int, default=100, help="number of frames to capture (per camera)")
+	parser.add_argument("--cameras", type=int, default=1, help="number of simulated cameras to capture with at once")
+	parser.add_argument("--width", type=int, default=1920)
+	parser.add_argument("--height", type=int, default=1080)
+	parser.add_argument("--image-type", type=int, default=1, choices=[0, 1, 2], help="0 = 8-bit mono, 1 = 24-bit colour, 2 = 16-bit mono")
+	parser.add_argument("--exposure", type=float, default=5, help="exposure time in seconds (only waited for with --realtime)")
+	parser.add_argument("--readout", type=float, default=0.0, help="simulated readout time per frame, in seconds")
+	parser.add_argument("--realtime", action="store_true", help="actually wait for each exposure")
+	parser.add_argument("--ext", default=".jpg", help="frame file type")
+	parser.add_argument("--pipelined", action="store_true", help="use pipelined capture")
+	parser.add_argument("--storage", default="files", choices=["files", "framestore"], help="save a file per frame, or raw frames in a frame store")
+	parser.add_argument("--darks", type=int, default=0, help="make a master dark from this many frames and calibrate with it")
+	parser.add_argument("--writers", type=int, default=2, help="writer threads for pipelined capture")
+	parser.add_argument("--startrails", action="store_true", help="stack star trails during capture")
+	parser.add_argument("--keogram", action="store_true", help="build a keogram during capture")
+	parser.add_argument("--meteors", type=float, help="chance of a simulated meteor in each frame - turns on meteor detection")
+	parser.add_argument("--previews", action="store_true", help="make previews and publish latest.jpg during capture")
+	parser.add_argument("--trail-videos", type=int, metavar="LENGTH", help="make a star trail video and a comet trail video with tails this many frames long")
+	parser.add_argument("--segments", type=int, help="timelapse segments to encode at once (default one per core)")
+	parser.add_argument("--stream-timelapse", action="store_true", help="stream the timelapse to ffmpeg during capture")
+	parser.add_argument("--output", help="folder to capture into (kept afterwards) - default is a temporary folder")
+	parser.add_argument("--keep", action="store_true", help="don't delete the temporary folder")
+	parser.add_argument("--json", action="store_true", help="print results as JSON")
+	parser.add_argument("--verbose", action="store_true", help="echo log messages")
+	args = parser.parse_args()
+
+	results = run(args)
+	if args.json:
+		print(json.dumps(results, indent=4))
+		return
+	for key, value in results.items():
+		if key == "stages":
+			for stage, seconds in value.items():
+				print("  %-20s %10.3f s" % (stage, seconds))
+		elif key == "spans":
+			for name, h in value.items():
+				print("  %-20s %6d x  mean %8.4f s  max %8.4f s" % (name, h["count"], h["mean"], h["max"]))
+		else:
+			print("%-22s %s" % (key, value))
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,87 @@
+# Capture scheduling for the capture loop.
+#
+# By default frames are taken back to back, 'interval' seconds apart: each exposure starts that long after the last
+# frame was dealt with, however long that took.
+#
+# With a period set, exposures are started on a fixed grid instead (start, start + period, start + 2 * period...)
+# measured with a monotonic clock, so the time each frame takes to capture and write doesn't stretch the night and NTP
+# adjustments to the wall clock can't end it early or late.  If a frame overruns its slot, the slots it covered are
+# counted as missed rather than shifting everything after it - so the period needs to be longer than a frame takes
+# (exposure, readout, encoding and writing).
+#
+# The time comes from the clock module, so a replay can run the grid on a virtual clock.
+
+import clock
+
+class Cadence(object):
+
+	def __init__(self, period, duration, interval=0.0):
+		# 'period'	=	Seconds between the start of one exposure and the next, or None to capture back to back...
+		# 'interval'	=	...with this many seconds between the end of one frame and the start of the next
+		# 'duration'	=	Seconds from now until capture should stop
+		self.period = float(period) if period else None
+		self.interval = interval or 0.0
+		self.start = clock.monotonic()
+		self.end = self.start + duration
+		self.slot = 0										# Next slot on the grid
+		self.frames = 0
+		self.missed = 0										# Slots we were too busy to use
+		self.jitter = 0.0									# How late (seconds) the last frame started
+		self.total_jitter = 0.0
+		self.max_jitter = 0.0
+		self.first = None									# When the first and last frames started
+		self.last = None
+
+	def next(self):
+		# Waits for the next slot.  Returns the number of slots missed since the last frame (0 if we kept up, and
+		# always 0 back to back), or None once capture should stop.
+		if self.period is None:
+			return self._next_free()
+		now = clock.monotonic()
+		target = self.start + self.slot * self.period
+		missed = 0
+		if now >= target + self.period:						# Overran by at least one whole slot - skip ahead
+			missed = int((now - target) // self.period)
+			self.slot += missed
+			self.missed += missed
+			target = self.start + self.slot * self.period
+
+		if target >= self.end:
+			return None
+		if target > now:
+			clock.sleep(target - now)
+
+		self.jitter = clock.monotonic() - target
+		self.total_jitter += self.jitter
+		self.max_jitter = max(self.max_jitter, self.jitter)
+		self.slot += 1
+		self._started()
+		return missed
+
+	def _next_free(self):
+		if self.frames and self.interval > 0:
+			clock.sleep(self.interval)
+		if clock.monotonic() >= self.end:
+			return None
+		self._started()
+		return 0
+
+	def _started(self):
+		self.last = clock.monotonic()
+		if self.first is None:
+			self.first = self.last
+		self.frames += 1
+
+	def remaining(self):
+		return max(0.0, self.end - clock.monotonic())
+
+	def summary(self):
+		# Jitter only means something on a grid - back to back there's no slot to be late for.
+		on_grid = self.period is not None
+		mean = self.total_jitter / self.frames if self.frames else 0.0
+		return { "period": self.period,
+				 "mean_period": round((self.last - self.first) / (self.frames - 1), 4) if self.frames > 1 else None,
+				 "frames": self.frames,
+				 "missed_slots": self.missed,
+				 "mean_jitter": round(mean, 4) if on_grid else None,
+				 "max_jitter": round(self.max_jitter, 4) if on_grid else None }
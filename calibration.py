@@ -0,0 +1,212 @@
+#!/usr/bin/python
+# Dark frame calibration.
+#
+# Hot pixels and amp glow are the same in every frame, so the max-stacked star trails end up with all of them.  A
+# master dark (the per-pixel median of a set of dark frames) taken at the same exposure, gain and sensor temperature
+# records that pattern, and subtracting it from each frame removes it.
+#
+# Master darks are kept in a dark library folder ('darks' in the image folder by default) with an index,
+# 'darks.json', so they only have to be made once for each camera / exposure / gain / temperature.  During capture
+# a DarkSubtractor looks up the right master (re-checking the sensor temperature once a minute) and subtracts it
+# from each frame, clipping at zero, before the frame is saved, stacked or encoded.
+#
+# Capturing darks (cover the lens first):	python calibration.py capture --frames 30
+# Importing existing dark frames:		python calibration.py import --exposure 5 --gain 300 --temperature 12 dark*.png
+
+import argparse, json, os, sys, time
+import numpy as np
+from PIL import Image
+try:
+	from time import monotonic
+except ImportError:
+	from monotonic import monotonic							# Python 2
+
+INDEX_FILE = "darks.json"
+MAX_TEMPERATURE_DIFF = 5.0									# Degrees C - further off than this and a master dark doesn't match
+TEMPERATURE_CHECK = 60										# Seconds between sensor temperature checks during capture
+MAX_MEMORY = 256											# MB to use for median stacking, at most
+
+class DarkLibrary(object):
+
+	def __init__(self, folder):
+		self.folder = folder
+		self.index_path = os.path.join(folder, INDEX_FILE)
+		self.masters = {}									# Master darks already loaded, by file name
+		try:
+			with open(self.index_path, 'r') as f:
+				self.index = json.load(f)
+		except (IOError, ValueError):
+			self.index = []
+
+	def find(self, exposure, gain, temperature=None, camera=0):
+		# Returns the index entry of the master dark that best matches, or None.
+		best = None
+		for entry in self.index:
+			if entry["camera"] != camera or entry["gain"] != gain or abs(entry["exposure"] - exposure) > 1e-6:
+				continue
+			if temperature is None or entry["temperature"] is None:
+				difference = 0
+			else:
+				difference = abs(entry["temperature"] - temperature)
+				if difference > MAX_TEMPERATURE_DIFF:
+					continue
+			if best is None or difference < best[0]:
+				best = (difference, entry)
+		return best[1] if best is not None else None
+
+	def settings(self, camera=0, temperature=None):
+		# The (exposure, gain) pairs there are master darks for, sorted.  Only masters that would match at
+		# 'temperature' are counted, if it's given.
+		return sorted(set((x["exposure"], x["gain"]) for x in self.index if x["camera"] == camera and
+						  (temperature is None or x["temperature"] is None or
+						   abs(x["temperature"] - temperature) <= MAX_TEMPERATURE_DIFF)))
+
+	def master(self, exposure, gain, temperature=None, camera=0):
+		# Returns the best matching master dark as an array, or None if there isn't one.
+		entry = self.find(exposure, gain, temperature, camera)
+		if entry is None:
+			return None
+		if entry["file"] not in self.masters:
+			self.masters[entry["file"]] = np.load(os.path.join(self.folder, entry["file"]))
+		return self.masters[entry["file"]]
+
+	def build(self, frames, count, exposure, gain, temperature=None, camera=0):
+		# Makes a master dark from 'count' dark frames (any iterable of arrays) and adds it to the library.
+		#
+		# The frames are spooled to a memory-mapped file and the median is taken a band of rows at a time, so memory
+		# use stays under MAX_MEMORY however many frames there are.  Returns the master's index entry.
+		if not os.path.exists(self.folder):
+			os.makedirs(self.folder)
+		name = "dark_c" + str(camera) + "_e" + str(exposure) + "_g" + str(gain)
+		if temperature is not None:
+			name += "_t" + str(int(round(temperature)))
+		spool_file = os.path.join(self.folder, name + ".spool.npy")
+
+		stack = None
+		n = 0
+		try:
+			for frame in frames:
+				if stack is None:
+					stack = np.lib.format.open_memmap(spool_file, mode='w+', dtype=frame.dtype, shape=(count,) + frame.shape)
+				stack[n] = frame
+				n += 1
+				if n == count:
+					break
+			if n == 0:
+				raise ValueError("No dark frames")
+
+			row_bytes = n * stack[0, 0].size * 8				# np.median works on a float64 copy
+			rows = max(1, int(MAX_MEMORY * 1024 * 1024 / row_bytes))
+			master = np.empty(stack.shape[1:], dtype=stack.dtype)
+			for r in range(0, master.shape[0], rows):
+				master[r:r + rows] = np.rint(np.median(stack[:n, r:r + rows], axis=0))
+		finally:
+			del stack
+			if os.path.exists(spool_file):
+				os.remove(spool_file)
+
+		filename = name + ".npy"
+		temp_file = os.path.join(self.folder, name + ".tmp")
+		with open(temp_file, 'wb') as f:
+			np.save(f, master)
+		os.rename(temp_file, os.path.join(self.folder, filename))
+		self.masters[filename] = master
+
+		entry = { "file": filename, "camera": camera, "exposure": exposure, "gain": gain, "temperature": temperature,
+				  "frames": n, "created": time.strftime("%Y-%m-%dT%H:%M:%S") }
+		self.index = [ x for x in self.index if x["file"] != filename ] + [ entry ]
+		self.save()
+		return entry
+
+	def save(self):
+		temp_file = self.index_path + ".tmp"
+		with open(temp_file, 'w') as f:
+			json.dump(self.index, f, indent=4)
+		os.rename(temp_file, self.index_path)
+
+
+class DarkSubtractor(object):
+	# Subtracts the matching master dark from each frame for one camera.  The master is only looked up again when
+	# the sensor temperature is re-read (every TEMPERATURE_CHECK seconds), so the per-frame cost is the subtraction.
+
+	def __init__(self, library, camera, exposure, gain):
+		self.library = library
+		self.camera = camera
+		self.exposure = exposure
+		self.gain = gain
+		self.dark = None
+		self.temperature = None
+		self.next_check = 0
+		self.frames = 0										# Frames calibrated
+		self.missing = False								# True while there's no matching master dark
+
+	def apply(self, frame):
+		if monotonic() >= self.next_check:
+			self.refresh()
+		if self.dark is None or self.dark.shape != frame.shape or self.dark.dtype != frame.dtype:
+			return frame
+		self.frames += 1
+		return subtract(frame, self.dark)
+
+	def set_exposure(self, exposure, gain):
+		# For auto exposure - looks up the master for the new settings before the next frame.
+		if (exposure, gain) != (self.exposure, self.gain):
+			self.exposure = exposure
+			self.gain = gain
+			self.next_check = 0
+
+	def refresh(self):
+		self.temperature = self.camera.temperature()
+		self.dark = self.library.master(self.exposure, self.gain, self.temperature, self.camera.id)
+		self.missing = self.dark is None
+		self.next_check = monotonic() + TEMPERATURE_CHECK
+
+
+def subtract(frame, dark):
+	# frame - dark, clipped at zero, without going up to a wider type.  Returns a new array.
+	result = np.maximum(frame, dark)
+	result -= dark
+	return result
+
+def read_frames(files):
+	for filename in files:
+		yield np.asarray(Image.open(filename))
+
+def main():
+	import sky_capture, skycam
+
+	parser = argparse.ArgumentParser(description="Make master dark frames for calibration.")
+	parser.add_argument("action", choices=["capture", "import", "list"])
+	parser.add_argument("files", nargs="*", help="dark frames to import")
+	parser.add_argument("--frames", type=int, default=30, help="number of dark frames to capture")
+	parser.add_argument("--exposure", type=float, help="exposure in seconds (default from settings)")
+	parser.add_argument("--gain", type=int, help="gain (default from settings)")
+	parser.add_argument("--temperature", type=float, help="sensor temperature of imported darks")
+	parser.add_argument("--camera", type=int, default=0, help="camera id")
+	args = parser.parse_args()
+
+	sky_capture.load_settings()
+	library = DarkLibrary(sky_capture.darks_folder())
+	exposure = args.exposure if args.exposure is not None else sky_capture.EXPOSURE_TIME
+	gain = args.gain if args.gain is not None else sky_capture.GAIN
+
+	if args.action == "list":
+		for entry in library.index:
+			print("%-40s camera %d  %6s s  gain %4d  %5s C  %d frames" % (entry["file"], entry["camera"], entry["exposure"],
+				  entry["gain"], entry["temperature"], entry["frames"]))
+		return
+
+	if args.action == "import":
+		if not args.files:
+			sys.exit("No dark frames given")
+		entry = library.build(read_frames(args.files), len(args.files), exposure, gain, args.temperature, args.camera)
+	else:
+		camera = skycam.open_camera(args.camera, sky_capture.SIMULATE_CAMERA)
+		camera.set_controls(gain, sky_capture.GAMMA, sky_capture.IMAGE_TYPE)
+		temperature = camera.temperature()
+		frames = (camera.capture(long(exposure * 1e6), None, dark=True) for n in range(args.frames))
+		entry = library.build(frames, args.frames, exposure, gain, temperature, args.camera)
+	print("Master dark saved to " + os.path.join(library.folder, entry["file"]) + " (" + str(entry["frames"]) + " frames)")
+
+if __name__ == "__main__":
+	main()
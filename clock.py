@@ -0,0 +1,112 @@
+# Where the capture loop gets the time from.
+#
+# sky_capture, the capture cadence and retention ask this module for the time and do their waiting through it,
+# rather than calling datetime.now(), time.sleep() or pause directly.  Normally that's the real clock.  A replay (see
+# replay.py) installs a VirtualClock instead, so a whole night - or several - runs in minutes:
+#
+#	- until() (waiting for twilight, or for the next sunset) jumps straight to the time asked for.
+#	- sleep() (the gaps between frames) waits 1/'speed' of the time asked for, so the night runs 'speed' times
+#	  faster than real time and the time spent capturing and saving each frame counts 'speed' times over.  With no
+#	  speed it doesn't wait at all and time only moves on when something sleeps - as fast as the I/O allows, but
+#	  only for a single camera, since the threads of several cameras would each move the time on for the others.
+#
+# now() gives naive local time like datetime.now() (and like sunpos.local_time()), utcnow() naive UTC, and
+# monotonic() seconds from an arbitrary start.
+
+import threading, time
+from datetime import datetime
+import pause
+try:
+	from time import monotonic as _monotonic
+except ImportError:
+	from monotonic import monotonic as _monotonic				# Python 2
+
+class Clock(object):
+	# The real time.
+
+	def now(self):
+		return datetime.now()
+
+	def utcnow(self):
+		return datetime.utcnow()
+
+	def monotonic(self):
+		return _monotonic()
+
+	def sleep(self, seconds):
+		if seconds > 0:
+			time.sleep(seconds)
+
+	def until(self, when):
+		pause.until(when)
+
+
+class VirtualClock(Clock):
+
+	def __init__(self, start, speed=None):
+		# 'start'	=	Time to start from, local time
+		# 'speed'	=	How many times faster than real time to run, or None not to wait at all
+		self.start = timestamp(start)
+		self.speed = speed
+		self.real_start = _monotonic()
+		self.skipped = 0.0										# Seconds jumped over by until() (and sleep() with no speed)
+		self.lock = threading.Lock()
+
+	def time(self):
+		# Seconds since the epoch, like time.time().
+		elapsed = (_monotonic() - self.real_start) * self.speed if self.speed else 0.0
+		return self.start + elapsed + self.skipped
+
+	def now(self):
+		return datetime.fromtimestamp(self.time())
+
+	def utcnow(self):
+		return datetime.utcfromtimestamp(self.time())
+
+	def monotonic(self):
+		return self.time() - self.start
+
+	def sleep(self, seconds):
+		if seconds <= 0:
+			return
+		if self.speed:
+			time.sleep(seconds / float(self.speed))
+			return
+		self.skip_to(self.time() + seconds)
+
+	def until(self, when):
+		self.skip_to(timestamp(when))
+
+	def skip_to(self, target):
+		# Moves the time on to 'target' (seconds since the epoch), unless it's already past it.
+		with self.lock:
+			self.skipped += max(0.0, target - self.time())
+
+
+def timestamp(when):
+	# Seconds since the epoch for a datetime, read as local time whatever its time zone - as pause.until() does on
+	# Python 2, and as sunpos gives its times.
+	return time.mktime(when.replace(tzinfo=None).timetuple()) + when.microsecond / 1e6
+
+current = Clock()
+
+def install(clock):
+	# Use 'clock' from now on.  Returns it.
+	global current
+	current = clock
+	return clock
+
+def now():
+	return current.now()
+
+def utcnow():
+	return current.utcnow()
+
+def monotonic():
+	return current.monotonic()
+
+def sleep(seconds):
+	current.sleep(seconds)
+
+def until(when):
+	current.until(when)
@@ -0,0 +1,155 @@
+# Raw frame storage.
+#
+# Instead of encoding every frame to its own JPEG, a FrameStore appends the frames exactly as they come off the
+# camera (RAW8, RAW16 or RGB24) into a handful of preallocated, memory-mapped .npy chunks in the night folder:
+# 'frames_00000.npy', 'frames_00001.npy', etc., each holding CHUNK_FRAMES frames.  The frame size and type are kept
+# in 'frames.json', and the manifest records where each frame went ('frames_00003.npy:17'), so it doubles as the
+# index.
+#
+# Writing a frame is a memory copy rather than an encode and a new file, and anything that reads the night back
+# (star trails, timelapse) gets each chunk as one array it can work through with sequential reads and no copying.
+
+import json, os
+import numpy as np
+import manifest
+
+LAYOUT_FILE = "frames.json"
+CHUNK_PREFIX = "frames_"
+CHUNK_FRAMES = 100
+
+class FrameStore(object):
+
+	def __init__(self, night_dir, chunk_frames=CHUNK_FRAMES, on_chunk=None):
+		# 'chunk_frames'	=	Frames per chunk file, for a new store.  An existing store keeps its own.
+		# 'on_chunk'		=	Called with the file name of each chunk once it is full (e.g. to upload it)
+		self.night_dir = night_dir
+		self.on_chunk = on_chunk
+		self.chunk = None										# Chunk currently being written to
+		self.chunk_index = None
+		self.shape = None
+		self.dtype = None
+		self.chunk_frames = chunk_frames
+		layout = read_layout(night_dir)
+		if layout is not None:
+			self.shape = tuple(layout["shape"])
+			self.dtype = np.dtype(layout["dtype"])
+			self.chunk_frames = layout["chunk_frames"]
+		self.count = stored_frames(night_dir)					# Carry on after the last frame the manifest knows about
+
+	def __len__(self):
+		return self.count
+
+	def __iter__(self):
+		for chunk in self.chunks():
+			for frame in chunk:
+				yield frame
+
+	def append(self, frame):
+		# Stores a frame and returns where it went, for the manifest.
+		if self.shape is None:
+			self._create(frame)
+		if frame.shape != self.shape or frame.dtype != self.dtype:
+			raise ValueError("Frame format changed from " + str(self.dtype) + " " + str(self.shape) + " to " +
+							 str(frame.dtype) + " " + str(frame.shape))
+
+		chunk_index, offset = divmod(self.count, self.chunk_frames)
+		if chunk_index != self.chunk_index:
+			self._open(chunk_index)
+		self.chunk[offset] = frame
+		self.count += 1
+
+		if offset == self.chunk_frames - 1:						# Chunk is full - make sure it's on disk and let it go
+			self.chunk.flush()
+			self.chunk = None
+			self.chunk_index = None
+			if self.on_chunk is not None:
+				self.on_chunk(chunk_name(chunk_index))
+		return locator(self.count - 1, self.chunk_frames)
+
+	def frame(self, n):
+		# Frame 'n' (counting from 0) as a read-only view into its chunk.
+		chunk_index, offset = divmod(n, self.chunk_frames)
+		return self._load(chunk_index)[offset]
+
+	def chunks(self):
+		# Yields each chunk in capture order.
+		for chunk_index in range(self.chunk_count()):
+			yield self.read_chunk(chunk_index)
+
+	def read_chunk(self, chunk_index):
+		# One chunk as an array of frames, trimmed to the frames actually stored in it.
+		filled = min(self.chunk_frames, self.count - chunk_index * self.chunk_frames)
+		return self._load(chunk_index)[:filled]
+
+	def chunk_count(self):
+		return (self.count + self.chunk_frames - 1) // self.chunk_frames
+
+	def flush(self):
+		if self.chunk is not None:
+			self.chunk.flush()
+
+	def close(self):
+		self.flush()
+		self.chunk = None
+		self.chunk_index = None
+
+	def _create(self, frame):
+		self.shape = frame.shape
+		self.dtype = frame.dtype
+		layout = { "shape": list(self.shape), "dtype": self.dtype.str, "chunk_frames": self.chunk_frames }
+		temp_file = os.path.join(self.night_dir, LAYOUT_FILE + ".tmp")
+		with open(temp_file, 'w') as f:
+			json.dump(layout, f)
+		os.rename(temp_file, os.path.join(self.night_dir, LAYOUT_FILE))
+
+	def _open(self, chunk_index):
+		# Opens a chunk for writing, creating it at full size if it isn't there yet.  The unwritten part of a new
+		# chunk is left sparse, so a part-filled last chunk doesn't take up its full size on disk.
+		self.flush()
+		path = os.path.join(self.night_dir, chunk_name(chunk_index))
+		if os.path.exists(path):
+			self.chunk = np.lib.format.open_memmap(path, mode='r+')	# Resuming an interrupted night
+		else:
+			self.chunk = np.lib.format.open_memmap(path, mode='w+', dtype=self.dtype,
+												   shape=(self.chunk_frames,) + self.shape)
+		self.chunk_index = chunk_index
+
+	def _load(self, chunk_index):
+		if chunk_index == self.chunk_index:
+			return self.chunk
+		return np.load(os.path.join(self.night_dir, chunk_name(chunk_index)), mmap_mode='r')
+
+
+def exists(night_dir):
+	return os.path.isfile(os.path.join(night_dir, LAYOUT_FILE))
+
+def read_layout(night_dir):
+	try:
+		with open(os.path.join(night_dir, LAYOUT_FILE), 'r') as f:
+			return json.load(f)
+	except (IOError, ValueError):
+		return None
+
+def chunk_name(chunk_index):
+	return CHUNK_PREFIX + '{:05d}'.format(chunk_index) + ".npy"
+
+def locator(n, chunk_frames=CHUNK_FRAMES):
+	chunk_index, offset = divmod(n, chunk_frames)
+	return chunk_name(chunk_index) + ":" + str(offset)
+
+def is_locator(filename):
+	return filename.startswith(CHUNK_PREFIX) and ":" in filename
+
+def position(locator, chunk_frames):
+	# Where a locator points in the store, counting from 0 - as for FrameStore.frame().
+	name, offset = locator.rsplit(":", 1)
+	return int(name[len(CHUNK_PREFIX):-len(".npy")]) * chunk_frames + int(offset)
+
+def stored_frames(night_dir):
+	# Number of frames in the night's store, going by the last one the manifest recorded.  (A frame only counts
+	# once it is in the manifest, so a crash between storing a frame and recording it just loses that frame.)
+	rows = manifest.read(night_dir) or []
+	for row in reversed(rows):
+		if is_locator(row["filename"]):
+			return position(row["filename"], read_layout(night_dir)["chunk_frames"]) + 1
+	return 0
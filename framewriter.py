@@ -0,0 +1,39 @@
+# Background JPEG encoding and disk writes for pipelined capture.
+#
+# The capture loop hands over the raw frame buffer and goes straight back to exposing.  Worker threads do the encode
+# and the write.  The queue is bounded, so if storage falls behind the capture loop waits instead of buffering frames
+# until we run out of memory.
+
+import skycam, metrics
+from workers import WorkerPool
+
+class FrameWriter(object):
+
+	def __init__(self, threads=2, max_queue=4, written=None, name="framewriter"):
+		# 'written'	=	Optional function called with each file name once it has been saved
+		self.failed = []										# Files that could not be written
+		self.on_written = written
+		self.pool = WorkerPool(self._save, threads, max_queue, name, self._failed).start()
+
+	def write(self, img, filename, saved=None):
+		# Queue a frame for writing.  'saved' is called with no arguments once it's been written, if it is.  Returns
+		# the number of seconds spent waiting for room in the queue.
+		return self.pool.put((img, filename, saved))
+
+	def stop(self):
+		# Wait for all queued frames to be written.  Returns the pool, for its stats.
+		self.pool.stop()
+		return self.pool
+
+	def _save(self, item):
+		img, filename, saved = item
+		with metrics.span("encode_write"):
+			skycam.save_frame(img, filename)
+		if saved is not None:
+			saved()
+		if self.on_written is not None:
+			self.on_written(filename)
+
+	def _failed(self, item, error):
+		self.failed.append((item[1], str(error)))
+
@@ -0,0 +1,53 @@
+# Keogram: the centre (meridian) column of every frame, side by side, so the whole night fits in one image.
+#
+# Built incrementally in the capture loop from the frame buffers as they come off the camera, so no extra pass over
+# the night folder is needed.  Columns go into a preallocated array that grows if the night turns out longer than
+# expected, and the array is checkpointed now and then so an interrupted night can carry on.
+
+from PIL import Image
+from startrailer import to_8bit
+import numpy as np
+import os
+
+class Keogram(object):
+
+	def __init__(self, expected_frames=1000, checkpoint_file=None):
+		self.expected_frames = max(1, int(expected_frames))
+		self.columns = None									# One row per frame: (frames, height[, channels])
+		self.count = 0
+		self.checkpoint_file = checkpoint_file
+		if checkpoint_file is not None and os.path.exists(checkpoint_file):
+			self.columns = np.load(checkpoint_file)			# Resume from an interrupted run
+			self.count = len(self.columns)
+
+	def add(self, frame):
+		column = frame[:, frame.shape[1] // 2]
+		if self.columns is None or self.columns.shape[1:] != column.shape or self.columns.dtype != column.dtype:
+			self.columns = np.zeros((self.expected_frames,) + column.shape, dtype=column.dtype)
+			self.count = 0
+		elif self.count == len(self.columns):
+			# Longer night than we planned for - double the space
+			self.columns = np.concatenate((self.columns, np.zeros_like(self.columns)))
+		self.columns[self.count] = column
+		self.count += 1
+
+	def image(self):
+		# Time runs left to right, so each frame's column becomes a column of the image.
+		return to_8bit(np.swapaxes(self.columns[:self.count], 0, 1))
+
+	def checkpoint(self):
+		if self.columns is None or self.checkpoint_file is None:
+			return
+		temp_file = self.checkpoint_file + ".tmp"
+		with open(temp_file, 'wb') as f:
+			np.save(f, self.columns[:self.count])
+		os.rename(temp_file, self.checkpoint_file)
+
+	def save(self, output_name):
+		# Saves the keogram and removes the checkpoint.
+		if self.count == 0:
+			return None
+		Image.fromarray(np.ascontiguousarray(self.image())).save(output_name, "JPEG")
+		if self.checkpoint_file is not None and os.path.exists(self.checkpoint_file):
+			os.remove(self.checkpoint_file)
+		return output_name
@@ -0,0 +1,99 @@
+# Per-night frame manifest.
+#
+# The capture loop appends one line per frame to 'manifest.csv' in the night folder as it goes.  Frames are numbered
+# when they are captured, so nothing needs to be sorted or renamed afterwards - anything that needs the frames in
+# order (timelapse, star trails, uploads) reads them from here.  If capture is interrupted, the manifest tells us
+# where to carry on from.
+#
+# With pipelined capture a frame is numbered when it's captured but only recorded once the writer has saved it, so
+# the manifest never lists a file that didn't make it to disk.  The writer threads can finish out of order, so read()
+# puts the rows back in frame order.
+
+import csv, os, threading
+from collections import OrderedDict
+
+MANIFEST_FILE = "manifest.csv"
+FIELDS = ["index", "timestamp", "exposure", "gain", "filename"]
+FRAME_PADDING = 5											# Frame file names are '00001.jpg', '00002.jpg', etc.
+
+# Everything else in a capture folder.  Sorting, pruning, previews and uploads all go by these, so a new product
+# only needs adding here.
+UPLOAD_STATE_FILE = "uploaded.txt"							# What the uploader has sent (see uploader.py)
+SKIP_FILE = ".skip"											# Tells tlapse there are no frames left to build a timelapse from
+SUMMARY_PREFIXES = ( "timelapse", "star_trails_", "keogram_", "capture_log_", "meteor_" )	# The night's products, not frames
+SUMMARY_FILES = ( MANIFEST_FILE, "capture_settings.json", "file_info.json", "metrics.json", "events.jsonl",
+				  UPLOAD_STATE_FILE, SKIP_FILE )
+SUMMARY_SUFFIXES = ( ".mp4", )								# Timelapse renditions can be named anything
+LOCAL_ONLY = ( UPLOAD_STATE_FILE, SKIP_FILE, "star_trails.npy", "star_trails.npy.tmp", "keogram.npy", "keogram.npy.tmp" )	# Working files that never get uploaded
+
+class Manifest(object):
+
+	def __init__(self, night_dir):
+		self.night_dir = night_dir
+		self.path = os.path.join(night_dir, MANIFEST_FILE)
+		self.count = 0
+		self.last = 0											# Highest frame number handed out
+		self.lock = threading.Lock()							# Pipelined frames are recorded from the writer threads
+		rows = read(night_dir)
+		if rows:
+			self.count = self.last = int(rows[-1]["index"])	# Resuming an interrupted night - carry on numbering from the last frame
+		is_new = rows is None
+		self.file = open(self.path, 'ab')
+		if not is_new and self.file.tell() > 0:
+			with open(self.path, 'rb') as f:
+				f.seek(-1, os.SEEK_END)
+				if f.read(1) != "\n":
+					self.file.write("\n")			# Don't append onto a line that was cut short by a crash
+		self.writer = csv.writer(self.file)
+		if is_new:
+			self.writer.writerow(FIELDS)
+			self.file.flush()
+
+	def next_filename(self, extension=".jpg"):
+		return ('{:0' + str(FRAME_PADDING) + 'd}').format(self.last + 1) + extension
+
+	def number(self):
+		# Hands out the next frame number without recording the frame - add() it with this number once it's been saved.
+		with self.lock:
+			self.last += 1
+			return self.last
+
+	def add(self, timestamp, exposure, gain, filename, index=None):
+		# Records a captured frame, numbering it unless it was given a number().  Each line is flushed straight away
+		# so the manifest survives a crash.
+		with self.lock:
+			if index is None:
+				self.last += 1
+				index = self.last
+			self.count += 1
+			self.writer.writerow([index, timestamp.isoformat(), exposure, gain, filename])
+			self.file.flush()
+		return index
+
+	def close(self):
+		self.file.close()
+
+
+def exists(night_dir):
+	return os.path.isfile(os.path.join(night_dir, MANIFEST_FILE))
+
+def read(night_dir):
+	# Returns the manifest rows (as dictionaries) in capture order, or None if the night has no manifest.
+	path = os.path.join(night_dir, MANIFEST_FILE)
+	if not os.path.isfile(path):
+		return None
+	with open(path, 'rb') as f:
+		rows = [ OrderedDict(zip(FIELDS, row)) for row in csv.reader(f) ]
+	rows = [ row for row in rows[1:] if len(row) == len(FIELDS) ]	# Skip the header and any line cut short by a crash
+	return sorted(rows, key=lambda row: int(row["index"]))
+
+def is_summary(filename):
+	# True for the night's products and records - anything that isn't a frame.
+	return filename in SUMMARY_FILES or filename.startswith(SUMMARY_PREFIXES) or filename.endswith(SUMMARY_SUFFIXES)
+
+def frame_files(night_dir):
+	# Returns the frame file names in capture order, or None if the night has no manifest.
+	rows = read(night_dir)
+	if rows is None:
+		return None
+	return [ row["filename"] for row in rows ]
@@ -0,0 +1,204 @@
+# Meteor (and other transient) detection during capture.
+#
+# A MeteorDetector works through the frames in a background thread alongside the capture loop.  For each frame it:
+#
+#	- Shrinks it to 1/DOWNSAMPLE size (green channel only for colour, by 2x2 box averages).
+#	- Subtracts the background: the per-pixel median of the last three shrunk frames.  At that size the stars barely
+#	  move between frames and hot pixels don't move at all, so they cancel out and anything new is left.
+#	- Thresholds the difference at THRESHOLD times the noise, estimated from the difference itself.
+#	- Looks for straight streaks among the bright pixels with a Hough transform, keeping a line only if its pixels
+#	  make an unbroken run at least MIN_LENGTH long.
+#
+# Hits are appended to 'events.jsonl' in the capture folder (one JSON object per line) with a crop of the full-size
+# frame around each streak ('meteor_00042_0.jpg').
+#
+# The work per frame is bounded: a frame with more than MAX_POINTS bright pixels (cloud rolling in, headlights, the
+# moon rising) isn't searched, and at most MAX_LINES lines are looked for.  If the thread is still busy when the next
+# frame arrives, that frame is skipped rather than holding up capture, so at most one frame is ever waiting.  stats()
+# reports the time taken per frame against BUDGET, and the memory held.
+
+import json, os
+import numpy as np
+import manifest, metrics, preview
+from workers import WorkerPool
+try:
+	from time import monotonic
+except ImportError:
+	from monotonic import monotonic							# Python 2
+
+EVENTS_FILE = "events.jsonl"
+CROP_PREFIX = "meteor_"
+DOWNSAMPLE = 4												# Must be a power of 2
+THRESHOLD = 5.0												# Times the noise
+MIN_DIFF = 12												# Smallest difference that counts, whatever the noise
+MIN_POINTS = 8												# Bright pixels (shrunk) a streak needs
+MIN_LENGTH = 12												# Shrunk pixels - 48 full size pixels at DOWNSAMPLE = 4
+MAX_GAP = 3													# Biggest gap allowed along a streak
+LINE_WIDTH = 1.5											# How far off the line a pixel can be and still be on it
+MAX_POINTS = 1500											# Frames with more bright pixels than this aren't searched
+MAX_LINES = 3
+THETAS = 90													# Hough angle steps (2 degrees)
+CROP_MARGIN = 32											# Full size pixels around a streak in its crop
+BUDGET = 0.1												# Seconds per frame we aim to stay under
+
+_ANGLES = np.linspace(0, np.pi, THETAS, endpoint=False)
+_COS = np.cos(_ANGLES).astype(np.float32)
+_SIN = np.sin(_ANGLES).astype(np.float32)
+
+class MeteorDetector(object):
+
+	def __init__(self, capture_dir, threshold=THRESHOLD, downsample=DOWNSAMPLE, max_queue=1, name="meteors"):
+		self.capture_dir = capture_dir
+		self.threshold = threshold
+		self.downsample = downsample
+		self.max_queue = max_queue
+		self.background = None									# Last three shrunk frames
+		self.slot = 0
+		self.frame_bytes = 0
+		self.checked = 0										# Frames searched
+		self.skipped = 0										# Frames the thread was too busy for
+		self.crowded = 0										# Frames with too many bright pixels to search
+		self.events = 0
+		self.over_budget = 0
+		self.total_time = 0.0
+		self.max_time = 0.0
+		self.failed = []
+		self.pool = WorkerPool(self._check, 1, 0, name, self._failed).start()
+
+	def add(self, frame, index, timestamp):
+		# Queue a frame to be checked.  Never waits - returns False if the frame was skipped.
+		if self.pool.depth() >= self.max_queue:
+			self.skipped += 1
+			return False
+		self.frame_bytes = frame.nbytes
+		self.pool.put((frame, index, timestamp))
+		return True
+
+	def stop(self):
+		# Wait for the queued frames to be checked.  Returns stats().
+		self.pool.stop()
+		return self.stats()
+
+	def stats(self):
+		return { "checked": self.checked,
+				 "skipped": self.skipped,
+				 "crowded": self.crowded,
+				 "events": self.events,
+				 "mean_ms": round(self.total_time / self.checked * 1000, 2) if self.checked else None,
+				 "max_ms": round(self.max_time * 1000, 2),
+				 "budget_ms": BUDGET * 1000,
+				 "over_budget": self.over_budget,
+				 "memory_mb": round(self.memory() / 1e6, 1) }
+
+	def memory(self):
+		# Bytes held at most: the background frames, the working arrays the same size (the median, the int16
+		# difference and the mask) and the full size frames waiting or being checked.
+		small = self.background[0].nbytes if self.background is not None else 0
+		return small * 3 + small * 4 + self.frame_bytes * (self.max_queue + 1)
+
+	def detect(self, frame):
+		# Returns the streaks in a frame as ((x1, y1), (x2, y2), points), in full size pixels.
+		small = shrink(frame, self.downsample)
+		if self.background is None or self.background.shape[1:] != small.shape:
+			self.background = np.array([ small, small, small ])
+			return []
+		background = median3(self.background[0], self.background[1], self.background[2])
+		self.background[self.slot] = small
+		self.slot = (self.slot + 1) % 3
+
+		diff = small.astype(np.int16)
+		diff -= background
+		noise = 1.4826 * np.median(np.abs(diff[::4, ::4]))		# Robust standard deviation
+		ys, xs = np.nonzero(diff > max(MIN_DIFF, self.threshold * noise))
+		if len(xs) < MIN_POINTS:
+			return []
+		if len(xs) > MAX_POINTS:
+			self.crowded += 1
+			return []
+		scale = self.downsample
+		return [ ((x1 * scale + scale // 2, y1 * scale + scale // 2), (x2 * scale + scale // 2, y2 * scale + scale // 2), n)
+				 for (x1, y1), (x2, y2), n in find_lines(xs, ys) ]
+
+	def _check(self, item):
+		frame, index, timestamp = item
+		start = monotonic()
+		with metrics.span("meteor_detect"):
+			lines = self.detect(frame)
+		for n, line in enumerate(lines):
+			self._record(frame, index, timestamp, n, line)
+		elapsed = monotonic() - start
+		self.checked += 1
+		self.total_time += elapsed
+		self.max_time = max(self.max_time, elapsed)
+		if elapsed > BUDGET:
+			self.over_budget += 1
+
+	def _record(self, frame, index, timestamp, n, line):
+		(x1, y1), (x2, y2), points = line
+		height, width = frame.shape[:2]
+		left = max(0, min(x1, x2) - CROP_MARGIN)
+		right = min(width, max(x1, x2) + CROP_MARGIN)
+		top = max(0, min(y1, y2) - CROP_MARGIN)
+		bottom = min(height, max(y1, y2) + CROP_MARGIN)
+		crop = CROP_PREFIX + ('{:0' + str(manifest.FRAME_PADDING) + 'd}').format(index) + "_" + str(n) + ".jpg"
+		preview.save_atomic(np.ascontiguousarray(preview.to_8bit(frame[top:bottom, left:right])),
+							os.path.join(self.capture_dir, crop))
+		event = { "frame": index, "time": timestamp.isoformat(), "start": [ int(x1), int(y1) ], "end": [ int(x2), int(y2) ],
+				  "length": int(round(np.hypot(x2 - x1, y2 - y1))), "points": int(points), "crop": crop }
+		with open(os.path.join(self.capture_dir, EVENTS_FILE), 'a') as f:
+			f.write(json.dumps(event) + "\n")
+		self.events += 1
+
+	def _failed(self, item, error):
+		self.failed.append((item[1], str(error)))
+
+
+def shrink(frame, downsample):
+	# Green channel (or the only channel), 8-bit, at 1/'downsample' size.
+	if frame.ndim == 3:
+		frame = frame[:, :, 1]
+	return preview.pyramid(preview.to_8bit(frame), downsample)[downsample]
+
+def median3(a, b, c):
+	# Per-pixel median of three arrays, without sorting.
+	return np.maximum(np.minimum(a, b), np.minimum(np.maximum(a, b), c))
+
+def find_lines(xs, ys, max_lines=MAX_LINES):
+	# Finds straight streaks among a set of points.  Each line is the strongest peak in a Hough transform of the
+	# points left over, kept if the points along it make an unbroken run; either way those points are taken out
+	# before looking for the next one.  Returns ((x1, y1), (x2, y2), points) for each streak.
+	xs = xs.astype(np.float32)
+	ys = ys.astype(np.float32)
+	offset = int(np.ceil(np.hypot(xs.max(), ys.max()))) + 1
+	bins = 2 * offset + 1
+	left = np.ones(len(xs), dtype=bool)
+	lines = []
+	for attempt in range(max_lines):
+		index = np.nonzero(left)[0]
+		if len(index) < MIN_POINTS:
+			break
+		px = xs[index]
+		py = ys[index]
+		rho = np.rint(np.outer(px, _COS) + np.outer(py, _SIN)).astype(np.int32) + offset
+		votes = np.bincount((rho + np.arange(THETAS, dtype=np.int32) * bins).ravel(), minlength=THETAS * bins)
+		best = votes.argmax()
+		if votes[best] < MIN_POINTS:
+			break
+		theta, r = divmod(best, bins)
+		r -= offset
+		cos, sin = _COS[theta], _SIN[theta]
+		near = np.abs(px * cos + py * sin - r) <= LINE_WIDTH
+		along = np.sort(py[near] * cos - px[near] * sin)
+		left[index[near]] = False
+
+		breaks = np.nonzero(np.diff(along) > MAX_GAP)[0]
+		starts = np.concatenate(([ 0 ], breaks + 1))
+		ends = np.concatenate((breaks, [ len(along) - 1 ]))
+		longest = np.argmax(along[ends] - along[starts])
+		a1, a2 = along[starts[longest]], along[ends[longest]]
+		points = ends[longest] - starts[longest] + 1
+		if a2 - a1 < MIN_LENGTH or points < MIN_POINTS:
+			continue
+		lines.append(((int(round(r * cos - a1 * sin)), int(round(r * sin + a1 * cos))),
+					  (int(round(r * cos - a2 * sin)), int(round(r * sin + a2 * cos))), points))
+	return lines
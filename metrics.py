@@ -0,0 +1,128 @@
+# Timing metrics for the capture loop and the post-night pipeline.
+#
+# Wrap a stage in 'with metrics.span("name"):' and its duration is added to a histogram for that stage.  The
+# histograms can be written out as JSON (metrics.json in the night folder), as a Prometheus text file (for the
+# node_exporter textfile collector) or served over HTTP from a small local endpoint.
+
+import json, os, threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+try:
+	from time import monotonic
+except ImportError:
+	from monotonic import monotonic							# Python 2
+
+# Histogram bucket upper bounds, in seconds
+BUCKETS = [ 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 1800 ]
+PREFIX = "skycam_stage_seconds"
+
+_histograms = OrderedDict()
+_lock = threading.Lock()
+_server = None
+
+class Histogram(object):
+
+	def __init__(self):
+		self.count = 0
+		self.sum = 0.0
+		self.min = None
+		self.max = None
+		self.buckets = [0] * len(BUCKETS)
+
+	def observe(self, value):
+		self.count += 1
+		self.sum += value
+		if self.min is None or value < self.min: self.min = value
+		if self.max is None or value > self.max: self.max = value
+		for i, bound in enumerate(BUCKETS):
+			if value <= bound:
+				self.buckets[i] += 1
+				break
+
+	def as_dict(self):
+		cumulative = 0
+		buckets = OrderedDict()
+		for bound, n in zip(BUCKETS, self.buckets):
+			cumulative += n
+			buckets[str(bound)] = cumulative
+		return OrderedDict([ ("count", self.count),
+							 ("sum", round(self.sum, 6)),
+							 ("mean", round(self.sum / self.count, 6) if self.count else None),
+							 ("min", round(self.min, 6) if self.min is not None else None),
+							 ("max", round(self.max, 6) if self.max is not None else None),
+							 ("buckets", buckets) ])
+
+def observe(name, seconds):
+	with _lock:
+		h = _histograms.get(name)
+		if h is None:
+			h = _histograms[name] = Histogram()
+		h.observe(seconds)
+
+@contextmanager
+def span(name):
+	# Times the enclosed block and records it under 'name'.
+	start = monotonic()
+	try:
+		yield
+	finally:
+		observe(name, monotonic() - start)
+
+def reset():
+	with _lock:
+		_histograms.clear()
+
+def snapshot():
+	with _lock:
+		return OrderedDict((name, h.as_dict()) for name, h in _histograms.items())
+
+def write_json(path):
+	_write_atomic(path, json.dumps(snapshot(), indent=4))
+
+def prometheus_text():
+	lines = [ "# HELP " + PREFIX + " Time spent in each stage of the SkyCam pipeline.",
+			  "# TYPE " + PREFIX + " histogram" ]
+	for name, h in snapshot().items():
+		for bound, n in h["buckets"].items():
+			lines.append('%s_bucket{stage="%s",le="%s"} %d' % (PREFIX, name, bound, n))
+		lines.append('%s_bucket{stage="%s",le="+Inf"} %d' % (PREFIX, name, h["count"]))
+		lines.append('%s_sum{stage="%s"} %s' % (PREFIX, name, repr(h["sum"])))
+		lines.append('%s_count{stage="%s"} %d' % (PREFIX, name, h["count"]))
+	return "\n".join(lines) + "\n"
+
+def write_prometheus(path):
+	_write_atomic(path, prometheus_text())
+
+def serve(port, host="127.0.0.1"):
+	# Serves the Prometheus text on http://host:port/metrics from a background thread.
+	global _server
+	if _server is not None:
+		return _server
+	_server = HTTPServer((host, port), _MetricsHandler)
+	t = threading.Thread(target=_server.serve_forever, name="metrics")
+	t.daemon = True
+	t.start()
+	return _server
+
+def _write_atomic(path, text):
+	temp_file = path + ".tmp"
+	with open(temp_file, 'w') as f:
+		f.write(text)
+	os.rename(temp_file, path)
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+	def do_GET(self):
+		if self.path.split("?")[0] not in ("/", "/metrics"):
+			self.send_error(404)
+			return
+		body = prometheus_text()
+		self.send_response(200)
+		self.send_header("Content-Type", "text/plain; version=0.0.4")
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		pass
@@ -0,0 +1,160 @@
+#!/usr/bin/python
+# Downscaled previews of each frame, for the "current sky" page and the night browser.
+#
+# During capture, CaptureSession hands each frame (already in memory) to a PreviewMaker.  A background thread
+# halves it down to 1/2, 1/4 and 1/8 size - each level is a 2x2 box average of the one before, so there's no full
+# decode or resample - and saves them in 'preview_2', 'preview_4' and 'preview_8' in the capture folder, named by
+# frame number ('00042.jpg').  It also publishes the newest frame as 'latest.jpg' in the image folder.  Every file
+# is written under a temporary name and renamed into place, so a viewer never sees a half-written image, and
+# nothing a viewer needs is ever read from the full-size frames.
+#
+# Previews are best effort: if the thread falls behind, frames are skipped rather than holding up capture.
+#
+# Previews for a night that was captured without them can be made afterwards, from the frame files:
+#
+#	python preview.py /path/to/images/20240101
+
+import os, sys, glob
+import numpy as np
+from PIL import Image
+import manifest, framestore, metrics
+from workers import WorkerPool
+from startrailer import to_8bit
+
+FOLDER_PREFIX = "preview_"									# 'preview_2' holds every frame at 1/2 size, etc.
+SCALES = (2, 4, 8)
+LATEST_FILE = "latest.jpg"
+QUALITY = 85
+
+class PreviewMaker(object):
+
+	def __init__(self, capture_dir, latest=None, scales=SCALES, latest_scale=2, max_queue=2, name="previews"):
+		# 'latest'		=	Where to publish the newest frame, or None not to
+		# 'latest_scale'	=	Size of the published frame, 1 for full size
+		# 'max_queue'		=	Frames waiting for the thread beyond this are skipped
+		self.capture_dir = capture_dir
+		self.latest = latest
+		self.scales = sorted(scales)
+		self.latest_scale = latest_scale
+		self.max_queue = max_queue
+		self.skipped = 0										# Frames we didn't have time for
+		self.failed = []
+		self.published = 0										# Frame number of the current latest.jpg
+		for scale in self.scales:
+			if not os.path.exists(folder(capture_dir, scale)):
+				os.makedirs(folder(capture_dir, scale))
+		self.pool = WorkerPool(self._make, 1, 0, name, self._failed).start()
+
+	def add(self, frame, index):
+		# Queue frame number 'index' for previews.  Never waits - returns False if the frame was skipped.
+		if self.pool.depth() >= self.max_queue:
+			self.skipped += 1
+			return False
+		self.pool.put((frame, index))
+		return True
+
+	def stop(self):
+		# Wait for the queued frames to be done.  Returns the pool, for its stats.
+		self.pool.stop()
+		return self.pool
+
+	def _make(self, item):
+		frame, index = item
+		with metrics.span("previews"):
+			levels = pyramid(to_8bit(frame), max(self.scales + [ self.latest_scale ]))
+			for scale in self.scales:
+				save_atomic(levels[scale], os.path.join(folder(self.capture_dir, scale), frame_name(index)))
+			if self.latest is not None and index > self.published:
+				save_atomic(levels[self.latest_scale], self.latest)
+				self.published = index
+
+	def _failed(self, item, error):
+		self.failed.append((item[1], str(error)))
+
+
+def folder(capture_dir, scale):
+	return os.path.join(capture_dir, FOLDER_PREFIX + str(scale))
+
+def is_preview_folder(name):
+	return name.startswith(FOLDER_PREFIX)
+
+def frame_name(index):
+	return ('{:0' + str(manifest.FRAME_PADDING) + 'd}').format(index) + ".jpg"
+
+def halve(img):
+	# 2x2 box average, in integer arithmetic.  Odd edge rows/columns are dropped.
+	h = img.shape[0] // 2 * 2
+	w = img.shape[1] // 2 * 2
+	total = img[0:h:2, 0:w:2].astype(np.uint16)
+	total += img[1:h:2, 0:w:2]
+	total += img[0:h:2, 1:w:2]
+	total += img[1:h:2, 1:w:2]
+	total += 2
+	return (total >> 2).astype(np.uint8)
+
+def pyramid(img, smallest):
+	# Returns { 1: img, 2: img at 1/2 size, 4: ..., smallest: ... }.
+	levels = { 1: img }
+	scale = 1
+	while scale < smallest:
+		img = halve(img)
+		scale *= 2
+		levels[scale] = img
+	return levels
+
+def save_atomic(img, filename):
+	# Write under a temporary name then rename over the old file - readers see either the old image or the new one.
+	temp_file = os.path.join(os.path.dirname(filename), "." + os.path.basename(filename) + ".tmp")
+	Image.fromarray(img).save(temp_file, "JPEG", quality=QUALITY)
+	os.rename(temp_file, filename)
+
+def load_reduced(filename, scale):
+	# Opens a frame file at roughly 1/'scale' size.  For JPEGs, draft() has the decoder scale the image down as it
+	# goes, which is much quicker than a full decode.  Returns an array.
+	img = Image.open(filename)
+	size = (img.size[0] // scale, img.size[1] // scale)
+	if img.mode in ("RGB", "L"):
+		img.draft(img.mode, size)
+	if img.mode not in ("RGB", "L"):
+		img = Image.fromarray(to_8bit(np.asarray(img)))
+	if img.size != size:
+		img = img.resize(size, Image.BOX)
+	return np.asarray(img)
+
+def build(capture_dir, scales=SCALES):
+	# Makes previews for every frame in a capture folder that doesn't have them yet.  Returns the number of frames done.
+	capture_dir = os.path.join(capture_dir, "")
+	scales = sorted(scales)
+	for scale in scales:
+		if not os.path.exists(folder(capture_dir, scale)):
+			os.makedirs(folder(capture_dir, scale))
+	done = 0
+	for index, frame in night_frames(capture_dir, scales[0]):
+		if os.path.exists(os.path.join(folder(capture_dir, scales[-1]), frame_name(index))):
+			continue
+		levels = pyramid(frame, scales[-1] // scales[0])
+		for scale in scales:
+			save_atomic(levels[scale // scales[0]], os.path.join(folder(capture_dir, scale), frame_name(index)))
+		done += 1
+	return done
+
+def night_frames(capture_dir, scale):
+	# Yields (frame number, frame at 1/'scale' size) for each frame in a capture folder.  The numbers come from the
+	# manifest, as they did during capture, so rebuilt previews get the same names even if frames are missing.
+	rows = manifest.read(capture_dir)
+	if rows is None:										# Older nights, numbered in order by sort_files()
+		files = sorted(os.path.basename(x) for x in glob.glob(capture_dir + "*.jpg"))
+		files = [ x for x in files if not x.startswith(manifest.SUMMARY_PREFIXES) ]
+		rows = [ { "index": n + 1, "filename": x } for n, x in enumerate(files) ]
+	store = framestore.FrameStore(capture_dir) if framestore.exists(capture_dir) else None
+	for row in rows:
+		if framestore.is_locator(row["filename"]):
+			yield int(row["index"]), pyramid(to_8bit(store.frame(framestore.position(row["filename"], store.chunk_frames))), scale)[scale]
+		else:
+			yield int(row["index"]), load_reduced(os.path.join(capture_dir, row["filename"]), scale)
+
+if __name__ == "__main__":
+	if len(sys.argv) < 2:
+		sys.exit("Usage: preview.py capture_folder [...]")
+	for capture_dir in sys.argv[1:]:
+		print(capture_dir + ": " + str(build(capture_dir)) + " frames")
@@ -1,23 +1,225 @@
 # Pushover plugin for LightingSense
+#
+# sendPushoverAlert() just queues the alert and returns, so capture never waits on the network.  A background thread
+# sends the alerts over one persistent HTTPS connection to the Pushover API:
+#
+#	- Alerts raised within COALESCE_WINDOW seconds of each other are sent as a single message.
+#	- If the API can't be reached (or asks us to slow down) the alert is retried, waiting twice as long each time up
+#	  to MAX_RETRY_WAIT.  Alerts the API rejects outright (bad token, etc.) are dropped.
+#	- Alerts that haven't been delivered yet are kept in QUEUE_FILE, so they are sent after a restart.
+#
+# Tokens are read from 'pushover.json' in this folder the first time an alert is sent.  It can also set "api_host",
+# "api_port" and "use_https" (or call configure()) to point the plugin at a local stand-in for testing.
 
-import httplib, urllib, json
+import httplib, urllib, json, os, socket, threading, time, atexit
+from Queue import Queue, Empty
 
-with open('pushover.json', 'r') as f:
-	data = json.load(f)
+THIS_FOLDER = os.path.abspath(os.path.dirname(__file__))
+CONFIG_FILE = os.path.join(THIS_FOLDER, 'pushover.json')
+QUEUE_FILE = os.path.join(THIS_FOLDER, 'pushover_queue.json')	# Alerts still to be delivered
 
-PO_TOKEN = data['app_token']
-PO_USER = data['user_token']
+API_HOST = "api.pushover.net"
+API_PORT = 443
+API_PATH = "/1/messages.json"
+USE_HTTPS = True
+TIMEOUT = 15												# Seconds to wait on the API
+COALESCE_WINDOW = 5.0										# Alerts this close together are sent as one
+RETRY_WAIT = 5												# Seconds before the first retry - doubles each time
+MAX_RETRY_WAIT = 600
+MAX_QUEUED = 50												# Oldest undelivered alerts are dropped beyond this
 
-def sendPushoverAlert(title, message):
-	
-	conn = httplib.HTTPSConnection("api.pushover.net:443")
-	conn.request("POST", "/1/messages.json",
-	  urllib.urlencode({
-	    "token": PO_TOKEN,
-	    "user": PO_USER,
-	    "priority": -1,
-	    "message": message,
-	    "title": title
-	  }), { "Content-type": "application/x-www-form-urlencoded" })
-	conn.getresponse()
+PO_TOKEN = None
+PO_USER = None
 
+last_error = None
+_queue = Queue()
+_pending = []												# Alerts taken off the queue but not delivered yet
+_in_flight = 0												# Alerts sent or loaded but not yet delivered, dropped or saved
+_in_flight_lock = threading.Lock()
+_conn = None
+_thread = None
+_start_lock = threading.Lock()
+
+_STOP = object()
+
+def configure(host=None, port=None, https=None, queue_file=None, coalesce_window=None, retry_wait=None):
+	global API_HOST, API_PORT, USE_HTTPS, QUEUE_FILE, COALESCE_WINDOW, RETRY_WAIT
+	if host is not None: API_HOST = host
+	if port is not None: API_PORT = port
+	if https is not None: USE_HTTPS = https
+	if queue_file is not None: QUEUE_FILE = queue_file
+	if coalesce_window is not None: COALESCE_WINDOW = coalesce_window
+	if retry_wait is not None: RETRY_WAIT = retry_wait
+
+def load_config(config_file=None):
+	global PO_TOKEN, PO_USER, API_HOST, API_PORT, USE_HTTPS
+	with open(config_file or CONFIG_FILE, 'r') as f:
+		data = json.load(f)
+	PO_TOKEN = data['app_token']
+	PO_USER = data['user_token']
+	API_HOST = data.get('api_host', API_HOST)
+	API_PORT = data.get('api_port', API_PORT)
+	USE_HTTPS = data.get('use_https', USE_HTTPS)
+
+def sendPushoverAlert(title, message, priority=-1):
+	# Queue an alert.  Never blocks.
+	_start()
+	_count(1)
+	_queue.put({ "title": title, "message": message, "priority": priority, "time": int(time.time()) })
+
+def undelivered():
+	# Number of alerts queued, being sent or waiting to be retried.
+	return _in_flight
+
+def flush(timeout=30):
+	# Wait (up to 'timeout' seconds) for everything queued so far to be delivered.  Returns True if it was.
+	deadline = time.time() + timeout
+	while undelivered() > 0:
+		if time.time() > deadline:
+			return False
+		time.sleep(0.05)
+	return True
+
+def shutdown(timeout=5):
+	# Stop the background thread.  Anything not yet delivered is saved to QUEUE_FILE for next time.
+	global _thread
+	if _thread is not None and _thread.is_alive():
+		_queue.put(_STOP)
+		_thread.join(timeout)
+	_thread = None
+
+def _start():
+	global _thread
+	if _thread is not None:
+		return
+	with _start_lock:
+		if _thread is None:
+			t = threading.Thread(target=_run, name="pushover")
+			t.daemon = True
+			t.start()
+			_thread = t
+
+atexit.register(shutdown)
+
+def _count(n):
+	# Alerts coming in (n > 0) or done with (n < 0) - see undelivered().
+	global _in_flight
+	with _in_flight_lock:
+		_in_flight += n
+
+def _run():
+	saved = _load_queue()
+	_count(len(saved))
+	_pending.extend(saved)
+	retry_wait = RETRY_WAIT
+	next_attempt = 0
+	stopping = False
+	while not stopping:
+		# Wait for new alerts, or until it's time to retry the ones we have
+		timeout = max(0, next_attempt - time.time()) if _pending else None
+		batch, stopping = _collect(timeout)
+		if batch:
+			_pending.append(_coalesce(batch))
+			_count(1 - len(batch))								# Still in flight, but as one alert now
+			dropped = len(_pending) - MAX_QUEUED
+			if dropped > 0:
+				del _pending[:dropped]
+				_count(-dropped)
+			_save_queue()
+		if stopping or not _pending or time.time() < next_attempt:
+			continue
+
+		while _pending:
+			if not _deliver(_pending[0]):
+				next_attempt = time.time() + retry_wait
+				retry_wait = min(retry_wait * 2, MAX_RETRY_WAIT)
+				break
+			_pending.pop(0)
+			_count(-1)
+			retry_wait = RETRY_WAIT
+		_save_queue()
+	_save_queue()												# What's left goes out after a restart
+	_count(-len(_pending))
+	del _pending[:]
+
+def _collect(timeout):
+	# Gets the next alert plus any others that arrive within COALESCE_WINDOW of it.  Returns (alerts, stop requested).
+	batch = []
+	try:
+		item = _queue.get(timeout=timeout) if timeout is not None else _queue.get()
+	except Empty:
+		return batch, False
+	deadline = time.time() + COALESCE_WINDOW
+	while True:
+		if item is _STOP:
+			return batch, True
+		batch.append(item)
+		try:
+			item = _queue.get(timeout=max(0, deadline - time.time()))
+		except Empty:
+			return batch, False
+
+def _coalesce(batch):
+	if len(batch) == 1:
+		return batch[0]
+	return { "title": batch[0]["title"] + " (+" + str(len(batch) - 1) + " more)",
+			 "message": "\n\n".join(x["title"] + ": " + x["message"] for x in batch),
+			 "priority": max(x["priority"] for x in batch),
+			 "time": batch[0]["time"] }
+
+def _deliver(alert):
+	# Sends one alert.  Returns False if it should be retried later.
+	global _conn, last_error
+	try:
+		if PO_TOKEN is None:
+			load_config()
+	except (IOError, ValueError, KeyError) as e:
+		last_error = "Can't read Pushover settings: " + str(e)
+		return True											# No point retrying until the settings are fixed
+
+	body = urllib.urlencode({
+		"token": PO_TOKEN,
+		"user": PO_USER,
+		"priority": alert["priority"],
+		"message": alert["message"],
+		"title": alert["title"],
+		"timestamp": alert["time"] })
+	try:
+		if _conn is None:
+			if USE_HTTPS:
+				_conn = httplib.HTTPSConnection(API_HOST, API_PORT, timeout=TIMEOUT)
+			else:
+				_conn = httplib.HTTPConnection(API_HOST, API_PORT, timeout=TIMEOUT)
+		_conn.request("POST", API_PATH, body, { "Content-type": "application/x-www-form-urlencoded" })
+		response = _conn.getresponse()
+		response.read()										# Read the whole response so the connection can be reused
+	except (httplib.HTTPException, socket.error) as e:
+		if _conn is not None:
+			_conn.close()
+		_conn = None
+		last_error = str(e) or e.__class__.__name__
+		return False
+
+	if response.status == 429 or response.status >= 500:	# Over the rate limit or the API is having trouble
+		last_error = "Pushover API returned " + str(response.status)
+		return False
+	if response.status >= 400:
+		last_error = "Pushover API rejected alert (" + str(response.status) + "): " + alert["title"]
+	return True
+
+def _load_queue():
+	try:
+		with open(QUEUE_FILE, 'r') as f:
+			return json.load(f)
+	except (IOError, ValueError):
+		return []
+
+def _save_queue():
+	if not _pending:
+		if os.path.exists(QUEUE_FILE):
+			os.remove(QUEUE_FILE)
+		return
+	temp_file = QUEUE_FILE + ".tmp"
+	with open(temp_file, 'w') as f:
+		json.dump(_pending, f)
+	os.rename(temp_file, QUEUE_FILE)
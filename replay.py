@@ -0,0 +1,145 @@
+#!/usr/bin/python
+# Replays whole nights through sky_capture on a virtual clock - no camera, and no waiting for twilight.
+#
+# Runs the same loop as sky_capture.main() for a number of nights: wait for twilight, capture on the cadence, sort,
+# timelapse, star trails, upload, purge, then wait for the next sunset and go again.  The waiting is done on a
+# clock.VirtualClock, so the waits for twilight and sunset take no time and the night itself runs as fast as the
+# I/O allows (or 'speed' times faster than real time).  Frames come from a simulated camera, or are played back from
+# the capture folders of an archived night (one folder per camera).  Uploads go to a local folder.
+#
+# Settings come from settings.json, apart from the image folder (a scratch folder), the camera and the upload
+# destination, and whatever is given below.  Reports the wall time taken for each night, and what was left and
+# uploaded at the end.
+#
+# Example:	python replay.py --nights 3 --cadence 30
+#			python replay.py --nights 2 --archive /data/images/20240101 --speed 600 --output /tmp/replay
+
+import argparse, json, os, shutil, tempfile, time
+from collections import OrderedDict
+from datetime import datetime
+
+import sky_capture, skycam, skylog, simcam, clock, metrics
+
+def configure(args, base_dir):
+	# settings.json, pointed at a scratch folder and with the options under test.
+	sky_capture.load_settings()
+	sky_capture.BASEDIR = base_dir + "/images/"
+	sky_capture.DARKS_FOLDER = None
+	sky_capture.USE_PUSHOVER = False
+	sky_capture.METRICS_FILE = None
+	sky_capture.REMOTE_COMMAND = None
+	if args.no_upload:
+		sky_capture.REMOTE_SERVER = None
+	else:
+		sky_capture.REMOTE_SERVER = ""							# An empty server has the uploader copy to a local folder
+		sky_capture.REMOTE_PATH = base_dir + "/uploads"
+	if args.latitude is not None:
+		sky_capture.LATITUDE = args.latitude
+	if args.longitude is not None:
+		sky_capture.LONGITUDE = args.longitude
+	if args.cadence is not None:
+		sky_capture.CADENCE = args.cadence
+	if not args.speed and not sky_capture.CADENCE:
+		# Flat out, exposures take no time on the virtual clock, so back to back frames would never get to the end of
+		# the night.  Give them the slots they'd take instead.
+		sky_capture.CADENCE = sky_capture.EXPOSURE_TIME + sky_capture.WAIT_BETWEEN
+	if args.days_to_keep is not None:
+		sky_capture.DAYS_TO_KEEP = args.days_to_keep
+	if not os.path.exists(sky_capture.BASEDIR):
+		os.makedirs(sky_capture.BASEDIR)
+	skylog.configure(echo=args.verbose)
+
+def open_cameras(args):
+	# Puts the cameras in sky_capture.OPEN_CAMERAS, where start_capture() will find them.
+	time_scale = 1.0 / args.speed if args.speed else 0.0		# Exposures take as long as the virtual clock says
+	count = len(args.archive) if args.archive else args.cameras
+	sky_capture.CAMERAS = [ { "id": n, "name": "camera" + str(n) } for n in range(count) ] if count > 1 else []
+	for n in range(count):
+		if args.archive:
+			handle = simcam.ReplayCamera(args.archive[n], n, time_scale=time_scale)
+		else:
+			handle = simcam.SimulatedCamera(n, args.width, args.height, readout=0.0, time_scale=time_scale,
+											meteors=args.meteors, seed=n)
+		sky_capture.OPEN_CAMERAS[n] = skycam.Camera(handle, n, "camera" + str(n) if count > 1 else None)
+
+def folder_files(path):
+	count = 0
+	for root, dirs, files in os.walk(path):
+		count += len(files)
+	return count
+
+def run(args):
+	base_dir = args.output or tempfile.mkdtemp(prefix="skycam_replay_")
+	configure(args, base_dir)
+	open_cameras(args)
+
+	# Start at noon on the first day, so the first night is tonight's:
+	start = datetime.strptime(args.start, "%Y-%m-%d") if args.start else datetime.now()
+	virtual = clock.install(clock.VirtualClock(start.replace(hour=12, minute=0, second=0, microsecond=0), args.speed))
+
+	results = OrderedDict()
+	nights = OrderedDict()
+	wall_start = time.time()
+	try:
+		for n in range(args.nights):
+			night_start = time.time()
+			sky_capture.run(1)
+			nights[str(n + 1)] = round(time.time() - night_start, 3)
+	finally:
+		clock.install(clock.Clock())
+		skylog.close()
+
+	results["nights"] = args.nights
+	results["speed"] = args.speed
+	results["wall_time"] = round(time.time() - wall_start, 3)
+	results["night_wall_times"] = nights
+	results["virtual_end"] = virtual.now().replace(microsecond=0).isoformat()
+	results["folders_kept"] = sorted(x for x in os.listdir(sky_capture.BASEDIR) if os.path.isdir(sky_capture.BASEDIR + x))
+	if sky_capture.REMOTE_SERVER is not None:
+		results["files_uploaded"] = folder_files(sky_capture.REMOTE_PATH)
+	results["spans"] = OrderedDict((name, OrderedDict([ ("count", h["count"]), ("mean", h["mean"]), ("max", h["max"]) ]))
+								   for name, h in metrics.snapshot().items())
+
+	if not args.keep and not args.output:
+		shutil.rmtree(base_dir)
+	return results
+
+def main():
+	parser = argparse.ArgumentParser(description="Replay whole nights through the SkyCam loop on a virtual clock.")
+	parser.add_argument("--nights", type=int, default=1, help="number of nights to run")
+	parser.add_argument("--start", help="date of the first night, YYYY-MM-DD (default today)")
+	parser.add_argument("--speed", type=float, help="run this many times faster than real time - default is as fast as possible")
+	parser.add_argument("--archive", action="append", help="capture folder of an archived night to play back (once per camera)")
+	parser.add_argument("--cameras", type=int, default=1, help="number of simulated cameras, without --archive")
+	parser.add_argument("--width", type=int, default=1280, help="simulated frame width")
+	parser.add_argument("--height", type=int, default=960, help="simulated frame height")
+	parser.add_argument("--meteors", type=float, default=0.0, help="chance of a simulated meteor in each frame")
+	parser.add_argument("--cadence", type=float, help="seconds between frames (default from settings.json, or exposure + interval without --speed)")
+	parser.add_argument("--latitude", type=float)
+	parser.add_argument("--longitude", type=float)
+	parser.add_argument("--days-to-keep", type=int, help="purge nights older than this (default from settings.json)")
+	parser.add_argument("--no-upload", action="store_true", help="don't upload anything")
+	parser.add_argument("--output", help="folder to run in (kept afterwards) - default is a temporary folder")
+	parser.add_argument("--keep", action="store_true", help="don't delete the temporary folder")
+	parser.add_argument("--json", action="store_true", help="print results as JSON")
+	parser.add_argument("--verbose", action="store_true", help="echo log messages")
+	args = parser.parse_args()
+	if (len(args.archive or []) > 1 or args.cameras > 1) and not args.speed:
+		parser.error("several cameras share the virtual clock from their own threads - give a --speed")
+
+	results = run(args)
+	if args.json:
+		print(json.dumps(results, indent=4))
+		return
+	for key, value in results.items():
+		if key == "night_wall_times":
+			for night, seconds in value.items():
+				print("  night %-14s %10.3f s" % (night, seconds))
+		elif key == "spans":
+			for name, h in value.items():
+				print("  %-20s %6d x  mean %8.4f s  max %8.4f s" % (name, h["count"], h["mean"], h["max"]))
+		else:
+			print("%-22s %s" % (key, value))
+
+if __name__ == "__main__":
+	main()
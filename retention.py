@@ -0,0 +1,216 @@
+# Disk space management for the image folder.
+#
+# Keeps a running index of how much space each night folder takes up, rescanning a night only when its folder has
+# changed.  The index is kept in the archive index (see archive.py) if there is one, which also says which nights there
+# are, so the image folder isn't listed; otherwise in 'retention_index.json' in the image folder.  enforce() then
+# applies three limits:
+#
+#	- Nights older than 'days_to_keep' are deleted outright (the old purgeFolders rule).
+#	- The image folder shouldn't grow beyond 'max_bytes'.
+#	- The disk should always have at least 'min_free_bytes' free.
+#
+# To get back under the last two, the raw frames are pruned first and the nights' summary products (timelapse, star
+# trails, keogram, logs, previews, meteor crops) are kept for longer.  Nights that have been uploaded go before ones that haven't, oldest
+# first, and tonight's folder is never touched.  check() is cheap enough to call from the capture loop, so a run of
+# long nights can't fill the card part-way through a capture: rather than rescanning tonight's folder each time, it
+# keeps a running total of the frames add()ed as they're written, and only enforce() does a full scan.
+
+import os, json, shutil, threading
+from datetime import datetime, timedelta
+from scandir import scandir
+import manifest, uploader, preview, clock
+
+INDEX_FILE = "retention_index.json"
+NIGHT_FORMAT = "%Y%m%d"										# Night folders are named after the date capture started
+
+_lock = threading.Lock()									# Each camera's capture thread may be checking at once
+
+class Retention(object):
+
+	def __init__(self, base_dir, days_to_keep=None, max_bytes=None, min_free_bytes=None, uploads=True, archive=None):
+		# 'uploads'	=	Whether nights are uploaded at all.  If not, every night counts as uploaded.
+		# 'archive'	=	archive.ArchiveIndex for the image folder, or None to keep our own index
+		self.base_dir = base_dir
+		self.days_to_keep = days_to_keep
+		self.max_bytes = max_bytes
+		self.min_free_bytes = min_free_bytes
+		self.uploads = uploads
+		self.archive = archive
+		self.index_path = os.path.join(base_dir, INDEX_FILE)
+		self.scanned = False
+		if archive is not None:
+			self.index = archive.sizes()
+			return
+		try:
+			with open(self.index_path, 'r') as f:
+				self.index = json.load(f)
+		except (IOError, ValueError):
+			self.index = {}
+
+	def scan(self, tonight=None):
+		# Brings the index up to date.  Tonight's folder is always rescanned, since it's still growing.
+		nights = {}
+		if self.archive is not None:
+			for night in self.archive.nights():
+				path = os.path.join(self.base_dir, night)
+				if os.path.isdir(path):
+					nights[night] = os.stat(path).st_mtime
+				else:										# Gone behind our back
+					self.archive.set_state(night, "deleted")
+		else:
+			for entry in scandir(self.base_dir):
+				if entry.is_dir() and night_date(entry.name) is not None:
+					nights[entry.name] = entry.stat().st_mtime
+		for night in list(self.index):
+			if night not in nights:
+				del self.index[night]
+		for night, mtime in nights.items():
+			known = self.index.get(night)
+			if known is None or known["mtime"] != mtime or night == tonight:
+				self.index[night] = self.measure(night)
+				self.index[night]["mtime"] = mtime
+		self.save()
+		self.scanned = True
+		return self.index
+
+	def add(self, night, path):
+		# Counts a file just written to a night folder (e.g. tonight's latest frame) towards the total.
+		size = os.stat(path).st_blocks * 512
+		with _lock:
+			info = self.index.setdefault(night, { "raw_bytes": 0, "summary_bytes": 0, "uploaded": False, "mtime": None })
+			info["raw_bytes"] += size
+
+	def measure(self, night):
+		# Adds up the raw frames and summary products in a night folder (and its camera subfolders, if there were
+		# several cameras) and works out whether it's all been uploaded.
+		raw = summary = 0
+		not_uploaded = 0
+		for path in night_folders(os.path.join(self.base_dir, night)):
+			uploaded = set()
+			state_file = os.path.join(path, uploader.STATE_FILE)
+			if os.path.isfile(state_file):
+				with open(state_file, 'r') as f:
+					uploaded = set(line.strip() for line in f)
+			for entry in scandir(path):
+				if not entry.is_file():
+					continue
+				size = entry.stat().st_blocks * 512			# Space actually used - frame store chunks can be sparse
+				if manifest.is_summary(entry.name):
+					summary += size
+				else:
+					raw += size
+				if entry.name not in uploaded and entry.name not in manifest.LOCAL_ONLY:
+					not_uploaded += 1
+			summary += preview_bytes(path)
+		return { "raw_bytes": raw,
+				 "summary_bytes": summary,
+				 "uploaded": not self.uploads or not_uploaded == 0 }
+
+	def save(self):
+		if self.archive is not None:
+			self.archive.update_sizes(self.index)
+			return
+		temp_file = self.index_path + ".tmp"
+		with open(temp_file, 'w') as f:
+			json.dump(self.index, f, indent=4, sort_keys=True)
+		os.rename(temp_file, self.index_path)
+
+	def total_bytes(self):
+		return sum(x["raw_bytes"] + x["summary_bytes"] for x in self.index.values())
+
+	def free_bytes(self):
+		stats = os.statvfs(self.base_dir)
+		return stats.f_bavail * stats.f_frsize
+
+	def over_limit(self):
+		if self.max_bytes is not None and self.total_bytes() > self.max_bytes:
+			return True
+		return self.min_free_bytes is not None and self.free_bytes() < self.min_free_bytes
+
+	def check(self, tonight=None):
+		# Quick check for use during capture: only does anything if we're over the budget or the disk is getting full.
+		# Tonight's frames count towards the budget as they're add()ed, so the folders are only scanned the first time.
+		# Returns the actions taken.
+		with _lock:
+			if self.max_bytes is not None and not self.scanned:
+				self.scan(tonight)
+			if not self.over_limit():
+				return []
+		return self.enforce(tonight)
+
+	def enforce(self, tonight=None, today=None):
+		# Applies the limits.  Returns a list of (night, action, bytes freed).
+		with _lock:
+			return self._enforce(tonight, today)
+
+	def _enforce(self, tonight, today):
+		self.scan(tonight)
+		actions = []
+		if today is None:
+			today = clock.now()
+
+		if self.days_to_keep is not None:
+			cutoff = today - timedelta(days=self.days_to_keep)
+			for night in sorted(self.index):
+				if night != tonight and night_date(night) < cutoff:
+					actions.append(self.delete(night, "expired"))
+
+		# Raw frames before summary products; uploaded nights before ones that haven't been sent yet:
+		for whole in (False, True):
+			for uploaded in (True, False):
+				for night in sorted(self.index):
+					if not self.over_limit():
+						break
+					info = self.index[night]
+					if night == tonight or info["uploaded"] != uploaded:
+						continue
+					if not whole and info["raw_bytes"] > 0:
+						actions.append(self.prune(night))
+					elif whole:
+						actions.append(self.delete(night, "deleted" if uploaded else "deleted before upload"))
+
+		self.save()
+		return actions
+
+	def prune(self, night):
+		# Deletes a night's raw frames, keeping its summary products.
+		path = os.path.join(self.base_dir, night)
+		freed = 0
+		for folder in night_folders(path):
+			for entry in scandir(folder):
+				if entry.is_file() and not manifest.is_summary(entry.name):
+					freed += entry.stat().st_blocks * 512
+					os.remove(entry.path)
+			open(os.path.join(folder, manifest.SKIP_FILE), 'a').close()
+		info = self.index[night]
+		info["raw_bytes"] = 0
+		info["mtime"] = os.stat(path).st_mtime
+		if self.archive is not None:
+			self.archive.set_state(night, "pruned")
+		return (night, "raw frames removed" if info["uploaded"] else "raw frames removed before upload", freed)
+
+	def delete(self, night, action):
+		info = self.index.pop(night)
+		shutil.rmtree(os.path.join(self.base_dir, night), ignore_errors=True)
+		if self.archive is not None:
+			self.archive.set_state(night, "deleted")
+		return (night, action, info["raw_bytes"] + info["summary_bytes"])
+
+
+def night_date(name):
+	try:
+		return datetime.strptime(name, NIGHT_FORMAT)
+	except ValueError:
+		return None
+
+def night_folders(path):
+	# The night folder plus any camera subfolders in it.
+	return [ path ] + [ entry.path for entry in scandir(path) if entry.is_dir() and not preview.is_preview_folder(entry.name) ]
+
+def preview_bytes(path):
+	# Space taken by a capture folder's previews.  They count as summary products, so pruning leaves them alone.
+	total = 0
+	for folder in scandir(path):
+		if folder.is_dir() and preview.is_preview_folder(folder.name):
+			total += sum(entry.stat().st_blocks * 512 for entry in scandir(folder.path) if entry.is_file())
+	return total
@@ -0,0 +1,236 @@
+# Simulated ASI camera.
+#
+# SimulatedCamera stands in for zwoasi.Camera so that the capture and post-processing code can be run (and timed)
+# without a camera or the ASI library.  It renders a synthetic star field that turns slowly about the centre of the
+# frame, so star trails and keograms come out looking like the real thing, along with a fixed set of hot pixels for
+# dark calibration to take out.  Resolution, image type (bit depth) and
+# readout latency are configurable, and exposures can be run faster than real time with 'time_scale'.
+#
+# ReplayCamera does the same but plays back the frames of an archived night instead of drawing a sky (see replay.py).
+
+import zwoasi as asi
+import numpy as np
+import glob, os, time
+import framestore, manifest
+
+SIDEREAL_RATE = 2 * np.pi / 86164.1							# Sky rotation, radians per second
+NIGHT_SETTINGS = (5.0, 300)									# Exposure and gain that give the dark sky background
+
+class SimulatedCamera(object):
+
+	def __init__(self, id_=0, width=1920, height=1080, image_type=asi.ASI_IMG_RGB24, readout=0.05, time_scale=1.0,
+				 stars=2000, sky_speed=60.0, hot_pixels=0.0005, sky_level=1.0, meteors=0.0, seed=0):
+		# 'readout'	=	Seconds to "read out" each frame, on top of the exposure
+		# 'time_scale'	=	Multiplier on the exposure time we actually wait for - 0 to skip exposures entirely
+		# 'sky_speed'	=	How much faster than real time the sky turns between frames
+		# 'hot_pixels'	=	Fraction of pixels that are hot
+		# 'sky_level'	=	Sky brightness compared to a dark night (e.g. 1000 for twilight) - can be changed at any time
+		# 'meteors'	=	Chance of a meteor streaking across each frame
+		self.id = id_
+		self.width = width
+		self.height = height
+		self.image_type = image_type
+		self.readout = readout
+		self.time_scale = time_scale
+		self.sky_speed = sky_speed
+		self.sky_level = sky_level
+		self.meteors = meteors
+		self.meteor_frames = []									# Frames with a meteor in them
+		self.controls = { asi.ASI_GAIN: 0, asi.ASI_EXPOSURE: 100000, asi.ASI_GAMMA: 50, asi.ASI_WB_B: 90,
+						  asi.ASI_WB_R: 53, asi.ASI_FLIP: 0, asi.ASI_TEMPERATURE: 200 }
+		self.video = False
+		self.exposure_end = None
+		self.dark = False
+		self.frames = 0
+		self.started = time.time()
+
+		rng = np.random.RandomState(seed)
+		radius = np.hypot(width, height) / 2.0
+		self.star_r = radius * np.sqrt(rng.uniform(0, 1, stars))	# Evenly spread over the frame
+		self.star_theta = rng.uniform(0, 2 * np.pi, stars)
+		self.star_brightness = rng.pareto(2.0, stars).clip(0, 10) / 10.0	# Lots of faint stars, a few bright ones
+		hot = int(width * height * hot_pixels)
+		self.hot_x = rng.randint(0, width, hot)
+		self.hot_y = rng.randint(0, height, hot)
+		self.hot_level = rng.uniform(0.2, 1.0, hot)
+		self.rng = rng
+
+	def get_camera_property(self):
+		return { 'Name': 'Simulated ASI Camera', 'CameraID': self.id, 'MaxHeight': self.height, 'MaxWidth': self.width,
+				 'IsColorCam': True, 'BayerPattern': 0, 'SupportedBins': [1], 'SupportedVideoFormat': [0, 1, 2],
+				 'PixelSize': 2.9, 'BitDepth': 16 if self.image_type == asi.ASI_IMG_RAW16 else 8 }
+
+	def get_controls(self):
+		return {}
+
+	def set_control_value(self, control_type, value, auto=False):
+		self.controls[control_type] = value
+
+	def get_control_value(self, control_type):
+		return [ self.controls.get(control_type, 0), False ]
+
+	def set_image_type(self, image_type):
+		self.image_type = image_type
+
+	def get_image_type(self):
+		return self.image_type
+
+	def get_roi_format(self):
+		return [ self.width, self.height, 1, self.image_type ]
+
+	def start_exposure(self, is_dark=False):
+		self.dark = is_dark
+		self.exposure_end = time.time() + self.controls[asi.ASI_EXPOSURE] / 1e6 * self.time_scale
+
+	def stop_exposure(self):
+		self.exposure_end = None
+
+	def get_exposure_status(self):
+		if self.exposure_end is None:
+			return asi.ASI_EXP_IDLE
+		if time.time() < self.exposure_end:
+			return asi.ASI_EXP_WORKING
+		return asi.ASI_EXP_SUCCESS
+
+	def get_data_after_exposure(self, buffer_=None):
+		self.exposure_end = None
+		time.sleep(self.readout)
+		return bytearray(self._render_next().tostring())
+
+	def start_video_capture(self):
+		self.video = True
+		self.dark = False
+
+	def stop_video_capture(self):
+		self.video = False
+
+	def close(self):
+		pass
+
+	def capture(self, initial_sleep=0.01, poll=0.01, buffer_=None, filename=None):
+		img = self._expose()
+		if filename is not None:
+			self._save(img, filename)
+		return img
+
+	def capture_video_frame(self, buffer_=None, filename=None, timeout=None):
+		if not self.video:
+			raise asi.ZWO_Error('Video capture not started')
+		return self.capture(filename=filename)
+
+	def _expose(self):
+		exposure = self.controls[asi.ASI_EXPOSURE] / 1e6
+		time.sleep(exposure * self.time_scale + self.readout)
+		return self._render_next()
+
+	def _render_next(self):
+		self.frames += 1
+		return self.render(self.frames * self.controls[asi.ASI_EXPOSURE] / 1e6 * self.sky_speed, self.dark)
+
+	def render(self, t, dark=False):
+		# Draws the star field as it would appear 't' seconds into the night, in the camera's output format.  A dark
+		# frame just has the noise and hot pixels.
+		gain = 1.0 + self.controls[asi.ASI_GAIN] / 100.0
+		background = 0.02
+		if not dark:											# Sky background goes with exposure, gain and how bright the sky is
+			background = 0.06 * self.sky_level * (self.controls[asi.ASI_EXPOSURE] / 1e6 / NIGHT_SETTINGS[0] *
+												   10 ** ((self.controls[asi.ASI_GAIN] - NIGHT_SETTINGS[1]) / 200.0))
+		sky = self.rng.normal(background, 0.01, (self.height, self.width)).astype(np.float32)	# Background and noise
+		if not dark:
+			theta = self.star_theta + t * SIDEREAL_RATE
+			x = (self.width / 2.0 + self.star_r * np.cos(theta)).astype(np.int32)
+			y = (self.height / 2.0 + self.star_r * np.sin(theta)).astype(np.int32)
+			visible = (x >= 0) & (x < self.width) & (y >= 0) & (y < self.height)
+			sky[y[visible], x[visible]] += self.star_brightness[visible] * gain
+			if self.meteors and self.rng.uniform() < self.meteors:
+				self._draw_meteor(sky)
+		sky[self.hot_y, self.hot_x] += self.hot_level
+		sky = np.clip(sky, 0, 1)
+
+		if self.image_type == asi.ASI_IMG_RAW16:
+			return (sky * 65535).astype(np.uint16)
+		img = (sky * 255).astype(np.uint8)
+		if self.image_type == asi.ASI_IMG_RGB24:
+			img = np.dstack((img, img, img))					# Camera order is BGR, but the sky is grey anyway
+		return img
+
+	def _draw_meteor(self, sky):
+		# A streak 100-400 pixels long (less in small frames), 2 pixels wide, somewhere in the frame.
+		length = self.rng.uniform(100, 400) * min(1.0, min(self.width, self.height) / 1080.0)
+		angle = self.rng.uniform(0, np.pi)
+		x0 = self.rng.uniform(length, self.width - length)
+		y0 = self.rng.uniform(length / 2, self.height - length / 2)
+		steps = np.linspace(0, length, int(length))
+		x = (x0 + steps * np.cos(angle)).astype(np.int32)
+		y = (y0 + steps * np.sin(angle) * 0.5).astype(np.int32)
+		brightness = self.rng.uniform(0.3, 0.8)
+		sky[y, x] += brightness
+		sky[np.minimum(y + 1, self.height - 1), x] += brightness
+		self.meteor_frames.append(self.frames)
+
+	def _save(self, img, filename):
+		from PIL import Image
+		mode = None
+		if img.ndim == 3:
+			img = img[:, :, ::-1]							# Convert BGR to RGB, as zwoasi does
+		if self.image_type == asi.ASI_IMG_RAW16:
+			mode = 'I;16'
+		Image.fromarray(img, mode=mode).save(filename)
+
+
+class ReplayCamera(SimulatedCamera):
+	# Plays back the frames of a capture folder from an earlier night, in capture order, starting again from the first
+	# once they run out.  Frames come out at the archive's size and type, whatever image type is asked for.  Dark
+	# frames are drawn, as for SimulatedCamera.
+
+	def __init__(self, capture_dir, id_=0, readout=0.0, time_scale=1.0):
+		self.capture_dir = capture_dir
+		self.archive = archive_frames(capture_dir)
+		first = next(self.archive, None)
+		if first is None:
+			raise ValueError("No frames to replay in " + capture_dir)
+		if first.dtype.itemsize == 2:
+			image_type = asi.ASI_IMG_RAW16
+		elif first.ndim == 3:
+			image_type = asi.ASI_IMG_RGB24
+		else:
+			image_type = asi.ASI_IMG_RAW8
+		SimulatedCamera.__init__(self, id_, first.shape[1], first.shape[0], image_type, readout, time_scale, stars=0,
+								 hot_pixels=0)
+		self.archive = archive_frames(capture_dir)
+		self.replays = 0										# Times we've started again from the first frame
+
+	def set_image_type(self, image_type):
+		pass
+
+	def render(self, t, dark=False):
+		if dark:
+			return SimulatedCamera.render(self, t, True)
+		frame = next(self.archive, None)
+		if frame is None:
+			self.archive = archive_frames(self.capture_dir)
+			self.replays += 1
+			frame = next(self.archive)
+		if frame.ndim == 3:
+			frame = frame[:, :, ::-1]							# Back to camera order (BGR)
+		return np.ascontiguousarray(frame)
+
+
+def archive_frames(capture_dir):
+	# Yields each frame of a capture folder in capture order: from its frame store, the files in its manifest, or
+	# failing those the numbered frame files left by sort_files.
+	capture_dir = os.path.join(capture_dir, "")
+	if framestore.exists(capture_dir):
+		for frame in framestore.FrameStore(capture_dir):
+			yield frame
+		return
+	from PIL import Image
+	files = manifest.frame_files(capture_dir)
+	if files is None:
+		files = sorted(os.path.basename(x) for x in glob.glob(capture_dir + "[0-9]*.*"))
+		files = [ x for x in files if x.lower().endswith((".jpg", ".png", ".tif", ".tiff")) ]
+	for filename in files:
+		frame = np.asarray(Image.open(capture_dir + filename))
+		if frame.dtype.itemsize > 2:							# 16-bit PNGs read back as 32-bit ints
+			frame = frame.astype(np.uint16)
+		yield frame
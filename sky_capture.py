@@ -1,12 +1,28 @@
 import sunpos
 import skycam
-from clean_folders import *
+import framewriter
+import manifest
+import framestore
+import skylog
+import metrics
+import retention
+import calibration
+import preview
+import autoexposure
+import meteors
+import clock
+import archive
 from pushover import sendPushoverAlert
-import pause, pytz, os, sys, glob, json
+import pytz, os, sys, glob, json, threading, traceback
 from datetime import datetime, timedelta
 from math import ceil, log10
 from collections import OrderedDict
-from startrailer import star_trails
+from functools import partial
+from startrailer import star_trails, trail_videos, TrailStacker, DEFAULT_TRAIL_VIDEOS
+import timelapse
+from keogram import Keogram
+from cadence import Cadence
+from uploader import Uploader, SSH
 
 # Declare some global variables:
 # Variables to be loaded from settings file:
@@ -18,18 +34,61 @@ EXPOSURE_TIME = None
 GAIN = None
 GAMMA = None
 WAIT_BETWEEN = None
+CADENCE = None
 PHASE = None
 FILE_EXT = None
-CAMERA = None
+CAMERAS = []													# Optional list of cameras, each with its own settings (see camera_settings())
+OPEN_CAMERAS = {}
+SIMULATE_CAMERA = False
+IMAGE_TYPE = 1
+STORAGE_MODE = "files"
+AUTO_EXPOSURE = False
+AUTO_EXPOSURE_TARGET = autoexposure.TARGET
+AUTO_EXPOSURE_SUN = True
+MIN_EXPOSURE = 0.0001
+MAX_EXPOSURE = None												# None to go no higher than the exposure setting
+MIN_GAIN = 0
+MAX_GAIN = None													# None to go no higher than the gain setting
+DARK_CALIBRATION = False
+DARKS_FOLDER = None
 CREATE_TIMELAPSE = False
 TIMELAPSE_FPS = 25
+TIMELAPSE_RENDITIONS = None										# See timelapse.py - None for a single 1080p h264 video
+TIMELAPSE_SEGMENTS = None										# Parts of the timelapse to encode at once - None for one per core
+TIMELAPSE_JOBS = 1												# Nights tlapse.py builds at once - the cores are shared out between them
 CREATE_STARTRAILS = False
+CREATE_TRAIL_VIDEOS = False
+TRAIL_VIDEOS = None												# See startrailer.py - None for a video of the trails growing through the night
+CREATE_KEOGRAM = False
+KEOGRAM_CHECKPOINT = 50
+DETECT_METEORS = False
+METEOR_THRESHOLD = meteors.THRESHOLD
+ARCHIVE_INDEX = False											# Record each session and frame in the archive index (see archive.py)
+CREATE_PREVIEWS = False
+PREVIEW_SCALES = [ 2, 4, 8 ]
+PREVIEW_LATEST_SCALE = 2
 REMOTE_SERVER = None
 REMOTE_PATH = None
 REMOTE_COMMAND = None
 USE_PUSHOVER = None
 CLEAN_UP = True
 DAYS_TO_KEEP = 3
+MAX_STORAGE_GB = None
+MIN_FREE_GB = 1.0
+RETENTION_CHECK = 100											# Frames between disk space checks during capture
+PIPELINED = False
+WRITER_THREADS = 2
+WRITER_QUEUE = 4
+STARTRAILS_CHECKPOINT = 50
+STREAM_TIMELAPSE = False
+LOG_FORMAT = "text"
+LOG_FLUSH_INTERVAL = 2.0
+UPLOAD_DURING_CAPTURE = False
+UPLOAD_BATCH_SIZE = 50
+UPLOAD_BATCH_WAIT = 60
+UPLOADERS = {}												# Uploaders for frames sent during capture, by capture folder
+METRICS_FILE = None
+METRICS_PORT = None
 
 # Fixed variables:
 UTC = pytz.timezone('UTC')
@@ -41,70 +100,153 @@ ASTRO = 3
 def main():
 	global LOCALTZ, BASEDIR, LATITUDE, LONGITUDE, EXPOSURE_TIME, GAIN, GAMMA, WAIT_BETWEEN, PHASE, FILE_EXT
 	global CREATE_TIMELAPSE, TIMELAPSE_FPS,CREATE_STARTRAILS, REMOTE_SERVER, REMOTE_PATH, REMOTE_COMMAND, USE_PUSHOVER
-	global CLEAN_UP, DAYS_TO_KEEP
+	global CLEAN_UP, DAYS_TO_KEEP, PIPELINED, WRITER_THREADS, WRITER_QUEUE, STARTRAILS_CHECKPOINT, STREAM_TIMELAPSE
+	global UPLOAD_DURING_CAPTURE, UPLOAD_BATCH_SIZE, UPLOAD_BATCH_WAIT, CREATE_KEOGRAM, CADENCE, SIMULATE_CAMERA, CAMERAS
+	global METRICS_FILE, METRICS_PORT, IMAGE_TYPE, STORAGE_MODE, MAX_STORAGE_GB, MIN_FREE_GB, DARK_CALIBRATION, DARKS_FOLDER
+	global CREATE_PREVIEWS, PREVIEW_SCALES, PREVIEW_LATEST_SCALE, TIMELAPSE_RENDITIONS, TIMELAPSE_SEGMENTS, TIMELAPSE_JOBS
+	global AUTO_EXPOSURE, AUTO_EXPOSURE_TARGET, AUTO_EXPOSURE_SUN, MIN_EXPOSURE, MAX_EXPOSURE, MIN_GAIN, MAX_GAIN
+	global DETECT_METEORS, METEOR_THRESHOLD, CREATE_TRAIL_VIDEOS, TRAIL_VIDEOS, ARCHIVE_INDEX, KEOGRAM_CHECKPOINT
 
 	load_settings()
-
-	while True:
+	if METRICS_PORT:
+		metrics.serve(METRICS_PORT)								# Live timings for Prometheus, on localhost only
+	run()
+
+def run(nights=None):
+	# Captures and processes one night after another - forever, or for 'nights' nights (e.g. for a replay).
+	night = 0
+	while nights is None or night < nights:
+		night += 1
+		metrics.reset()
 		NIGHTDIR = start_capture()
-		[target_dir, padding] = sort_files(NIGHTDIR)
 		night_path = os.path.basename(os.path.normpath(NIGHTDIR))
-		
-		# If no remote server is set, then generate the timelapse on local machine and leave it here
-		if REMOTE_SERVER is None and CREATE_TIMELAPSE:				
-			timelapse = generate_timelapse(target_dir, TIMELAPSE_FPS)
-
-		# If remote server is set and we have no remote command, upload all files after generating timelapse (if we want one)
-		elif REMOTE_COMMAND is None:								
-			if CREATE_TIMELAPSE: timelapse = generate_timelapse(target_dir, TIMELAPSE_FPS)
-			os.system("rsync -aq " + NIGHTDIR + "/* " + REMOTE_SERVER + ":" + REMOTE_PATH + "/" + night_path)
-
-		# If remote server is set and we have a remote command, upload to server and generate timelapse on remote machine (if we want one)	
-		else:														
-			os.system("rsync -aq " + NIGHTDIR + "/* " + REMOTE_SERVER + ":" + REMOTE_PATH + "/" + night_path)
-			command = "ssh " + REMOTE_SERVER + " '" + REMOTE_COMMAND + " " + REMOTE_PATH + "/" + night_path +"' " + TIMELAPSE_FPS
-			if CREATE_TIMELAPSE: os.system(command)
-		
-
-		# Generate Star Trail image if desired and sync to remote server:
-		file_pattern = ""
-		if CREATE_STARTRAILS:
-			for i in range(padding):
-				file_pattern = file_pattern + "[0-9]"
-			file_pattern = file_pattern + ".jpg"
-			star_trails_file = "star_trails_" + night_path + ".jpg"
-
-			star_trails(NIGHTDIR, star_trails_file, "jpg", file_pattern)
-			if not REMOTE_SERVER is None:
-				os.system("rsync -aq " + NIGHTDIR + "/" + star_trails_file + " " + REMOTE_SERVER + ":" + REMOTE_PATH + "/" + night_path)
+		process_night(NIGHTDIR)
 
 		if USE_PUSHOVER:
 			title = "SkyCam Sequence Complete"
-			message = "Image capture is complete for " + night_path + " at " + datetime.now().strftime("%H:%M %d-%b-%Y")
+			message = "Image capture is complete for " + night_path + " at " + clock.now().strftime("%H:%M %d-%b-%Y")
 			if REMOTE_SERVER: message = message + "\nFiles have been uploaded to:" + REMOTE_SERVER + ":" + REMOTE_PATH + "/" + night_path
 			sendPushoverAlert(title, message)
 
 
-		# Purge subfolders older than specified numbers of days:
+		# Purge subfolders older than specified numbers of days, and make room if we're short of space:
 		if CLEAN_UP:
 			logdiv("=")
 			logmsg("Purging folders older than " + str(DAYS_TO_KEEP) + " days.")
-			purgeFolders(BASEDIR, DAYS_TO_KEEP)
+			with metrics.span("retention"):
+				clean_up(make_retention().enforce(night_path))	# Never tonight's, whatever days_to_keep says
 
+		# Save tonight's timings alongside capture_settings.json, and for the Prometheus textfile collector if wanted:
+		metrics.write_json(NIGHTDIR + "metrics.json")
+		if METRICS_FILE:
+			metrics.write_prometheus(METRICS_FILE)
 
-		# Pause for a while before starting another loop.
-		# Workaround for issue with sunrise / sunset calculation in sunpos that causes repeated loops if calculation is run before sunrise
-		next_sunset = LOCALTZ.localize(sunpos.next_sunset(LATITUDE, LONGITUDE))
+
+		# Pause until shortly before the next sunset before starting another loop.
+		# (sunpos used to evaluate its default date at import time, which caused repeated loops if this ran before sunrise.
+		#  Passing the current time explicitly keeps this safe either way.)
+		next_sunset = LOCALTZ.localize(sunpos.next_sunset(LATITUDE, LONGITUDE, clock.utcnow()))
 		logdiv("-")
 		logmsg("Run complete. Next sunset is at: " + str_local(next_sunset))
 		logmsg("Next run will set up at: " + str_local(next_sunset - timedelta(minutes=30)))
 		logdiv("-")
-		pause.until(next_sunset - timedelta(minutes=30))
+		for uploader in UPLOADERS.values():
+			uploader.close()
+		UPLOADERS.clear()
+		skylog.close()											# Flush everything and let go of tonight's log files
+		clock.until(next_sunset - timedelta(minutes=30))
+
+def process_night(night_dir):
+	# Builds and uploads the products for each of the night's capture folders - one per camera, or just the night
+	# folder with a single camera.  With several cameras the night folder's own log and settings go up last.
+	folders = capture_folders(night_dir)
+	for folder in folders:
+		process_folder(folder)
+	if REMOTE_SERVER is not None and folders != [ os.path.join(night_dir, "") ]:
+		upload_night(night_dir)
+
+def process_folder(NIGHTDIR):
+	# Builds and uploads the products for one capture folder: timelapse, star trail image and videos, and keogram.
+	with metrics.span("sort_files"):
+		[target_dir, padding] = sort_files(NIGHTDIR)
+	night_path = folder_label(NIGHTDIR)
+	
+	# Generate the timelapse here unless the remote server builds it (with the remote command)
+	# (A streamed timelapse will already be finished, in which case there's nothing to generate)
+	timelapse_done = all(os.path.exists(NIGHTDIR + x) for x in timelapse.output_names(TIMELAPSE_RENDITIONS))
+	if CREATE_TIMELAPSE and not timelapse_done and (REMOTE_SERVER is None or REMOTE_COMMAND is None):
+		with metrics.span("generate_timelapse"):
+			timelapse_file = generate_timelapse(target_dir, TIMELAPSE_FPS)
+
+
+	# Star trail videos, all made in one pass over the frames:
+	if CREATE_TRAIL_VIDEOS:
+		if not all(os.path.exists(NIGHTDIR + x) for x in timelapse.output_names(TRAIL_VIDEOS or DEFAULT_TRAIL_VIDEOS)):
+			with metrics.span("trail_videos"):
+				generate_trail_videos(target_dir, padding)
+
+	# Generate Star Trail image if desired and sync to remote server:
+	file_pattern = ""
+	if CREATE_STARTRAILS:
+		for i in range(padding):
+			file_pattern = file_pattern + "[0-9]"
+		file_pattern = file_pattern + ".jpg"
+		star_trails_file = "star_trails_" + night_path + ".jpg"
+
+		if not os.path.exists(NIGHTDIR + star_trails_file):		# Normally built during capture - only re-read the frames if that didn't happen
+			with metrics.span("star_trails"):
+				result = star_trails(NIGHTDIR, star_trails_file, "jpg", file_pattern)
+			logmsg("Star trails built from " + str(result["frames"]) + " frames in " + str(round(result["elapsed"], 1)) + " s")
+
+	# Upload everything in one go now it's all built (the keogram is built during capture), then have the remote
+	# server generate the timelapse if that's its job:
+	if not REMOTE_SERVER is None:
+		upload_night(NIGHTDIR)
+		if REMOTE_COMMAND is not None and CREATE_TIMELAPSE:
+			command = SSH + " " + REMOTE_SERVER + " '" + REMOTE_COMMAND + " " + REMOTE_PATH + "/" + relative_folder(NIGHTDIR) +"' " + str(TIMELAPSE_FPS)
+			with metrics.span("remote_command"):
+				os.system(command)
+
+def capture_folders(night_dir):
+	# The folders a night was captured into: a subfolder for each camera if there were several, otherwise just the
+	# night folder itself.
+	night_dir = os.path.join(night_dir, "")
+	cameras = [ night_dir + x + "/" for x in sorted(os.listdir(night_dir)) if manifest.exists(night_dir + x) ]
+	return cameras or [ night_dir ]
+
+def relative_folder(folder):
+	# A capture folder's path within the image folder: 'YYYYMMDD', or 'YYYYMMDD/name' for one of several cameras.
+	return os.path.relpath(os.path.normpath(folder), os.path.normpath(BASEDIR))
+
+def folder_label(folder):
+	# Used to name the summary products - 'YYYYMMDD' or 'YYYYMMDD_name'.
+	return relative_folder(folder).replace(os.sep, "_")
+
+def camera_settings():
+	# Settings for each camera.  Anything not given for a camera in the "cameras" list in settings.json is taken from
+	# the main settings.  With no list there's a single camera, capturing straight into the night folder.
+	cameras = []
+	for n, camera in enumerate(CAMERAS or [ {} ]):
+		cameras.append( {
+			"id": camera.get("id", n),
+			"name": camera.get("name", "camera" + str(n) if CAMERAS else None),
+			"exposure": camera.get("exposure", EXPOSURE_TIME),
+			"gain": camera.get("gain", GAIN),
+			"gamma": camera.get("gamma", GAMMA),
+			"interval": camera.get("interval", WAIT_BETWEEN),
+			"cadence": camera.get("cadence", CADENCE) } )
+	return cameras
 
 def load_settings():
 	global LOCALTZ, BASEDIR, LATITUDE, LONGITUDE, EXPOSURE_TIME, GAIN, GAMMA, WAIT_BETWEEN, PHASE, FILE_EXT
 	global CREATE_TIMELAPSE, TIMELAPSE_FPS, CREATE_STARTRAILS, REMOTE_SERVER, REMOTE_PATH, REMOTE_COMMAND, USE_PUSHOVER
-	global CLEAN_UP, DAYS_TO_KEEP
+	global CLEAN_UP, DAYS_TO_KEEP, PIPELINED, WRITER_THREADS, WRITER_QUEUE, STARTRAILS_CHECKPOINT, STREAM_TIMELAPSE
+	global LOG_FORMAT, LOG_FLUSH_INTERVAL
+	global UPLOAD_DURING_CAPTURE, UPLOAD_BATCH_SIZE, UPLOAD_BATCH_WAIT, CREATE_KEOGRAM, CADENCE, SIMULATE_CAMERA, CAMERAS
+	global METRICS_FILE, METRICS_PORT, IMAGE_TYPE, STORAGE_MODE, MAX_STORAGE_GB, MIN_FREE_GB, DARK_CALIBRATION, DARKS_FOLDER
+	global CREATE_PREVIEWS, PREVIEW_SCALES, PREVIEW_LATEST_SCALE, TIMELAPSE_RENDITIONS, TIMELAPSE_SEGMENTS, TIMELAPSE_JOBS
+	global AUTO_EXPOSURE, AUTO_EXPOSURE_TARGET, AUTO_EXPOSURE_SUN, MIN_EXPOSURE, MAX_EXPOSURE, MIN_GAIN, MAX_GAIN
+	global DETECT_METEORS, METEOR_THRESHOLD, CREATE_TRAIL_VIDEOS, TRAIL_VIDEOS, ARCHIVE_INDEX, KEOGRAM_CHECKPOINT
 
 	this_folder = os.path.abspath(os.path.dirname(__file__))
 	with open(this_folder + '/' + 'settings.json', 'r') as f:
@@ -118,18 +260,101 @@ def load_settings():
 	GAIN = data['camera_gain']
 	GAMMA = data['image_gamma']
 	WAIT_BETWEEN = data['interval']
+	CADENCE = data.get('cadence', CADENCE)
 	PHASE = data['twilight_phase']
 	FILE_EXT = data['file_type']
 	CREATE_TIMELAPSE = data['create_timelapse']
 	TIMELAPSE_FPS = data['timelapse_fps']
+	TIMELAPSE_RENDITIONS = data.get('timelapse_renditions', TIMELAPSE_RENDITIONS)
+	TIMELAPSE_SEGMENTS = data.get('timelapse_segments', TIMELAPSE_SEGMENTS)
+	TIMELAPSE_JOBS = data.get('timelapse_jobs', TIMELAPSE_JOBS)
 	CREATE_STARTRAILS = data['create_startrails']
+	CREATE_TRAIL_VIDEOS = data.get('create_trail_videos', CREATE_TRAIL_VIDEOS)
+	TRAIL_VIDEOS = data.get('trail_videos', TRAIL_VIDEOS)
+	CREATE_KEOGRAM = data.get('create_keogram', CREATE_KEOGRAM)
+	KEOGRAM_CHECKPOINT = data.get('keogram_checkpoint', KEOGRAM_CHECKPOINT)
+	DETECT_METEORS = data.get('detect_meteors', DETECT_METEORS)
+	METEOR_THRESHOLD = data.get('meteor_threshold', METEOR_THRESHOLD)
+	ARCHIVE_INDEX = data.get('archive_index', ARCHIVE_INDEX)
+	CREATE_PREVIEWS = data.get('create_previews', CREATE_PREVIEWS)
+	PREVIEW_SCALES = data.get('preview_scales', PREVIEW_SCALES)
+	PREVIEW_LATEST_SCALE = data.get('preview_latest_scale', PREVIEW_LATEST_SCALE)
 	REMOTE_SERVER = data['upload_server']
 	REMOTE_PATH = data['upload_path']
 	REMOTE_COMMAND = data['remote_command']
 	USE_PUSHOVER = data['use_pushover']
+	SIMULATE_CAMERA = data.get('simulate_camera', SIMULATE_CAMERA)
+	CAMERAS = data.get('cameras', CAMERAS)
+	IMAGE_TYPE = data.get('image_type', IMAGE_TYPE)
+	STORAGE_MODE = data.get('storage_mode', STORAGE_MODE)
+	AUTO_EXPOSURE = data.get('auto_exposure', AUTO_EXPOSURE)
+	AUTO_EXPOSURE_TARGET = data.get('auto_exposure_target', AUTO_EXPOSURE_TARGET)
+	AUTO_EXPOSURE_SUN = data.get('auto_exposure_sun', AUTO_EXPOSURE_SUN)
+	MIN_EXPOSURE = data.get('min_exposure', MIN_EXPOSURE)
+	MAX_EXPOSURE = data.get('max_exposure', MAX_EXPOSURE)
+	MIN_GAIN = data.get('min_gain', MIN_GAIN)
+	MAX_GAIN = data.get('max_gain', MAX_GAIN)
+	DARK_CALIBRATION = data.get('dark_calibration', DARK_CALIBRATION)
+	DARKS_FOLDER = data.get('darks_folder', DARKS_FOLDER)
+	METRICS_FILE = data.get('metrics_file', METRICS_FILE)
+	METRICS_PORT = data.get('metrics_port', METRICS_PORT)
 	CLEAN_UP = data['clean_up_folders']
 	DAYS_TO_KEEP = data['days_to_keep']
-
+	MAX_STORAGE_GB = data.get('max_storage_gb', MAX_STORAGE_GB)
+	MIN_FREE_GB = data.get('min_free_gb', MIN_FREE_GB)
+	PIPELINED = data.get('pipelined_capture', PIPELINED)
+	WRITER_THREADS = data.get('writer_threads', WRITER_THREADS)
+	WRITER_QUEUE = data.get('writer_queue', WRITER_QUEUE)
+	STARTRAILS_CHECKPOINT = data.get('startrails_checkpoint', STARTRAILS_CHECKPOINT)
+	STREAM_TIMELAPSE = data.get('stream_timelapse', STREAM_TIMELAPSE)
+	LOG_FORMAT = data.get('log_format', LOG_FORMAT)
+	LOG_FLUSH_INTERVAL = data.get('log_flush_interval', LOG_FLUSH_INTERVAL)
+	UPLOAD_DURING_CAPTURE = data.get('upload_during_capture', UPLOAD_DURING_CAPTURE)
+	UPLOAD_BATCH_SIZE = data.get('upload_batch_size', UPLOAD_BATCH_SIZE)
+	UPLOAD_BATCH_WAIT = data.get('upload_batch_wait', UPLOAD_BATCH_WAIT)
+
+	skylog.configure(json_lines=(LOG_FORMAT == "json"), flush_interval=LOG_FLUSH_INTERVAL)
+
+
+def darks_folder():
+	return DARKS_FOLDER or BASEDIR + "darks/"
+
+def make_retention():
+	gb = 1024 ** 3
+	return retention.Retention(BASEDIR, DAYS_TO_KEEP,
+							   MAX_STORAGE_GB * gb if MAX_STORAGE_GB else None,
+							   MIN_FREE_GB * gb if MIN_FREE_GB else None,
+							   uploads=REMOTE_SERVER is not None,
+							   archive=archive.open_index(BASEDIR) if ARCHIVE_INDEX else None)
+
+def clean_up(actions, logfile=None):
+	for night, action, freed in actions:
+		logmsg("Cleaned up " + night + ": " + action + " (" + str(round(freed / 1048576.0, 1)) + " MB)", logfile)
+
+def upload_night(night_dir):
+	# Sends whatever in the night folder hasn't been uploaded yet.  If frames were uploaded during capture, that's
+	# just the summary products.
+	uploader = UPLOADERS.get(os.path.normpath(night_dir))
+	if uploader is None:
+		uploader = Uploader(night_dir, REMOTE_SERVER, remote_parent(night_dir))
+	logmsg("Uploading to " + uploader.destination())
+	with metrics.span("upload"):
+		sent = uploader.finish()
+	logmsg("Uploaded " + str(sent) + " files (" + str(len(uploader.uploaded)) + " in total)")
+	if uploader.last_error:
+		logmsg("** Upload error: " + uploader.last_error)
+	if ARCHIVE_INDEX:
+		with metrics.span("archive"):
+			archive.open_index(BASEDIR).mark_uploaded(relative_folder(night_dir), uploader.uploaded)
+	return sent
+
+def remote_parent(folder):
+	# Where the uploader should put a capture folder: the remote path itself for a night folder, or the night's
+	# folder under it for one camera's subfolder.
+	parent = os.path.dirname(relative_folder(folder))
+	if parent:
+		return REMOTE_PATH.rstrip("/") + "/" + parent
+	return REMOTE_PATH
 
 def str_utc(time):
 	if time.tzinfo is None:
@@ -154,13 +379,16 @@ def name_local(time):
 def start_capture(PHASE=NAUTICAL):
 	# Make a note in the log that we're starting a new run:
 	logdiv("=")
-	logmsg("Starting new image run at: " + str_local(datetime.now()))	
+	logmsg("Starting new image run at: " + str_local(clock.now()))	
 
 	# Declare global variables
-	global WAIT_BETWEEN, EXPOSURE_TIME, GAIN, GAMMA, LATITUDE, LONGITUDE, CAMERA, USE_PUSHOVER
+	global WAIT_BETWEEN, EXPOSURE_TIME, GAIN, GAMMA, LATITUDE, LONGITUDE, OPEN_CAMERAS, USE_PUSHOVER
+	global PIPELINED, WRITER_THREADS, WRITER_QUEUE, CREATE_STARTRAILS, STARTRAILS_CHECKPOINT
+	global CREATE_TIMELAPSE, TIMELAPSE_FPS, STREAM_TIMELAPSE, REMOTE_SERVER, REMOTE_COMMAND
+	global REMOTE_PATH, UPLOAD_DURING_CAPTURE, UPLOAD_BATCH_SIZE, UPLOAD_BATCH_WAIT, CREATE_KEOGRAM, CADENCE
 
 	# Define a few key variables
-	[ START_TIME, END_TIME ] = sunpos.twilight_time(PHASE, LATITUDE, LONGITUDE, datetime.utcnow())		# When to start and finish taking images
+	[ START_TIME, END_TIME ] = sunpos.twilight_time(PHASE, LATITUDE, LONGITUDE, clock.utcnow())		# When to start and finish taking images
 	
 	while START_TIME is None:									# If sun is always up, fallback one twilight phase
 		logmsg("Selected twilight phase does not occur for this location / date.  Falling back to earlier twilight.")
@@ -170,7 +398,7 @@ def start_capture(PHASE=NAUTICAL):
 			logmsg('ERROR: sun always above horizon - cannot set start time.  Exiting')
 			logdiv('*')
 			raise RuntimeError('Error: sun always above horizon - cannot set start time.')
-		[ START_TIME, END_TIME ] = sunpos.twilight_time(PHASE, LATITUDE, LONGITUDE, datetime.utcnow())
+		[ START_TIME, END_TIME ] = sunpos.twilight_time(PHASE, LATITUDE, LONGITUDE, clock.utcnow())
 	
 	duration = END_TIME - START_TIME
 	duration_hours = duration.seconds // 3600
@@ -183,21 +411,35 @@ def start_capture(PHASE=NAUTICAL):
 
 	TONIGHT = START_TIME.strftime("%Y%m%d")						# Tonight's date
 	NIGHTDIR = BASEDIR + TONIGHT + "/"							# Base directory for images 
+	if ARCHIVE_INDEX:											# Pick up any nights copied into the image folder since the last run
+		added = archive.open_index(BASEDIR).import_nights()
+		if added:
+			logmsg("Added " + str(len(added)) + " nights to the archive index: " + ", ".join(added))
 	if not os.path.exists(NIGHTDIR):							# Make sure the directory exists, otherwise create it
 		os.makedirs(NIGHTDIR)
 	LOGFILE = NIGHTDIR + "capture_log_" + TONIGHT + ".log"		# Set up the logging for tonight
 
 	logmsg("Capturing images to folder: " + NIGHTDIR)
 	
-	# Initialize the camera:
-	if CAMERA is None:
-		CAMERA = skycam.initialize()
-	skycam.set_controls(GAIN, GAMMA)
+	# Initialize the cameras, each capturing into its own subfolder if there's more than one:
+	cameras = camera_settings()
+	sessions = []
+	for settings in cameras:
+		camera = OPEN_CAMERAS.get(settings["id"])
+		if camera is None:
+			camera = OPEN_CAMERAS[settings["id"]] = skycam.open_camera(settings["id"], SIMULATE_CAMERA, settings["name"])
+		camera.set_controls(settings["gain"], settings["gamma"], IMAGE_TYPE)
+		folder = NIGHTDIR + settings["name"] + "/" if settings["name"] else NIGHTDIR
+		if not os.path.exists(folder):
+			os.makedirs(folder)
+		sessions.append((settings, folder, folder + "capture_log_" + TONIGHT + ".log"))
 
 	# Wait until start of twilight and then start capturing images:
 	logdiv("-",LOGFILE)
-	logmsg("Exposure = " + str(EXPOSURE_TIME) + " | Gain = " + str(GAIN) + " | Gamma = " + str(GAMMA), LOGFILE)
-	logmsg("Current time is     :  " + str_local(datetime.now()), LOGFILE)
+	for settings, folder, logfile in sessions:
+		name = (settings["name"] + ": ") if settings["name"] else ""
+		logmsg(name + "Exposure = " + str(settings["exposure"]) + " | Gain = " + str(settings["gain"]) + " | Gamma = " + str(settings["gamma"]), LOGFILE)
+	logmsg("Current time is     :  " + str_local(clock.now()), LOGFILE)
 	logmsg("Waiting until       :  " + str_local(START_TIME), LOGFILE)
 	logmsg("Imaging will end at :  " + str_local(END_TIME), LOGFILE)
 	logmsg("Total Duration is   :  " + str(duration_hours) + " hours " + str(duration_minutes) + " minutes", LOGFILE)
@@ -208,67 +450,407 @@ def start_capture(PHASE=NAUTICAL):
 		message = "SkyCam is online and will begin capture at " + START_TIME.strftime("%H:%M %d-%b-%Y")
 		sendPushoverAlert(title, message)
 
-	pause.until(START_TIME)						
+	clock.until(START_TIME)						
 	
 	if USE_PUSHOVER:
 		title = "Starting Image Acquisition"
 		message = "SkyCam is capturing images.\n\nImage capture will finish at " + END_TIME.strftime("%H:%M %d-%b-%Y")
 		sendPushoverAlert(title, message)
 	
-	while datetime.now() < END_TIME:
-		now = datetime.now()
-		filename = name_local(now) + FILE_EXT
-		skycam.capture(long(EXPOSURE_TIME * 1e6), NIGHTDIR + filename) 
-		logmsg("Captured image: " + filename, LOGFILE)
-		pause.seconds(WAIT_BETWEEN)
-
-	logmsg("Finished capturing images", LOGFILE)
+	# Each camera captures in its own thread - back to back with 'interval' seconds between frames, or on a fixed
+	# cadence if it has one
+	runs = []
+	shared = make_retention() if CLEAN_UP else None				# One for all the cameras, so it sees all of tonight's frames
+	for settings, folder, logfile in sessions:
+		period = settings["cadence"] or None
+		shortest = period or settings["exposure"] + settings["interval"]	# For sizing things by the number of frames
+		session = CaptureSession(folder, logfile, duration.seconds / shortest + 1, OPEN_CAMERAS[settings["id"]],
+								 settings["exposure"], settings["gain"], shared)
+		thread = threading.Thread(target=run_session, args=(session, period, END_TIME, settings["interval"]),
+								  name="capture-" + str(settings["id"]))
+		thread.start()
+		runs.append((settings, session, thread))
+	for settings, session, thread in runs:
+		while thread.is_alive():								# (join() with a timeout so Ctrl-C still works)
+			thread.join(1)
 	logdiv("-",LOGFILE)
 	LOGFILE = None
 
-	data = OrderedDict( [
-		   	( "start", START_TIME ),
-			( "finish", END_TIME ),
-			( "exposure", EXPOSURE_TIME),
-			( "gain", GAIN ),
-			( "gamma", GAMMA ),
-			( "interval", WAIT_BETWEEN ),
-			( "latitude", LATITUDE ),
-			( "longitude", LONGITUDE ),
-			( "create_timelapse", CREATE_TIMELAPSE),
-			( "create_startrails", CREATE_STARTRAILS),
-			( "upload_server", REMOTE_SERVER),
-			( "upload_path", REMOTE_PATH),
-			( "remote_command", REMOTE_COMMAND),
-			( "clean_up_folders", CLEAN_UP),
-			( "days_to_keep", DAYS_TO_KEEP)  ],)
-	store_data(data, "capture_settings.json", NIGHTDIR)
+	for settings, session, thread in runs:
+		if session.error is not None:
+			raise session.error
+		timing = session.timing
+		data = OrderedDict( [
+			   	( "start", START_TIME ),
+				( "finish", END_TIME ),
+				( "camera", settings["name"] ),
+				( "camera_id", settings["id"] ),
+				( "exposure", settings["exposure"]),
+				( "gain", settings["gain"] ),
+				( "gamma", settings["gamma"] ),
+				( "interval", settings["interval"] ),
+				( "cadence", timing["period"] ),
+				( "mean_period", timing["mean_period"] ),
+				( "frames", timing["frames"] ),
+				( "missed_slots", timing["missed_slots"] ),
+				( "mean_jitter", timing["mean_jitter"] ),
+				( "max_jitter", timing["max_jitter"] ),
+				( "pipelined_capture", PIPELINED ),
+				( "image_type", IMAGE_TYPE ),
+				( "storage_mode", STORAGE_MODE ),
+				( "auto_exposure", AUTO_EXPOSURE ),
+				( "dark_calibration", DARK_CALIBRATION ),
+				( "latitude", LATITUDE ),
+				( "longitude", LONGITUDE ),
+				( "create_timelapse", CREATE_TIMELAPSE),
+				( "create_startrails", CREATE_STARTRAILS),
+				( "create_trail_videos", CREATE_TRAIL_VIDEOS),
+				( "create_keogram", CREATE_KEOGRAM),
+				( "create_previews", CREATE_PREVIEWS),
+				( "archive_index", ARCHIVE_INDEX),
+				( "detect_meteors", DETECT_METEORS),
+				( "upload_server", REMOTE_SERVER),
+				( "upload_path", REMOTE_PATH),
+				( "remote_command", REMOTE_COMMAND),
+				( "clean_up_folders", CLEAN_UP),
+				( "days_to_keep", DAYS_TO_KEEP),
+				( "max_storage_gb", MAX_STORAGE_GB),
+				( "min_free_gb", MIN_FREE_GB)  ],)
+		store_data(data, "capture_settings.json", session.night_dir)
+
+	if len(runs) > 1:											# Note the cameras in the night folder too
+		data = OrderedDict( [
+			   	( "start", START_TIME ),
+				( "finish", END_TIME ),
+				( "cameras", [ settings["name"] for settings in cameras ] ),
+				( "frames", sum(session.timing["frames"] for settings, session, thread in runs) ) ],)
+		store_data(data, "capture_settings.json", NIGHTDIR)
 
 	return NIGHTDIR
 
-def logmsg(message, filename=None):
+def run_session(session, period, end_time, interval=0):
+	# Captures frames until 'end_time' - on a fixed grid timed with a monotonic clock if there's a 'period', otherwise
+	# back to back 'interval' seconds apart - then finishes the session.  Runs in a thread of its own for each camera.
+	# The cadence stats end up in session.timing, or any error in session.error.
+	LOGFILE = session.logfile
+	try:
+		schedule = Cadence(period, (end_time - clock.now()).total_seconds(), interval)
+		if period:
+			logmsg("Capturing a frame every " + str(period) + " s", LOGFILE)
+		else:
+			logmsg("Capturing frames back to back, " + str(interval) + " s apart", LOGFILE)
+
+		while True:
+			missed = schedule.next()
+			if missed is None:
+				break
+			if missed and schedule.missed == missed:				# Just the first time - the rest are counted in the summary
+				logmsg("** Missed " + str(missed) + " frame slot(s) - capture is taking longer than the " + str(period) +
+					   " s cadence.  Further misses are only counted.", LOGFILE)
+			if period:
+				session.capture(clock.now(), jitter=round(schedule.jitter, 4))
+			else:
+				session.capture(clock.now())
+
+		session.timing = schedule.summary()
+		if period:
+			logmsg("Cadence: " + str(session.timing["frames"]) + " frames, " + str(session.timing["missed_slots"]) + " missed slots, jitter mean " + 
+				str(session.timing["mean_jitter"]) + " s / max " + str(session.timing["max_jitter"]) + " s", LOGFILE)
+		else:
+			logmsg("Cadence: " + str(session.timing["frames"]) + " frames, one every " + str(session.timing["mean_period"]) + " s on average", LOGFILE)
+		session.finish()
+		logdiv("-",LOGFILE)
+	except Exception as e:
+		logmsg("** Capture failed: " + traceback.format_exc(), LOGFILE)
+		session.error = e
+
+class CaptureSession(object):
+	# Everything that happens to each of tonight's frames once it comes off the camera: saving it, recording it in
+	# the manifest, and feeding the star trail stack, keogram, streamed timelapse and uploads.
+	#
+	# There's one session per camera.  'camera' defaults to skycam's default camera, and 'exposure' and 'gain' to
+	# the main settings.  'retention' is shared by the night's sessions, so it counts all their frames - one is made
+	# if it isn't given.
+
+	def __init__(self, night_dir, logfile, expected_frames=1000, camera=None, exposure=None, gain=None, retention=None):
+		self.night_dir = night_dir
+		self.tonight = relative_folder(night_dir).split(os.sep)[0]	# Tonight's folder in the image folder
+		self.label = folder_label(night_dir)
+		self.logfile = logfile
+		self.camera = camera if camera is not None else skycam.default
+		self.exposure = exposure if exposure is not None else EXPOSURE_TIME
+		self.gain = gain if gain is not None else GAIN
+		self.timing = None
+		self.error = None
+		self.frames = manifest.Manifest(night_dir)				# Frame list for tonight, picking up where we left off if capture was interrupted
+		if self.frames.count > 0:
+			logmsg("Resuming capture after frame " + str(self.frames.count), logfile)
+
+		self.stacker = None
+		if CREATE_STARTRAILS:									# Build the star trail image as we go rather than re-reading everything in the morning
+			self.stacker = TrailStacker(night_dir + "star_trails.npy")
+
+		self.keo = None
+		if CREATE_KEOGRAM:										# One column per frame, sized for the frames we expect tonight
+			self.keo = Keogram(expected_frames, night_dir + "keogram.npy")
+
+		self.stream = None
+		if CREATE_TIMELAPSE and STREAM_TIMELAPSE and (REMOTE_SERVER is None or REMOTE_COMMAND is None):
+			self.stream = timelapse.TimelapseStream(night_dir, TIMELAPSE_FPS, TIMELAPSE_RENDITIONS)	# Encode the timelapse as we go, unless it's built on the remote server
+			logmsg("Streaming timelapse to: " + self.stream.output, logfile)
+
+		self.previews = None
+		if CREATE_PREVIEWS:										# Small copies of each frame for viewers, and the newest one as latest.jpg
+			name, ext = os.path.splitext(preview.LATEST_FILE)
+			latest = BASEDIR + name + self.label[len(self.tonight):] + ext	# 'latest.jpg', or 'latest_name.jpg' for one of several cameras
+			self.previews = preview.PreviewMaker(night_dir, latest, PREVIEW_SCALES, PREVIEW_LATEST_SCALE)
+			logmsg("Publishing previews to: " + latest, logfile)
+
+		self.meteors = None
+		if DETECT_METEORS:										# Look for streaks in each frame as it comes in
+			self.meteors = meteors.MeteorDetector(night_dir, METEOR_THRESHOLD)
+			logmsg("Detecting meteors - events go to: " + night_dir + meteors.EVENTS_FILE, logfile)
+
+		self.uploader = None
+		if REMOTE_SERVER is not None and UPLOAD_DURING_CAPTURE:	# Send frames to the server as soon as they're written
+			self.uploader = Uploader(night_dir, REMOTE_SERVER, remote_parent(night_dir), UPLOAD_BATCH_SIZE, UPLOAD_BATCH_WAIT).start()
+			UPLOADERS[os.path.normpath(night_dir)] = self.uploader
+			logmsg("Uploading frames during capture to: " + self.uploader.destination(), logfile)
+
+		self.archive = None
+		if ARCHIVE_INDEX:										# A row for each frame in the archive index, written in the background
+			self.archive = archive.ArchiveWriter(archive.open_index(BASEDIR), relative_folder(night_dir), self.camera.name,
+												 self.exposure, self.gain)
+
+		self.retention = None
+		if CLEAN_UP:											# Keep an eye on disk space through the night
+			self.retention = retention or make_retention()
+
+		library = None
+		if DARK_CALIBRATION:
+			library = calibration.DarkLibrary(darks_folder())
+
+		self.auto = None
+		if AUTO_EXPOSURE:										# Follow the sky brightness through twilight and moonlight
+			steps = None
+			if library is not None:								# Only use settings there's a master dark for, so frames stay calibrated
+				steps = library.settings(self.camera.id, self.camera.temperature())
+			self.auto = autoexposure.AutoExposure(self.exposure, self.gain, MIN_EXPOSURE, MAX_EXPOSURE or self.exposure,
+												  MIN_GAIN, MAX_GAIN if MAX_GAIN is not None else self.gain, AUTO_EXPOSURE_TARGET,
+												  steps=steps)
+			logmsg("Auto exposure: " + str(self.auto.min_exposure) + " - " + str(self.auto.max_exposure) + " s, gain " +
+				   str(self.auto.min_gain) + " - " + str(self.auto.max_gain), logfile)
+			if self.auto.steps:
+				logmsg("Auto exposure keeps to the " + str(len(self.auto.steps)) + " exposure / gain settings with master darks", logfile)
+			elif steps is not None:
+				logmsg("** No master darks within the auto exposure range - frames won't be calibrated", logfile)
+			if self.auto.gain != self.gain:
+				self.camera.set_gain(self.auto.gain)
+			self.exposure, self.gain = self.auto.exposure, self.auto.gain
+
+		self.darks = None
+		self.dark_missing = None
+		if library is not None:									# Take out hot pixels and amp glow before anything else sees the frame
+			self.darks = calibration.DarkSubtractor(library, self.camera, self.exposure, self.gain)
+			self.darks.refresh()
+			self.log_darks()
+
+		self.store = None
+		self.writer = None
+		if STORAGE_MODE == "framestore":						# Keep the raw frames in a few large chunk files instead of a JPEG each
+			self.store = framestore.FrameStore(night_dir, on_chunk=self.written)
+			logmsg("Storing raw frames in: " + night_dir + framestore.CHUNK_PREFIX + "*.npy", logfile)
+		elif PIPELINED:											# Encode and write frames in the background while the next one is exposing
+			self.writer = framewriter.FrameWriter(WRITER_THREADS, WRITER_QUEUE, self.written)
+			logmsg("Pipelined capture with " + str(WRITER_THREADS) + " writer threads, queue depth " + str(WRITER_QUEUE), logfile)
+
+	def capture(self, now, **fields):
+		# Captures and processes one frame.  Any keyword arguments are added to the log entry.  Returns the frame.
+		LOGFILE = self.logfile
+		exposure = long(self.exposure * 1e6)
+		settings = (self.exposure, self.gain)					# Auto exposure changes these for the next frame
+		index = None
+		with metrics.span("frame"):
+			if self.store is None and self.darks is None and not PIPELINED:
+				filename = self.frames.next_filename(FILE_EXT)
+				frame = self.camera.capture(exposure, self.night_dir + filename) 
+				self.written(filename)
+			else:
+				if PIPELINED:
+					frame = self.camera.read_frame(exposure)
+				else:
+					frame = self.camera.capture(exposure, None)
+				if self.darks is not None:
+					with metrics.span("dark_subtract"):
+						frame = self.darks.apply(frame)
+					if self.darks.missing != self.dark_missing:		# Calibration stopped, or started again
+						self.log_darks()
+
+				if self.store is not None:
+					with metrics.span("frame_store"):
+						filename = self.store.append(frame)
+				elif PIPELINED:									# Goes in the manifest once the writer has saved it
+					filename = self.frames.next_filename(FILE_EXT)
+					index = self.frames.number()
+					saved = partial(self.frames.add, now, self.exposure, self.gain, filename, index)
+					with metrics.span("writer_queue"):
+						waited = self.writer.write(frame, self.night_dir + filename, saved)
+					if waited > 1:
+						logmsg("Writer queue full - waited " + str(round(waited, 1)) + " s for storage", LOGFILE)
+				else:
+					filename = self.frames.next_filename(FILE_EXT)
+					with metrics.span("encode_write"):
+						skycam.save_frame(frame, self.night_dir + filename)
+					self.written(filename)
+			if index is None:
+				with metrics.span("manifest"):
+					index = self.frames.add(now, self.exposure, self.gain, filename)
+			with metrics.span("log"):
+				logmsg("Captured image: " + filename, LOGFILE, frame=index, exposure=self.exposure, gain=self.gain, **fields)
+			if self.previews is not None:
+				with metrics.span("preview_queue"):
+					self.previews.add(frame, index)
+			if self.meteors is not None:
+				with metrics.span("meteor_queue"):
+					self.meteors.add(frame, index, now)
+			if self.stream is not None and not self.stream.failed:
+				with metrics.span("timelapse_stream"):
+					if not self.stream.write(frame):
+						logmsg("** Timelapse encoder failed: " + str(self.stream.error) + " - will build timelapse after capture", LOGFILE)
+			if self.stacker is not None:
+				with metrics.span("star_trails_stack"):
+					self.stacker.add(frame)
+					if self.stacker.count % STARTRAILS_CHECKPOINT == 0:
+						self.stacker.checkpoint()
+			if self.keo is not None:
+				with metrics.span("keogram"):
+					self.keo.add(frame)
+					if self.keo.count % KEOGRAM_CHECKPOINT == 0:
+						self.keo.checkpoint()
+			if self.retention is not None and index % RETENTION_CHECK == 0:
+				with metrics.span("retention_check"):
+					clean_up(self.retention.check(self.tonight), LOGFILE)
+			if self.auto is not None:
+				with metrics.span("auto_exposure"):
+					self.adjust_exposure(frame)
+			if self.archive is not None:
+				with metrics.span("archive_queue"):
+					level = self.auto.level if self.auto is not None else autoexposure.sky_level(frame)
+					self.archive.add(index, now, settings[0], settings[1], filename, level)
+		return frame
+
+	def written(self, filename):
+		# Called with each file once it's been saved (from the writer threads with pipelined capture): counts it
+		# towards tonight's disk use, and sends it to the server if we're uploading as we go.
+		name = os.path.basename(filename)
+		if self.retention is not None:
+			self.retention.add(self.tonight, self.night_dir + name)
+		if self.uploader is not None:
+			self.uploader.add(name)
+
+	def log_darks(self):
+		# Notes whether frames are being calibrated, at the start and whenever it changes.
+		if self.darks.missing:
+			logmsg("** No master dark for exposure " + str(self.darks.exposure) + " s, gain " + str(self.darks.gain) + " at " +
+				   str(self.darks.temperature) + " C - frames won't be calibrated", self.logfile)
+		else:
+			logmsg("Subtracting master dark for exposure " + str(self.darks.exposure) + " s, gain " + str(self.darks.gain), self.logfile)
+		self.dark_missing = self.darks.missing
+
+	def adjust_exposure(self, frame):
+		# Sets the exposure and gain for the next frame from the sky level in this one.
+		sun = sunpos.sun_angle(LATITUDE, LONGITUDE, clock.utcnow()) if AUTO_EXPOSURE_SUN else None
+		exposure, gain = self.auto.update(frame, sun)
+		if (exposure, gain) == (self.exposure, self.gain):
+			return
+		if gain != self.gain:
+			self.camera.set_gain(gain)
+		if self.darks is not None:
+			self.darks.set_exposure(exposure, gain)
+		logmsg("Auto exposure: sky level " + str(round(self.auto.level, 3)) + " - exposure " + str(round(exposure, 4)) +
+			   " s, gain " + str(gain) + " for the next frame", self.logfile, sky_level=self.auto.level)
+		self.exposure = exposure
+		self.gain = gain
+
+	def finish(self):
+		# Waits for background work to finish and writes out tonight's summary products.
+		LOGFILE = self.logfile
+		if self.store is not None:
+			self.store.close()
+			logmsg("Stored " + str(len(self.store)) + " raw frames in " + str(self.store.chunk_count()) + " chunks", LOGFILE)
+		if PIPELINED:
+			self.camera.stop_stream()
+		if self.writer is not None:
+			stats = self.writer.stop()
+			logmsg("Frame writer finished: " + str(stats.processed) + " written, " + str(stats.errors) + " failed, " + 
+				str(round(stats.blocked, 1)) + " s waiting on storage, max queue depth " + str(stats.max_depth), LOGFILE)
+			for failed_file, error in self.writer.failed:
+				logmsg("** Could not write " + failed_file + ": " + error, LOGFILE)
+
+		if self.previews is not None:
+			stats = self.previews.stop()
+			logmsg("Previews made for " + str(stats.processed) + " frames, " + str(self.previews.skipped) + " skipped to keep up with capture", LOGFILE)
+			for index, error in self.previews.failed:
+				logmsg("** Could not make previews for frame " + str(index) + ": " + error, LOGFILE)
+
+		if self.meteors is not None:
+			stats = self.meteors.stop()
+			logmsg("Meteor detection: " + str(stats["events"]) + " events in " + str(stats["checked"]) + " frames checked, " +
+				   str(stats["skipped"]) + " skipped to keep up, " + str(stats["crowded"]) + " too busy to search", LOGFILE)
+			logmsg("Meteor detection took " + str(stats["mean_ms"]) + " ms per frame on average, " + str(stats["max_ms"]) + " ms at most (" +
+				   str(stats["over_budget"]) + " over the " + str(stats["budget_ms"]) + " ms budget), using " + str(stats["memory_mb"]) + " MB", LOGFILE)
+			for index, error in self.meteors.failed:
+				logmsg("** Meteor detection failed on frame " + str(index) + ": " + error, LOGFILE)
+
+		if self.archive is not None:
+			stats = self.archive.stop()
+			logmsg("Archive index: " + str(stats.processed) + " frames recorded, " + str(stats.errors) + " failed", LOGFILE)
+			for index, error in self.archive.failed:
+				logmsg("** Could not record frame " + str(index) + " in the archive index: " + error, LOGFILE)
+
+		self.frames.close()
+		if self.uploader is not None:
+			self.uploader.flush()
+			logmsg("Uploaded " + str(len(self.uploader.uploaded)) + " frames during capture, " + str(len(self.uploader.pending)) + " still to send", LOGFILE)
+		logmsg("Finished capturing images", LOGFILE)
+		if self.stream is not None:
+			if self.stream.close():
+				logmsg("Timelapse saved to: " + self.stream.output + " (" + str(self.stream.frames) + " frames)", LOGFILE)
+			else:
+				logmsg("** Streamed timelapse failed: " + str(self.stream.error) + " - falling back to batch encoding", LOGFILE)
+		if self.stacker is not None:
+			star_trails_file = self.stacker.save(self.night_dir + "star_trails_" + self.label + ".jpg")
+			logmsg("Star trails saved to: " + str(star_trails_file) + " (" + str(self.stacker.count) + " frames)", LOGFILE)
+		if self.keo is not None:
+			keogram_file = self.keo.save(self.night_dir + "keogram_" + self.label + ".jpg")
+			logmsg("Keogram saved to: " + str(keogram_file) + " (" + str(self.keo.count) + " frames)", LOGFILE)
+
+def logmsg(message, filename=None, **fields):
+	# Messages are written by a background thread (see skylog) so this never waits on disk.
+	# Any keyword arguments are added as fields when logging in JSON-lines format.
 	if filename is None:
 		filename = BASEDIR + "skycam.log"
-	if os.path.isfile(filename):
-		f = open(filename, 'a')
-	else:
-		f = open(filename, 'w')
-	print message
-	f.write( message + "\n")
-	f.close()
+	skylog.write(message, filename, **fields)
 
 def logdiv(char="-", log=None, N=70):
-	line = ''
-	for n in range(N):
-		line = line + char
-	logmsg(line,log)
+	logmsg(char * N, log)
 
 def sort_files(target_dir):
 	# Sorts files by timestamp.  Oldest to newest.
 	#
 	# Files will be renamed to format '0001.jpg', '0002.jpg', etc.
+	#
+	# Nights captured with a manifest are already numbered in capture order, so all we do for those is record the
+	# file info - no globbing, stat'ing or renaming.
 	global FILE_EXT
 
+	if manifest.exists(target_dir):
+		filecount = len(manifest.frame_files(target_dir))
+		data = { "image_count": filecount,
+				 "padding": manifest.FRAME_PADDING }
+		store_data(data, "file_info.json", target_dir)
+		return target_dir, manifest.FRAME_PADDING
+
 	MIN_PADDING = 4										# Minimum number of characters in file name
 	starting_dir = os.getcwd()							# Make a note of where we started, so we can get back
 	os.chdir(target_dir)								# Change to the target directory
@@ -276,6 +858,7 @@ def sort_files(target_dir):
 	LOGFILE = glob.glob("capture_log_*.log")[0]			# Get the name of the nightly log file so we can append to it
 
 	files = glob.glob('*' + FILE_EXT)					# Get a list of image files
+	files = [x for x in files if not x.startswith(manifest.SUMMARY_PREFIXES)]	# Don't number the summary images along with the frames
 	files.sort(key=lambda x: os.path.getmtime(x))		# Sort them by timestamp
 	filecount = len(files)								# Find out how many files we have
 
@@ -303,37 +886,65 @@ def sort_files(target_dir):
 	
 	return target_dir, padding
 
-def generate_timelapse(target_dir, rate=TIMELAPSE_FPS, extension=FILE_EXT ):
-
-	starting_dir = os.getcwd()
-	os.chdir(target_dir)								# Switch to the target directory
-	LOGFILE = glob.glob("capture_log_*.log")[0]			# Get the name of the nightly log file so we can append to it
-
-	data = read_data('file_info.json', target_dir)
-	padding = data['padding']
+def generate_timelapse(target_dir, rate=None, extension=None):
+	# Builds the timelapse renditions from the frames in 'target_dir'.  Returns the file name of the first one, or
+	# None if ffmpeg failed.
+	#
+	# The frames are encoded in several segments at once and then joined (see timelapse.encode).  ffmpeg is run in
+	# the target directory rather than changing the working directory of the whole process, so several of these can
+	# run at once (see tlapse.build_timelapses).
+	if rate is None:
+		rate = TIMELAPSE_FPS
+	if extension is None:
+		extension = FILE_EXT or ".jpg"
+	target_dir = os.path.join(target_dir, "")
+
+	logs = glob.glob(target_dir + "capture_log_*.log")		# Get the name of the nightly log file so we can append to it
+	LOGFILE = logs[0] if logs else None
 
 	logdiv("-",LOGFILE)
 	logmsg("Starting timelapse    : " + target_dir, LOGFILE)
-	
-	
-	i = ' -i ' + "%0" + str(padding) + "d" + extension
-	r = ' -r ' + str(rate)
-	f = ' -s hd1080 -vf format=rgb24 -vcodec h264'
-	o = ' timelapse.mp4'
-	cmd = 'ffmpeg' + r + i + f + o
-	logmsg("Running system command: " + cmd, LOGFILE)
-	
-	if os.path.exists(o.strip()):
-		logmsg("** Removing existing file: " + o.strip(), LOGFILE)
-		os.remove(o.strip())
-	os.system(cmd)
+
+	if framestore.exists(target_dir):					# Raw frames - pipe them straight into ffmpeg, no JPEGs needed
+		frames = timelapse.StoreFrames(framestore.FrameStore(target_dir), rate)
+	elif manifest.exists(target_dir):					# Take the frame order from the manifest
+		frames = timelapse.FileFrames(target_dir, manifest.frame_files(target_dir), rate)
+	else:												# Frames numbered by sort_files
+		data = read_data('file_info.json', target_dir)
+		name = '{:0' + str(data['padding']) + 'd}' + extension
+		frames = timelapse.FileFrames(target_dir, [ name.format(n) for n in range(1, data['image_count'] + 1) ], rate)
+
+	outputs = timelapse.output_names(TIMELAPSE_RENDITIONS)
+	logmsg("Encoding " + ", ".join(outputs) + " from " + str(len(frames)) + " frames", LOGFILE)
+	try:
+		timelapse.encode(target_dir, frames, rate, TIMELAPSE_RENDITIONS, TIMELAPSE_SEGMENTS)
+	except (RuntimeError, ValueError, IOError, OSError) as e:
+		logmsg("** Timelapse generation failed: " + str(e), LOGFILE)
+		logdiv("-",LOGFILE)
+		return None
 	logmsg("Timelapse generation complete", LOGFILE)
 	logdiv("-",LOGFILE)
-	
-	logmsg("Timelapse generation complete: " + target_dir + o.strip())
-	
-	os.chdir(starting_dir)
-	return o.strip()
+
+	logmsg("Timelapse generation complete: " + target_dir + outputs[0])
+
+	return outputs[0]
+
+def generate_trail_videos(target_dir, padding, rate=None):
+	# Builds the star trail videos from the frames in 'target_dir'.  Returns the file names, or None if ffmpeg failed.
+	if rate is None:
+		rate = TIMELAPSE_FPS
+	target_dir = os.path.join(target_dir, "")
+	logs = glob.glob(target_dir + "capture_log_*.log")
+	LOGFILE = logs[0] if logs else None
+
+	logmsg("Making star trail videos: " + ", ".join(timelapse.output_names(TRAIL_VIDEOS or DEFAULT_TRAIL_VIDEOS)), LOGFILE)
+	try:
+		result = trail_videos(target_dir, TRAIL_VIDEOS, rate, (FILE_EXT or ".jpg").strip("."), "[0-9]" * padding)
+	except (RuntimeError, ValueError, IOError, OSError) as e:
+		logmsg("** Star trail videos failed: " + str(e), LOGFILE)
+		return None
+	logmsg("Star trail videos made from " + str(result["frames"]) + " frames in " + str(round(result["elapsed"], 1)) + " s", LOGFILE)
+	return result["outputs"]
 
 def datetime_handler(x):
     if isinstance(x, datetime):
@@ -353,6 +964,8 @@ def store_data(data, filename="data.json", target_dir = None):
 	f = open(datafile, 'w')
 	json.dump(OrderedDict(data), f, indent=4, default=datetime_handler)
 	f.close()	
+	if ARCHIVE_INDEX and os.path.abspath(target_dir).startswith(os.path.join(os.path.abspath(BASEDIR), "")):	# Capture folders go in the archive index too
+		archive.open_index(BASEDIR).record(relative_folder(target_dir), filename, data)
 	
 def read_data(filename="data.json", target_dir = None):
 	# Reads variables in a json encoded file and returns a data dictionary.
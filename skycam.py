@@ -1,75 +1,195 @@
 import zwoasi as asi
+import numpy as np
+import sys, time
+import metrics
+from PIL import Image
 
-camera = None
+ASI_LIBRARY = "/usr/local/lib/libASICamera2.so"				# Hard coded library location as fallback
 
-def initialize():
-	# Initialize the ASI camera library and confirm we have at least one ASI camera connected:
-	# 
-	# Note that this application will always pick the first camera - fine for me because I will only have one camera connected but could be an issue if that is not the case for you.  If you need support for more than one ASI camera, edit the code below accordingly.
+camera = None												# zwoasi handle of the default camera (see initialize())
+default = None												# Default Camera, used by the module-level functions below
+_library_loaded = False
 
-	global camera
+class Camera(object):
+	# One ASI camera (or a simulated one).  Each Camera keeps its own state, so several can be driven at once from
+	# different threads.
 
-	# Hard coded library location as fallback:
-	#TODO: Generalize this so that library does not need to be hard coded
-	ASI_LIBRARY="/usr/local/lib/libASICamera2.so"
-	asi.init(ASI_LIBRARY)
+	def __init__(self, handle, camera_id=0, name=None):
+		self.camera = handle
+		self.id = camera_id
+		self.name = name
+		self.streaming = False								# True while the camera is in video mode for pipelined capture
+		self.stream_exposure = None
+
+	def set_controls(self, gain=50, gamma=50, image_type=1, wbb=90, wbr=53, flip=0):
+		camera = self.camera
+		camera.set_control_value(asi.ASI_GAIN, gain)
+		camera.set_control_value(asi.ASI_GAMMA, gamma)
+		camera.set_control_value(asi.ASI_WB_B, wbb)
+		camera.set_control_value(asi.ASI_WB_R, wbr)
+		camera.set_control_value(asi.ASI_FLIP, flip)
+
+		if image_type==0:
+		    image_type=asi.ASI_IMG_RAW8
+		    msg = "8-bit Mono"
+		elif image_type==1:
+		    image_type=asi.ASI_IMG_RGB24
+		    msg = "24-bit Colour"
+		elif image_type==2:
+		    image_type=asi.ASI_IMG_RAW16
+		    msg = "16-bit Mono"
+		else:
+		    print('Invalid image format specified')
+		    sys.exit(1)
+		camera.set_image_type(image_type)
+
+	def set_gain(self, gain):
+		# For auto exposure - changes the gain between frames without touching the other controls.
+		self.camera.set_control_value(asi.ASI_GAIN, gain)
+
+	def capture(self, exp=500000, filename="image.jpg", dark=False):
+		# 'dark' asks the camera for a dark frame - only cameras with a shutter can close it, so cover the lens too.
+		camera = self.camera
+
+		with metrics.span("set_exposure"):
+			camera.set_control_value(asi.ASI_EXPOSURE, exp)
+
+		# Stop any current exposures / video captures:
+		with metrics.span("stop_exposure"):
+			self.stop_stream()
+
+		# This does the same as camera.capture(), but split up so that each stage can be timed separately:
+		with metrics.span("exposure"):
+			camera.start_exposure(dark)
+			time.sleep(0.01)
+			while camera.get_exposure_status() == asi.ASI_EXP_WORKING:
+				time.sleep(0.01)
+		status = camera.get_exposure_status()
+		if status != asi.ASI_EXP_SUCCESS:
+			raise asi.ZWO_CaptureError('Could not capture image', status)
+
+		with metrics.span("readout"):
+			img = rgb(self.to_array(camera.get_data_after_exposure()))
+
+		if filename is not None:
+			with metrics.span("encode_write"):
+				save_frame(img, filename)
+		return img
+
+	def read_frame(self, exp=500000):
+		# Pipelined capture:  returns the next frame as a numpy array without encoding or saving it.
+		#
+		# The camera is left running in video mode, so it starts on the next exposure while we're still dealing with
+		# this one.  Use save_frame() (usually from a background thread) to write the frame out.
+		if not self.streaming or exp != self.stream_exposure:
+			self.stop_stream()
+			self.camera.set_control_value(asi.ASI_EXPOSURE, exp)
+			self.camera.start_video_capture()
+			self.streaming = True
+			self.stream_exposure = exp
+
+		# The SDK suggests a timeout of twice the exposure plus 500 ms (in milliseconds)
+		timeout = int(2 * exp / 1000 + 500)
+		with metrics.span("read_frame"):
+			img = self.camera.capture_video_frame(timeout=timeout)
+		return rgb(img)
+
+	def stop_stream(self):
+		# Take the camera out of video mode, if it's in it.
+		try:
+		    # Force any single exposure to be halted
+		    self.camera.stop_video_capture()
+		    self.camera.stop_exposure()
+		except (KeyboardInterrupt, SystemExit):
+		    raise
+		except:
+		    pass
+		self.streaming = False
+		self.stream_exposure = None
+
+	def temperature(self):
+		# Sensor temperature in degrees C.
+		return self.camera.get_control_value(asi.ASI_TEMPERATURE)[0] / 10.0
+
+	def to_array(self, data):
+		# Turns a raw buffer from the camera into a numpy array of the right shape and type for the current ROI format.
+		whbi = self.camera.get_roi_format()
+		shape = [whbi[1], whbi[0]]
+		if whbi[3] == asi.ASI_IMG_RAW8 or whbi[3] == asi.ASI_IMG_Y8:
+			img = np.frombuffer(data, dtype=np.uint8)
+		elif whbi[3] == asi.ASI_IMG_RAW16:
+			img = np.frombuffer(data, dtype=np.uint16)
+		elif whbi[3] == asi.ASI_IMG_RGB24:
+			img = np.frombuffer(data, dtype=np.uint8)
+			shape.append(3)
+		else:
+			raise ValueError('Unsupported image type')
+		return img.reshape(shape)
+
+def open_camera(camera_id=0, simulate=False, name=None, **options):
+	# Opens camera number 'camera_id' (in the order the ASI library lists them).  With simulate=True a simulated
+	# camera is used instead (see simcam) - any other keyword arguments are passed to it.
+	global _library_loaded
+
+	if simulate:
+		import simcam
+		options.setdefault('seed', camera_id)					# Give each simulated camera its own sky
+		print('Using simulated camera %d' % camera_id)
+		return Camera(simcam.SimulatedCamera(camera_id, **options), camera_id, name)
+
+	if not _library_loaded:
+		#TODO: Generalize this so that library does not need to be hard coded
+		asi.init(ASI_LIBRARY)
+		_library_loaded = True
 
 	num_cameras = asi.get_num_cameras()
 	if num_cameras == 0:
 		print('No cameras found')
 		sys.exit(0)
-	else:
-		cameras_found = asi.list_cameras()
-		print('Found %d cameras' % num_cameras)
-		for n in range(num_cameras):
-			print('    %d: %s' % (n, cameras_found[n]))
-		camera_id = 0
-		print('Using #%d: %s' % (camera_id, cameras_found[camera_id]))
+	cameras_found = asi.list_cameras()
+	print('Found %d cameras' % num_cameras)
+	for n in range(num_cameras):
+		print('    %d: %s' % (n, cameras_found[n]))
+	if camera_id >= num_cameras:
+		raise ValueError('Camera %d not found' % camera_id)
+	print('Using #%d: %s' % (camera_id, cameras_found[camera_id]))
 
 	# Setup Camera:
-	camera=asi.Camera(camera_id)
+	return Camera(asi.Camera(camera_id), camera_id, name)
+
+def initialize(simulate=False, **options):
+	# Initialize the ASI camera library and open the first ASI camera as the default camera.
+	#
+	# The module-level functions below all work on this camera.  Use open_camera() to drive more than one.
+	global camera, default
+	default = open_camera(0, simulate, **options)
+	camera = default.camera
 	return camera
 
 def set_controls(gain=50, gamma=50, image_type=1, wbb=90, wbr=53, flip=0):
-	global camera
-	camera.set_control_value(asi.ASI_GAIN, gain)
-	camera.set_control_value(asi.ASI_GAMMA, gamma)
-	camera.set_control_value(asi.ASI_WB_B, wbb)
-	camera.set_control_value(asi.ASI_WB_R, wbr)
-	camera.set_control_value(asi.ASI_FLIP, flip)
-
-	if image_type==0:
-	    image_type=asi.ASI_IMG_RAW8
-	    msg = "8-bit Mono"
-	elif image_type==1:
-	    image_type=asi.ASI_IMG_RGB24
-	    msg = "24-bit Colour"
-	elif image_type==2:
-	    image_type=asi.ASI_IMG_RAW16
-	    msg = "16-bit Mono"
-	else:
-	    print('Invalid image format specified')
-	    sys.exit(1)
-	camera.set_image_type(image_type)
+	default.set_controls(gain, gamma, image_type, wbb, wbr, flip)
 
 def capture(exp=500000, filename="image.jpg"):
-	
-	global camera
-	
-	camera.set_control_value(asi.ASI_EXPOSURE, exp)
+	return default.capture(exp, filename)
 
-	# Stop any current exposures / video captures:
-	try:
-	    # Force any single exposure to be halted
-	    camera.stop_video_capture()
-	    camera.stop_exposure()
-	except (KeyboardInterrupt, SystemExit):
-	    raise
-	except:
-	    pass
+def read_frame(exp=500000):
+	return default.read_frame(exp)
 
-	camera.capture(filename=filename)
+def stop_stream():
+	default.stop_stream()
 
+def to_array(data):
+	return default.to_array(data)
 
-	
+def rgb(img):
+	# The camera returns colour frames in BGR order - flip them so that everything else can assume RGB.
+	if img.ndim == 3:
+		return img[:, :, ::-1]
+	return img
 
+def save_frame(img, filename):
+	# Encodes and saves a frame returned by capture() or read_frame().  Format is taken from the file extension.
+	mode = None
+	if img.dtype.itemsize == 2:
+		mode = 'I;16'
+	Image.fromarray(img, mode=mode).save(filename)
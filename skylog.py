@@ -0,0 +1,132 @@
+# Buffered, non-blocking logging.
+#
+# write() just puts the message on a queue and returns.  A background thread does the actual writing, keeping one
+# buffered file handle open per log file (skycam.log and each night's capture log) and flushing them every
+# FLUSH_INTERVAL seconds, so the capture loop never waits on log I/O.  Everything is flushed on shutdown.
+#
+# With JSON_LINES set, each line is written as a JSON object (time, message and any extra fields) instead of text.
+
+import threading, json, atexit, sys, time
+from Queue import Queue, Empty
+from datetime import datetime
+
+FLUSH_INTERVAL = 2.0										# Seconds between flushes to disk
+BUFFER_SIZE = 65536											# Buffer size for each open log file
+JSON_LINES = False											# Write structured JSON-lines output instead of plain text
+ECHO = True													# Also print messages to the console
+
+_queue = Queue()
+_handles = {}
+_thread = None
+_start_lock = threading.Lock()
+
+_FLUSH = object()
+_CLOSE = object()
+_STOP = object()
+
+def configure(json_lines=None, flush_interval=None, echo=None):
+	global JSON_LINES, FLUSH_INTERVAL, ECHO
+	if json_lines is not None: JSON_LINES = json_lines
+	if flush_interval is not None: FLUSH_INTERVAL = flush_interval
+	if echo is not None: ECHO = echo
+
+def write(message, filename, **fields):
+	# Queue a message for 'filename'.  Any keyword arguments are included as fields in JSON-lines output.
+	_start()
+	_queue.put((time.time(), filename, message, fields))
+
+def flush():
+	# Wait until everything queued so far has been written and flushed to disk.
+	_command(_FLUSH)
+
+def close(filename=None):
+	# Flush and close the handle for 'filename', or all handles if no filename is given.  Handles are reopened
+	# automatically if more messages arrive.
+	_command(_CLOSE, filename)
+
+def shutdown():
+	# Flush and close everything and stop the background thread.
+	global _thread
+	if _thread is not None and _thread.is_alive():
+		_command(_STOP)
+		_thread.join()
+	_thread = None
+
+def _command(command, filename=None):
+	_start()
+	done = threading.Event()
+	_queue.put((command, filename, done))
+	done.wait()
+
+def _start():
+	global _thread
+	if _thread is not None:
+		return
+	with _start_lock:
+		if _thread is None:
+			t = threading.Thread(target=_run, name="skylog")
+			t.daemon = True
+			t.start()
+			_thread = t
+
+atexit.register(shutdown)
+
+def _run():
+	last_flush = time.time()
+	while True:
+		try:
+			item = _queue.get(timeout=FLUSH_INTERVAL)
+		except Empty:
+			item = None
+
+		if item is not None and item[0] in (_FLUSH, _CLOSE, _STOP):
+			command, filename, done = item
+			_flush_all()
+			if command is not _FLUSH:
+				_close(filename)
+			last_flush = time.time()
+			done.set()
+			if command is _STOP:
+				return
+			continue
+
+		if item is not None:
+			_write(*item)
+
+		if time.time() - last_flush >= FLUSH_INTERVAL:
+			_flush_all()
+			last_flush = time.time()
+
+def _write(timestamp, filename, message, fields):
+	if ECHO:
+		print message
+	if JSON_LINES:
+		record = { "time": datetime.fromtimestamp(timestamp).isoformat(), "message": message }
+		record.update(fields)
+		line = json.dumps(record, default=str)
+	else:
+		line = message
+	try:
+		f = _handles.get(filename)
+		if f is None:
+			f = _handles[filename] = open(filename, 'a', BUFFER_SIZE)
+		f.write(line + "\n")
+	except (IOError, OSError) as e:
+		sys.stderr.write("Could not write to log " + filename + ": " + str(e) + "\n")
+
+def _flush_all():
+	for f in _handles.values():
+		try:
+			f.flush()
+		except (IOError, OSError):
+			pass
+
+def _close(filename=None):
+	names = list(_handles.keys()) if filename is None else [filename]
+	for name in names:
+		f = _handles.pop(name, None)
+		if f is not None:
+			try:
+				f.close()
+			except (IOError, OSError):
+				pass
@@ -1,34 +1,379 @@
-from PIL import Image, ImageChops
+from PIL import Image
 from glob import glob
-import progressbar
-import os
+from multiprocessing import Pool, cpu_count
+from math import ceil
+from collections import OrderedDict
+import numpy as np
+import os, subprocess, time
+import manifest, framestore, timelapse
 
+# Star trail videos (see trail_videos()).  Each is a dictionary like a timelapse rendition (see timelapse.py), with:
+#
+#	"mode"		=	'cumulative' - the trails grow from the first frame to the last, ending on the star trail image
+#					'comet'      - each star has a tail of the last "length" frames behind it
+#	"length"	=	Length of a comet's tail, in frames
+#	"fade"		=	True for tails that fade out towards the end (a decayed maximum), False for a hard cut-off (the
+#					maximum over a sliding window)
+DEFAULT_TRAIL_VIDEOS = [ { "name": "star_trails_video", "mode": "cumulative", "size": "hd1080", "codec": "h264" } ]
+COMET_LENGTH = 30
+FADE_TO = 0.05												# How bright a fading tail is "length" frames back
 
 
-def star_trails(tgtDir=None, output_name=None, imageType="jpg", prefix=""):
+
+def star_trails(tgtDir=None, output_name=None, imageType="jpg", prefix="", processes=None, max_memory=None):
+	# Builds a star trail image from every frame matching 'prefix*.imageType' in 'tgtDir'.  If the folder has a frame
+	# manifest, the frames listed in it are used instead, and if the frames were kept in a frame store they are
+	# stacked straight from its chunks.
+	#
+	# Frames are decoded in a pool of worker processes.  Each worker reduces a batch of frames with np.maximum and
+	# the partial results are then combined pairwise (a tree reduction) into the final image.
+	#
+	#	processes	Number of worker processes.  Defaults to the number of cores.
+	#	max_memory	Rough limit (in MB) on the memory used for partial results.  Fewer, larger batches are used to stay under it.
+	#
+	# Returns a dictionary with the output file, number of frames processed and elapsed time.
+	start = time.time()
 	filePattern = prefix + "*." + imageType
-	
+
 	if tgtDir is None:
 		tgtDir = os.getcwd()
-	else:
-		os.chdir(tgtDir)
 
 	if output_name is None:
 		output_name = "star_trails.jpg"
 	elif not output_name.lower().endswith(".jpg"):
 		output_name = os.path.splitext(output_name)[0] + ".jpg"
+	output_name = os.path.join(tgtDir, output_name)
+
+	stacker = stack_batch
+	store, images = find_frames(tgtDir, filePattern)
+	if store is not None:
+		frame_count = len(store)
+		batches = [ (tgtDir, i) for i in range(store.chunk_count()) ]	# One chunk per batch - already sequential on disk
+		stacker = stack_chunk
+	else:
+		frame_count = len(images)
+
+	if processes is None:
+		processes = cpu_count()
+	processes = max(1, min(processes, frame_count))
+
+	result = OrderedDict( [
+			( "output", None ),
+			( "frames", frame_count ),
+			( "processes", processes ),
+			( "elapsed", 0.0 ) ], )
+	if frame_count == 0:
+		return result
+
+	if stacker is stack_batch:
+		batches = make_batches(images, processes, max_memory)
+	processes = min(processes, len(batches))
+	if processes == 1:
+		partials = [ stacker(batch) for batch in batches ]
+	else:
+		pool = Pool(processes)
+		try:
+			partials = pool.map(stacker, batches)
+		finally:
+			pool.close()
+			pool.join()
+
+	final_image = tree_reduce(partials)
+	Image.fromarray(to_8bit(final_image)).save(output_name, "JPEG")
+
+	result["output"] = output_name
+	result["elapsed"] = time.time() - start
+	return result
+
+
+def find_frames(tgtDir, filePattern):
+	# The night's frames: (FrameStore, None) if they were kept in a frame store, otherwise (None, frame files) - the
+	# files in the manifest if there is one, or else the files matching 'filePattern', in name order.
+	if framestore.exists(tgtDir):
+		return framestore.FrameStore(tgtDir), None
+	frame_files = manifest.frame_files(tgtDir)
+	if frame_files is not None:
+		return None, [ os.path.join(tgtDir, x) for x in frame_files ]
+	return None, sorted(glob(os.path.join(tgtDir, filePattern)))
+
+
+def make_batches(images, processes, max_memory=None):
+	# Splits the list of frames into batches - a few per process so that the work balances out.
+	#
+	# Each batch produces one full-size partial result, so if there is a memory limit we cap the number of batches.
+	num_batches = processes * 4
+	if max_memory is not None:
+		with Image.open(images[0]) as first:
+			frame_bytes = first.size[0] * first.size[1] * len(first.getbands()) * (2 if first.mode.startswith("I") else 1)
+		allowed = int(max_memory * 1024 * 1024 / frame_bytes) - 2 * processes		# Workers each hold a frame and a partial too
+		num_batches = min(num_batches, max(1, allowed))
+	num_batches = max(1, min(num_batches, len(images)))
+	size = int(ceil(len(images) / float(num_batches)))
+	return [ images[i:i + size] for i in range(0, len(images), size) ]
+
+
+def stack_batch(images):
+	# Decodes a batch of frames and returns their per-pixel maximum.
+	stack = np.array(Image.open(images[0]))
+	for image in images[1:]:
+		np.maximum(stack, np.asarray(Image.open(image)), out=stack)
+	return stack
+
+
+def stack_chunk(args):
+	# Returns the per-pixel maximum of one frame store chunk, read through the memory map.
+	night_dir, chunk_index = args
+	store = framestore.FrameStore(night_dir)
+	return np.maximum.reduce(store.read_chunk(chunk_index))
+
+
+def tree_reduce(partials):
+	# Combines partial results pairwise until only one is left.
+	while len(partials) > 1:
+		merged = []
+		for i in range(0, len(partials) - 1, 2):
+			merged.append(np.maximum(partials[i], partials[i + 1], out=partials[i]))
+		if len(partials) % 2:
+			merged.append(partials[-1])
+		partials = merged
+	return partials[0]
+
+
+def to_8bit(img):
+	# JPEG can only hold 8 bits per channel, so scale RAW16 data (which PIL may have read back as 32-bit) down before saving.
+	if img.dtype != np.uint8:
+		return (img >> 8).clip(0, 255).astype(np.uint8)
+	return img
+
+
+class TrailStacker(object):
+	# Builds the star trail image incrementally during capture by keeping a running per-pixel maximum of every frame.
+	#
+	# The stack is checkpointed to a .npy file every so often so that a crash or restart part-way through the night
+	# doesn't lose the trails captured so far.
+
+	def __init__(self, checkpoint_file=None):
+		self.stack = None
+		self.count = 0
+		self.checkpoint_file = checkpoint_file
+		if checkpoint_file is not None and os.path.exists(checkpoint_file):
+			self.stack = np.load(checkpoint_file)			# Resume from an interrupted run
+
+	def add(self, frame):
+		if self.stack is None or self.stack.shape != frame.shape or self.stack.dtype != frame.dtype:
+			self.stack = np.array(frame)					# First frame (or the image format changed) - take a copy to stack onto
+		else:
+			np.maximum(self.stack, frame, out=self.stack)
+		self.count += 1
+
+	def checkpoint(self):
+		# Write to a temporary file and rename it, so we never leave a half-written checkpoint behind.
+		if self.stack is None or self.checkpoint_file is None:
+			return
+		temp_file = self.checkpoint_file + ".tmp"
+		with open(temp_file, 'wb') as f:
+			np.save(f, self.stack)
+		os.rename(temp_file, self.checkpoint_file)
+
+	def save(self, output_name):
+		# Saves the finished star trail image and removes the checkpoint.
+		if self.stack is None:
+			return None
+		Image.fromarray(to_8bit(self.stack)).save(output_name, "JPEG")
+		if self.checkpoint_file is not None and os.path.exists(self.checkpoint_file):
+			os.remove(self.checkpoint_file)
+		return output_name
+
+
+class CumulativeMax(object):
+	# Star trails so far: the per-pixel maximum of every frame added.
+
+	def __init__(self):
+		self.stack = None
+
+	def add(self, frame):
+		# Adds a frame and returns the trails up to and including it.
+		if self.stack is None:
+			self.stack = np.array(frame)
+		else:
+			np.maximum(self.stack, frame, out=self.stack)
+		return self.stack
+
+
+class DecayedMax(object):
+	# Fading comet tails: each frame the trails so far are dimmed a little before the new frame is maxed in, so a
+	# star's tail fades to FADE_TO of its brightness over 'length' frames.  The sky background stays where it is,
+	# since the new frame tops it up again.  Two frames of memory and two passes over them per frame, however long the
+	# tails are.
+
+	def __init__(self, length=COMET_LENGTH):
+		self.decay = np.float32(FADE_TO ** (1.0 / max(1, length)))
+		self.stack = None
+		self.out = None
+
+	def add(self, frame):
+		if self.stack is None:
+			self.stack = frame.astype(np.float32)
+			self.out = np.empty_like(frame)
+		else:
+			self.stack *= self.decay
+			np.maximum(self.stack, frame, out=self.stack)
+		self.out[...] = self.stack
+		return self.out
+
+
+class SlidingMax(object):
+	# Comet tails with a hard end: the per-pixel maximum of the last 'length' frames.
+	#
+	# The window is kept as a queue made of two stacks, so each frame costs three np.maximum passes on average
+	# whatever the length.  New frames go on the back stack, which only keeps its overall maximum up to date.  Frames
+	# leave from the front stack, where each entry holds the maximum of itself and every newer frame on that stack;
+	# when it runs out the back stack is turned into a new front stack in one backwards pass, in place.  Holds
+	# 'length' frames plus two.
+
+	def __init__(self, length=COMET_LENGTH):
+		self.length = max(1, length)
+		self.back = []										# Oldest first
+		self.back_max = None
+		self.front = []										# Oldest last, each the maximum of itself and everything before it in the list
+		self.out = None
+
+	def add(self, frame):
+		frame = np.array(frame)
+		self.back.append(frame)
+		if self.back_max is None:
+			self.back_max = frame.copy()
+		else:
+			np.maximum(self.back_max, frame, out=self.back_max)
+
+		if len(self.front) + len(self.back) > self.length:	# Drop the oldest frame
+			if not self.front:
+				self._flip()
+			self.front.pop()
+
+		if not self.back:
+			return self.front[-1]
+		if not self.front:
+			return self.back_max
+		if self.out is None:
+			self.out = np.empty_like(frame)
+		return np.maximum(self.front[-1], self.back_max, out=self.out)
+
+	def _flip(self):
+		back = self.back
+		for i in range(len(back) - 2, -1, -1):
+			np.maximum(back[i], back[i + 1], out=back[i])
+		back.reverse()
+		self.front = back
+		self.back = []
+		self.back_max = None
+
+
+def trail_engine(video):
+	# The stacking for one of the videos described at the top of this file.
+	mode = video.get("mode", "cumulative")
+	if mode == "cumulative":
+		return CumulativeMax()
+	if mode == "comet":
+		if video.get("fade", True):
+			return DecayedMax(video.get("length", COMET_LENGTH))
+		return SlidingMax(video.get("length", COMET_LENGTH))
+	raise ValueError("Unknown star trail video mode: " + str(mode))
+
+
+def load_frame(image):
+	return np.asarray(Image.open(image))
+
+
+def night_frames(tgtDir, filePattern, processes=None):
+	# Yields the night's frames in capture order, each read once.  Frame files are decoded a few at a time in a pool
+	# of worker processes, ahead of where we've got to.
+	store, images = find_frames(tgtDir, filePattern)
+	if store is not None:
+		for frame in store:
+			yield frame
+		return
+	if processes is None:
+		processes = cpu_count()
+	if processes <= 1 or len(images) < 2:
+		for image in images:
+			yield load_frame(image)
+		return
+	pool = Pool(processes)
+	try:
+		for frame in pool.imap(load_frame, images, chunksize=4):
+			yield frame
+	finally:
+		pool.terminate()
+		pool.join()
+
+
+def trail_videos(tgtDir, videos=None, rate=25, imageType="jpg", prefix="", processes=None):
+	# Makes star trail videos (see the top of this file) from the frames in 'tgtDir' in a single pass.  Each frame is
+	# read once and added to every video's stack, and the result goes straight down a pipe to that video's ffmpeg -
+	# no need to stack the night again for every frame of the video.  Videos are written to temporary files and
+	# renamed once ffmpeg finishes cleanly.  Raises RuntimeError if ffmpeg fails, leaving any existing videos alone.
+	#
+	# Returns a dictionary with the output files, number of frames and elapsed time.
+	start = time.time()
+	videos = videos or DEFAULT_TRAIL_VIDEOS
+	engines = [ trail_engine(video) for video in videos ]
+	outputs = [ os.path.join(tgtDir, x) for x in timelapse.output_names(videos) ]
+	temp_outputs = [ timelapse.part_name(x) for x in outputs ]
+	logs = [ os.path.splitext(x)[0] + "_ffmpeg.log" for x in outputs ]
+	encoders = []
+	shape = None
+	frames = 0
+	finished = False
+	try:
+		for frame in night_frames(tgtDir, prefix + "*." + imageType, processes):
+			if frame.dtype.itemsize > 2:						# 16-bit PNGs read back as 32-bit ints
+				frame = frame.astype(np.uint16)
+			if shape is None:
+				shape = frame.shape
+			elif frame.shape != shape:
+				raise ValueError("Frame size changed from " + str(shape) + " to " + str(frame.shape))
+			for n, engine in enumerate(engines):
+				trails = engine.add(frame)
+				if len(encoders) <= n:
+					encoders.append(start_encoder(trails, videos[n], temp_outputs[n], logs[n], rate))
+				try:
+					encoders[n].stdin.write(np.ascontiguousarray(trails).tostring())
+				except IOError:									# ffmpeg gave up - its exit status says why
+					pass
+			frames += 1
+		finished = True
+	finally:
+		failed = []
+		for encoder, log in zip(encoders, logs):
+			try:
+				encoder.stdin.close()
+			except IOError:
+				pass
+			if encoder.wait() != 0:
+				failed.append(os.path.basename(log))
+		for temp_output in temp_outputs:
+			if not finished or failed:
+				if os.path.exists(temp_output):
+					os.remove(temp_output)
 
-	images = glob(filePattern)
-	images.sort()
-	final_image = Image.open(images[0])
+	if failed:
+		raise RuntimeError("ffmpeg failed making star trail videos - see " + ", ".join(failed))
+	for temp_output, output, log in zip(temp_outputs, outputs, logs):
+		if frames:
+			os.rename(temp_output, output)
+			os.remove(log)
 
-	bar = progressbar.ProgressBar(maxval=len(images)-1, widgets=[progressbar.Bar('=', '[', ']'), ' ', progressbar.Percentage()])
-	bar.start()
+	result = OrderedDict( [
+			( "outputs", outputs if frames else [] ),
+			( "frames", frames ),
+			( "elapsed", time.time() - start ) ], )
+	return result
 
-	for i in range(1, len(images)):
-		current_image = Image.open(images[i])
-		final_image = ImageChops.lighter(final_image, current_image)
-		bar.update(i)
-	final_image.save(output_name, "JPEG")
 
-	bar.finish()
\ No newline at end of file
+def start_encoder(frame, video, output, log_file, rate):
+	# An ffmpeg taking raw frames like 'frame' on its stdin and making one video.
+	cmd = [ 'ffmpeg', '-y', '-loglevel', 'error' ] + timelapse.raw_input_args(frame, rate)
+	cmd += timelapse.output_args([ video ], [ output ], rate)
+	with open(log_file, 'w') as log:
+		return subprocess.Popen(cmd, stdin=subprocess.PIPE, stderr=log)
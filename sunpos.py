@@ -1,5 +1,6 @@
-import ephem,json
-from math import pi
+import ephem,json,os,calendar,threading
+from math import pi, floor
+from bisect import bisect_right
 from datetime import datetime
 import pytz
 
@@ -11,25 +12,48 @@ ASTRO=-18
 TWILIGHT = [SUNSET, CIVIL, NAUTICAL, ASTRO]
 
 
-# Default values for latitude and longitude
-with open('settings.json', 'r') as f:
-	data = json.load(f)
-LAT=data['latitude']
-LON=data['longitude']
+# Default values for latitude and longitude - read from settings.json the first time they are needed
+LAT=None
+LON=None
 
+# Precomputed sunset / twilight times are cached on disk, one file per location
+CACHE_DIR = os.path.join(os.path.abspath(os.path.dirname(__file__)), "ephemeris")
+CACHE_DAYS = 366											# How many nights to precompute when a location is first used
+EPHEM_EPOCH = 25567.5										# ephem date (days since 1899-12-31 12:00 UTC) of 1970-01-01 00:00 UTC
+CACHE_VERSION = 2											# Tables saved in an older format are recomputed
 
-def sun_angle(lat=LAT,lon=LON):
+_tables = {}
+_tables_lock = threading.Lock()
+
+
+def default_location(lat=None, lon=None):
+	global LAT, LON
+	if LAT is None or LON is None:
+		this_folder = os.path.abspath(os.path.dirname(__file__))
+		with open(this_folder + '/' + 'settings.json', 'r') as f:
+			data = json.load(f)
+		LAT=data['latitude']
+		LON=data['longitude']
+	if lat is None: lat = LAT
+	if lon is None: lon = LON
+	return lat, lon
+
+
+def sun_angle(lat=None,lon=None,date=None):
+	# Sun's altitude in degrees at 'date' (UTC, defaults to now).
+	lat, lon = default_location(lat, lon)
 	o = ephem.Observer()
 	o.lat = lat*pi/180
 	o.long = lon*pi/180
-	o.date = ephem.now()
+	o.date = ephem.now() if date is None else ephem.Date(date)
 	s=ephem.Sun()
 	s.compute(o)
 	angle=s.alt*180/pi
 	return angle
 
 
-def twilight_phase(lat=LAT, lon=LON):
+def twilight_phase(lat=None, lon=None):
+	lat, lon = default_location(lat, lon)
 	# Start by converting coordiantes to radian for calculations:
 	lat = lat*pi/180
 	lon = lon*pi/180
@@ -48,7 +72,7 @@ def twilight_phase(lat=LAT, lon=LON):
 		return 4			# "NIGHT"
 
 
-def twilight_time(twilight=0,lat=LAT,lon=LON,date=datetime.utcnow(),clean_seconds=True):
+def twilight_time(twilight=0,lat=None,lon=None,date=None,clean_seconds=True):
 	# Returns twilight start and end time for tonight.
 	# 
 	# Arguments are:
@@ -58,110 +82,210 @@ def twilight_time(twilight=0,lat=LAT,lon=LON,date=datetime.utcnow(),clean_second
 	#			3 - Astronomical twilight
 	#	lat		Latitude in degrees, +ve values are North of equator
 	#	lon		Longitude in degrees, +ve values are East of the prime meridian
-	#	date		Today's date - must be TZ aware. If not, we assume UTC.
+	#	date		Today's date - must be TZ aware. If not, we assume UTC.  Defaults to now.
 	#	clean_seconds	I hate seeing fractional seconds in my results so I'll round off by default.  Set this to False if you want different behaviour.
+	#
+	# Times come from the precomputed ephemeris table for this location (see EphemerisTable).
 
-	# Start by converting coordiantes to radian for calculations
-	lat = lat*pi/180
-	lon = lon*pi/180
+	lat, lon = default_location(lat, lon)
+	now = utc_timestamp(date)
+	table = ephemeris_table(lat, lon)
 
-	# Check whether date provided is TZ aware. If yes and not in UTC, then convert to UTC.
-	# try:
-	isAware = (date.tzinfo is not None)
-	isUTC = date.tzinfo == pytz.timezone('UTC')
-	if isAware and not isUTC:
-		print "Date provided is not UTC time, converting to UTC."
-		date = date.astimezone(pytz.timezone('UTC'))
-	elif not isAware:
-		print "Warning - date provided is not UTC aware.  Calculations will assume UTC."
-	# except:
-	# 	pass
+	night = table.night(tonight(table, now, twilight))['phases'][twilight]
 
-	# Set up our observer location and sun object
-	sun = ephem.Sun()
-	o = ephem.Observer()
-	o.lat = lat
-	o.lon = lon
-	o.date = date
-	o.horizon = TWILIGHT[twilight]*pi/180
-
-	# And now calculate the start and end of  twilight (or sunset/sunrise):
-	try:
-		start = o.next_setting(sun)
-		end = o.next_rising(sun)
-
-		if start > end:	# This means we're running at night and the sun has already set.  In this case we will switch to the previous setting.
-			start = o.previous_setting(sun)
-
-		# Convert to local time:
-		start = ephem.localtime(start)
-		end = ephem.localtime(end)
-
-		# Cleanup Seconds so that we don't have fractional results
-		if clean_seconds:
-			start = datetime(start.year, start.month, start.day, start.hour, start.minute, start.second)
-			end = datetime(end.year, end.month, end.day, end.hour, end.minute, end.second)
-
-	
-	except ephem.AlwaysUpError:
-		start = None
-		end = None
-	except:
-		raise
+	# The sun doesn't get low enough tonight:
+	if night is None:
+		return [None, None]
 
 	# Finally, return the values but in local time:
-	return [start, end]
+	return [local_time(night[0], clean_seconds), local_time(night[1], clean_seconds)]
 
-def next_sunset(lat=LAT,lon=LON,date=datetime.utcnow(),clean_seconds=True):
-	# Returns twilight start and end time for tonight.
+def next_sunset(lat=None,lon=None,date=None,clean_seconds=True):
+	# Returns the time of the next sunset.
 	# 
 	# Arguments are:
-	#	twilight 	0 - Sunset
-	#			1 - Civil twilight
-	#			2 - Nautical twilight
-	#			3 - Astronomical twilight
 	#	lat		Latitude in degrees, +ve values are North of equator
 	#	lon		Longitude in degrees, +ve values are East of the prime meridian
-	#	date		Today's date - must be TZ aware. If not, we assume UTC.
+	#	date		Today's date - must be TZ aware. If not, we assume UTC.  Defaults to now.
 	#	clean_seconds	I hate seeing fractional seconds in my results so I'll round off by default.  Set this to False if you want different behaviour.
 
-	# Start by converting coordiantes to radian for calculations
-	lat = lat*pi/180
-	lon = lon*pi/180
+	lat, lon = default_location(lat, lon)
+	now = utc_timestamp(date)
+	table = ephemeris_table(lat, lon)
+
+	day = table.day_of(now)
+	setting = table.night(day)['sunset']
+	if setting is None or setting <= now:
+		setting = table.night(day + 1)['sunset']
+	if setting is None:
+		return None
+
+	return local_time(setting, clean_seconds)
+
+def upcoming_sessions(nights=7,twilight=0,lat=None,lon=None,date=None,clean_seconds=True):
+	# Returns a list of [start, end] twilight times for the next few nights - e.g. for showing upcoming sessions.
+	lat, lon = default_location(lat, lon)
+	now = utc_timestamp(date)
+	table = ephemeris_table(lat, lon)
+
+	sessions = []
+	first = tonight(table, now, twilight)
+	for day in range(first, first + nights):
+		night = table.night(day)['phases'][twilight]
+		if night is None:
+			sessions.append([None, None])
+		else:
+			sessions.append([local_time(night[0], clean_seconds), local_time(night[1], clean_seconds)])
+	return sessions
+
+
+def tonight(table, now, twilight):
+	# Day number of the night twilight_time() gives at 'now': the one that follows the most recent (local solar) noon,
+	# or the next one if we're already past the end of it - or past midnight on a night the sun doesn't get low
+	# enough.  That's the night the ephem solver would find from 'now'.
+	day = table.day_of(now)
+	night = table.night(day)
+	phase = night['phases'][twilight]
+	if phase is not None and phase[1] <= now or phase is None and night['midnight'] <= now:
+		return day + 1
+	return day
+
+def utc_timestamp(date=None):
+	# Converts a date to a UTC timestamp.  Dates that are not TZ aware are assumed to be UTC.
+	if date is None:
+		date = datetime.utcnow()
 
 	# Check whether date provided is TZ aware. If yes and not in UTC, then convert to UTC.
-	# try:
-	isAware = date.tzinfo is not None
+	isAware = (date.tzinfo is not None)
 	isUTC = date.tzinfo == pytz.timezone('UTC')
 	if isAware and not isUTC:
-		print "Date provided is not UTC time, converting to UTC."
 		date = date.astimezone(pytz.timezone('UTC'))
-	elif not isAware:
-		print "Warning - date provided is not UTC aware.  Calculations will assume UTC."
-	# except:
-	# 	pass
+	return calendar.timegm(date.utctimetuple()) + date.microsecond / 1e6
 
-	# Set up our observer location and sun object
-	sun = ephem.Sun()
-	o = ephem.Observer()
-	o.lat = lat
-	o.lon = lon
-	o.date = date
-
-	try:
-		setting = o.next_setting(sun)
-	
-		# Convert to local time:
-		setting = ephem.localtime(setting)
-	
-		# Cleanup Seconds so that we don't have fractional results
-		if clean_seconds:
-			setting = datetime(setting.year, setting.month, setting.day, setting.hour, setting.minute, setting.second)
-	
-	except ephem.AlwaysUpError:
-		setting = None
-
-	except:
-		raise
-
-	return setting
\ No newline at end of file
+def ephem_timestamp(date):
+	# Converts an ephem date to a UTC timestamp, rounded to the microsecond the same way ephem.localtime() does it.
+	microseconds = int(round(24 * 60 * 60 * 1000000 * date))
+	return (microseconds - 2209032000 * 1000000) / 1e6
+
+def local_time(timestamp, clean_seconds=True):
+	# Converts a UTC timestamp to (naive) local time, like ephem.localtime()
+	seconds, microseconds = divmod(int(round(timestamp * 1e6)), 1000000)
+	local = datetime.fromtimestamp(seconds).replace(microsecond=microseconds)
+	# Cleanup Seconds so that we don't have fractional results
+	if clean_seconds:
+		local = local.replace(microsecond=0)
+	return local
+
+def ephemeris_table(lat, lon):
+	# Returns the (cached) ephemeris table for a location, loading or precomputing it the first time it is used.
+	key = (round(lat, 4), round(lon, 4))
+	with _tables_lock:
+		table = _tables.get(key)
+		if table is None:
+			table = _tables[key] = EphemerisTable(key[0], key[1])
+	return table
+
+
+class EphemerisTable(object):
+	# Sunset and twilight start / end times for a location, one entry per night, saved to disk.
+	#
+	# Each night is keyed by the day number (days since 1970-01-01) of the local solar noon before it.  On first use
+	# a year of nights is precomputed and saved.  Nights outside that range are computed when they're first asked
+	# for and added to the table, so lookups are a dictionary / binary search instead of a run of the ephem solver.
+
+	def __init__(self, lat, lon, cache_dir=None, days=CACHE_DAYS):
+		self.lat = lat
+		self.lon = lon
+		if cache_dir is None:
+			cache_dir = CACHE_DIR
+		self.path = os.path.join(cache_dir, "ephemeris_%.4f_%.4f.json" % (lat, lon))
+		self.nights = {}
+		self.noons = []										# Sorted noon timestamps, for binary searches
+		self.days = []										# Day numbers matching self.noons
+		self.lock = threading.RLock()
+
+		if os.path.isfile(self.path):
+			self.load()
+		if not self.nights:
+			self.precompute(self.day_of(utc_timestamp()) - 1, days)
+
+	def noon(self, day):
+		# Timestamp of local solar noon on 'day'
+		return day * 86400.0 + 43200.0 - self.lon / 15.0 * 3600.0
+
+	def day_of(self, timestamp):
+		# Day number of the most recent local solar noon at or before 'timestamp'
+		with self.lock:
+			i = bisect_right(self.noons, timestamp) - 1
+			if i >= 0 and timestamp < self.noons[i] + 86400.0:
+				return self.days[i]
+		return int(floor((timestamp - self.noon(0)) / 86400.0))
+
+	def night(self, day):
+		with self.lock:
+			night = self.nights.get(day)
+			if night is None:
+				night = self.add(day)
+				self.save()
+			return night
+
+	def precompute(self, first_day, days):
+		with self.lock:
+			for day in range(first_day, first_day + days):
+				if day not in self.nights:
+					self.add(day)
+			self.save()
+
+	def add(self, day):
+		night = self.compute(day)
+		self.nights[day] = night
+		i = bisect_right(self.days, day)
+		self.days.insert(i, day)
+		self.noons.insert(i, night['noon'])
+		return night
+
+	def compute(self, day):
+		# Runs the ephem solver for the night following local noon on 'day'.
+		sun = ephem.Sun()
+		o = ephem.Observer()
+		o.lat = self.lat*pi/180
+		o.lon = self.lon*pi/180
+		noon = self.noon(day)
+
+		phases = []
+		for angle in TWILIGHT:
+			o.date = noon / 86400.0 + EPHEM_EPOCH
+			o.horizon = angle*pi/180
+			try:
+				start = o.next_setting(sun)
+				end = o.next_rising(sun)
+				phases.append([ ephem_timestamp(start), ephem_timestamp(end) ])
+			except (ephem.AlwaysUpError, ephem.NeverUpError):
+				phases.append(None)
+
+		o.date = noon / 86400.0 + EPHEM_EPOCH
+		midnight = ephem_timestamp(o.next_antitransit(sun))
+		sunset = phases[SUNSET][0] if phases[SUNSET] is not None else None
+		return { 'noon': noon, 'midnight': midnight, 'sunset': sunset, 'phases': phases }
+
+	def load(self):
+		try:
+			with open(self.path, 'r') as f:
+				data = json.load(f)
+		except (IOError, ValueError):
+			return
+		if data.get('version') != CACHE_VERSION or data.get('latitude') != self.lat or data.get('longitude') != self.lon:
+			return
+		with self.lock:
+			for day, night in data['nights'].items():
+				self.nights[int(day)] = night
+			self.days = sorted(self.nights.keys())
+			self.noons = [ self.nights[day]['noon'] for day in self.days ]
+
+	def save(self):
+		if not os.path.exists(os.path.dirname(self.path)):
+			os.makedirs(os.path.dirname(self.path))
+		temp_file = self.path + ".tmp"
+		with open(temp_file, 'w') as f:
+			json.dump({ 'version': CACHE_VERSION, 'latitude': self.lat, 'longitude': self.lon, 'nights': self.nights }, f)
+		os.rename(temp_file, self.path)
@@ -0,0 +1,107 @@
+# Builds an archive index over a couple of night folders: importing what's already there, adding frames through an
+# ArchiveWriter, marking uploads, and reading capture_settings.json times with or without a UTC offset.
+#
+#	python -m unittest discover -s tests
+
+import json, os, shutil, tempfile, unittest
+from datetime import datetime
+import pytz
+import archive, manifest, uploader
+
+class ArchiveTest(unittest.TestCase):
+
+	def setUp(self):
+		self.base_dir = tempfile.mkdtemp() + "/"
+		self.make_night("20240301", 3, start="2024-03-01T20:00:00-07:00", finish="2024-03-02T05:30:00-07:00")
+		self.index = archive.ArchiveIndex(self.base_dir)
+
+	def tearDown(self):
+		shutil.rmtree(self.base_dir)
+
+	def make_night(self, night, count, **settings):
+		path = self.base_dir + night + "/"
+		os.makedirs(path)
+		frames = manifest.Manifest(path)
+		for n in range(count):
+			filename = frames.next_filename()
+			open(path + filename, 'w').close()
+			frames.add(datetime(2024, 3, 1, 21, 0, n), 5.0, 200, filename)
+		frames.close()
+		settings.update(camera="ASI178MC", exposure=5.0, gain=200)
+		with open(path + "capture_settings.json", 'w') as f:
+			json.dump(settings, f)
+		return path
+
+	def test_schema(self):
+		tables = [ row["name"] for row in self.index.query("SELECT name FROM sqlite_master WHERE type = 'table' ORDER BY name") ]
+		self.assertEqual(tables, [ "frames", "nights", "sessions" ])
+		self.index.db().executescript(archive.SCHEMA)				# Opening it again changes nothing
+		self.assertEqual(self.index.nights(), [ "20240301" ])
+
+	def test_import(self):
+		session = self.index.query("SELECT * FROM sessions WHERE folder = '20240301'")[0]
+		self.assertEqual((session["camera"], session["gain"], session["frames"]), ("ASI178MC", 200, 3))
+		self.assertEqual(session["start"], "2024-03-01T20:00:00")		# Local time, as in the manifest
+		self.assertAlmostEqual(session["hours"], 9.5)
+		paths = [ row["path"] for row in self.index.query("SELECT path FROM frames ORDER BY idx") ]
+		self.assertEqual(paths, [ "20240301/00001.jpg", "20240301/00002.jpg", "20240301/00003.jpg" ])
+
+		# Only nights it doesn't have yet, and only ones with a folder
+		self.make_night("20240302", 2)
+		self.assertEqual(self.index.import_nights(), [ "20240302" ])
+		self.assertEqual(self.index.import_nights([ "20240302", "20240303" ]), [])
+		self.assertEqual(self.index.nights(), [ "20240301", "20240302" ])
+
+	def test_writer_batches(self):
+		batches = []
+		add_frames = self.index.add_frames
+		def counting(session, frames):
+			batches.append(len(frames))
+			add_frames(session, frames)
+		self.index.add_frames = counting
+
+		count = archive.BATCH * 2 + 50
+		writer = archive.ArchiveWriter(self.index, "20240302", "ASI178MC", 5.0, 200)
+		for n in range(1, count + 1):
+			writer.add(n, datetime(2024, 3, 2, 22, 0, 0), 5.0, 200, "%05d.jpg" % n)
+		writer.stop()
+		self.assertEqual(sum(batches), count)
+		self.assertTrue(max(batches) <= archive.BATCH)
+		self.assertEqual(writer.failed, [])
+		frames = self.index.query("SELECT frames FROM sessions WHERE folder = '20240302'")[0]["frames"]
+		self.assertEqual(frames, count)
+		self.assertEqual(self.index.nights(), [ "20240301", "20240302" ])
+
+	def test_mark_uploaded(self):
+		self.index.mark_uploaded("20240301", [ "00001.jpg", "00003.jpg", "capture_settings.json" ])
+		self.index.mark_uploaded("20240309", [ "00001.jpg" ])			# Not a session: nothing to do
+		rows = self.index.query("SELECT idx, uploaded FROM frames ORDER BY idx")
+		self.assertEqual([ (x["idx"], x["uploaded"]) for x in rows ], [ (1, 1), (2, 0), (3, 1) ])
+
+		# Imported nights pick up what the uploader has already sent
+		path = self.make_night("20240302", 2)
+		with open(path + uploader.STATE_FILE, 'w') as f:
+			f.write("00002.jpg\n")
+		self.index.import_nights()
+		rows = self.index.query("SELECT frames.idx, frames.uploaded FROM frames JOIN sessions ON sessions.id = frames.session "
+								"WHERE sessions.folder = '20240302' ORDER BY frames.idx")
+		self.assertEqual([ (x["idx"], x["uploaded"]) for x in rows ], [ (1, 0), (2, 1) ])
+
+	def test_parse_time(self):
+		self.assertEqual(archive.parse_time("2024-03-01T02:15:30"), datetime(2024, 3, 1, 2, 15, 30))
+		self.assertEqual(archive.parse_time("2024-03-01T02:15:30.250000"), datetime(2024, 3, 1, 2, 15, 30, 250000))
+		self.assertEqual(archive.parse_time("yesterday"), None)
+		self.assertEqual(archive.parse_time(None), None)
+
+		# Times written by isoformat() come back as they went in, offset and all
+		tz = pytz.timezone("America/Edmonton")
+		start = tz.localize(datetime(2024, 3, 9, 20, 0, 0))
+		finish = tz.localize(datetime(2024, 3, 10, 6, 0, 0))			# Clocks went forward in between
+		for value in (start, finish, pytz.utc.localize(datetime(2024, 3, 1, 9, 0, 0, 500))):
+			self.assertEqual(archive.parse_time(value.isoformat()), value)
+		self.assertEqual(archive.parse_time("2024-03-01T09:00:00Z"), pytz.utc.localize(datetime(2024, 3, 1, 9, 0, 0)))
+		self.assertEqual(archive.elapsed(archive.parse_time(start.isoformat()), archive.parse_time(finish.isoformat())), 9.0)
+		self.assertEqual(archive.local_time(archive.parse_time(start.isoformat())), datetime(2024, 3, 9, 20, 0, 0))
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,120 @@
+# Runs auto exposure against a simulated sky, where each frame's level is the sky's brightness times the exposure and
+# gain the frame was taken with: settling after the sky steps darker, leaving well alone inside the deadband, keeping
+# up with twilight using the sun's altitude, and keeping to the dark library's steps.
+#
+#	python -m unittest discover -s tests
+
+import unittest
+import numpy as np
+import autoexposure
+from autoexposure import AutoExposure, TARGET, TOLERANCE, gain_factor
+
+def frame(level):
+	# A RAW16 frame with the given sky level, plus a little noise.
+	noise = np.random.RandomState(1).normal(0, 200, (240, 320))
+	return (level * 65535 + noise).clip(0, 65535).astype(np.uint16)
+
+class Sky(object):
+	# 'flux' is the sky level a 1 second exposure at gain 0 would give.
+
+	def __init__(self, auto, flux):
+		self.auto = auto
+		self.flux = flux
+
+	def level(self):
+		return min(self.flux * self.auto.brightness(), 1.0)
+
+	def take(self, sun_altitude=None):
+		level = self.level()
+		self.auto.update(frame(level), sun_altitude)
+		return level
+
+	def settle(self, frames=20):
+		# Levels of the frames taken until the loop settles.
+		levels = [ self.take() ]
+		while len(levels) < frames and abs(levels[-1] / TARGET - 1.0) > TOLERANCE:
+			levels.append(self.take())
+		return levels
+
+def close(level):
+	return abs(level / TARGET - 1.0) <= TOLERANCE + 0.02			# Noise and rounding the gain
+
+class AutoExposureTest(unittest.TestCase):
+
+	def test_sky_level(self):
+		self.assertAlmostEqual(autoexposure.sky_level(frame(0.5)), 0.5, places=2)
+		colour = np.zeros((240, 320, 3), np.uint8)
+		colour[:, :, 1] = 51
+		self.assertAlmostEqual(autoexposure.sky_level(colour), 0.2)
+
+	def test_settles_after_each_step(self):
+		auto = AutoExposure(1.0, 0, min_exposure=0.001, max_exposure=30.0, min_gain=0, max_gain=400)
+		sky = Sky(auto, 0.02)
+		for flux in (0.02, 0.002, 0.0001, 0.05):				# Dusk, night, moonset, moonrise
+			sky.flux = flux
+			levels = sky.settle()
+			self.assertTrue(close(levels[-1]), levels)
+			self.assertTrue(len(levels) < 15, levels)
+			settings = (auto.exposure, auto.gain)
+			sky.take()
+			self.assertEqual((auto.exposure, auto.gain), settings)	# And stays put
+
+			# Exposure is used up before gain
+			if auto.gain > 0:
+				self.assertEqual(auto.exposure, 30.0)
+			else:
+				self.assertTrue(auto.exposure < 30.0)
+		self.assertTrue(auto.gain == 0 and auto.exposure < 10)
+
+	def test_moves_at_most_max_step(self):
+		auto = AutoExposure(10.0, 0, min_exposure=0.001, max_exposure=30.0, min_gain=0, max_gain=400)
+		auto.update(frame(1.0))									# Blown out
+		self.assertAlmostEqual(auto.exposure, 10.0 / autoexposure.MAX_STEP)
+		auto.update(frame(0.0))
+		self.assertAlmostEqual(auto.exposure, 10.0)
+
+	def test_deadband(self):
+		auto = AutoExposure(1.0, 100, min_exposure=0.001, max_exposure=30.0, min_gain=0, max_gain=400)
+		for level in (TARGET * (1 - TOLERANCE * 0.8), TARGET * (1 + TOLERANCE * 0.8)):
+			self.assertEqual(auto.update(frame(level)), (1.0, 100))
+		auto.update(frame(TARGET * (1 + TOLERANCE * 1.5)))
+		self.assertTrue(auto.brightness() < gain_factor(100))
+
+	def test_sun_feed_forward(self):
+		# The sun sinks 0.5 degrees a frame through twilight.  Fed the sun's altitude, the loop catches up within a few
+		# frames and then keeps up; without it, it's always behind.
+		errors = {}
+		for feed_forward in (True, False):
+			auto = AutoExposure(0.01, 0, min_exposure=0.0001, max_exposure=30.0, min_gain=0, max_gain=400)
+			sky = Sky(auto, TARGET / auto.brightness())
+			levels = []
+			for altitude in np.arange(-4.0, -14.0, -0.5):
+				levels.append(sky.take(altitude if feed_forward else None))
+				sky.flux /= 10 ** (0.4 * autoexposure.SKY_MAG_PER_DEGREE * 0.5)
+			errors[feed_forward] = max(abs(x / TARGET - 1.0) for x in levels[6:])
+		self.assertTrue(errors[True] < 0.05, errors)
+		self.assertTrue(errors[False] > 0.3, errors)
+
+		# Out of twilight there's nothing to feed forward
+		auto = AutoExposure(1.0, 0, min_exposure=0.001, max_exposure=30.0, min_gain=0, max_gain=400)
+		auto.update(frame(TARGET), -30.0)
+		self.assertEqual(auto.update(frame(TARGET), -31.0), (1.0, 0))
+
+	def test_steps(self):
+		steps = [ (1.0, 0), (4.0, 0), (4.0, 120), (1.0, 200), (10.0, 0), (60.0, 0) ]	# 1s at gain 200 is as bright as 10s
+		auto = AutoExposure(3.0, 0, min_exposure=0.001, max_exposure=30.0, min_gain=0, max_gain=400, steps=steps)
+		self.assertEqual(auto.steps, steps[:5])					# 60s is longer than allowed
+		self.assertEqual((auto.exposure, auto.gain), (4.0, 0))		# Started on the nearest
+
+		sky = Sky(auto, TARGET / 4.0 / gain_factor(90))			# Between steps: nearest are 10s and 1s at gain 200
+		sky.settle()
+		self.assertEqual((auto.exposure, auto.gain), (10.0, 0))		# A tie goes to less gain
+		sky.flux = TARGET / 4.0 / gain_factor(110)
+		sky.settle()
+		self.assertEqual((auto.exposure, auto.gain), (4.0, 120))
+		sky.flux = TARGET / 0.9
+		sky.settle()
+		self.assertEqual((auto.exposure, auto.gain), (1.0, 0))
+
+if __name__ == "__main__":
+	unittest.main()
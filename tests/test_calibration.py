@@ -0,0 +1,119 @@
+# Builds a dark library from synthetic dark frames: median stacking (in bands, so a small memory limit gives the same
+# master), finding the master for an exposure, gain and sensor temperature, and subtracting it during capture.
+#
+#	python -m unittest discover -s tests
+
+import os, shutil, tempfile, unittest
+import numpy as np
+import calibration
+from calibration import DarkLibrary, DarkSubtractor
+
+def darks(count, seed=0, shape=(48, 64)):
+	# Dark frames: a fixed pattern of hot pixels plus noise, and a cosmic ray in each one.
+	state = np.random.RandomState(seed)
+	pattern = np.full(shape, 400, np.int32)
+	pattern[::7, ::5] = 30000
+	for n in range(count):
+		frame = pattern + state.randint(-50, 51, shape)
+		frame[state.randint(shape[0]), state.randint(shape[1])] = 65535
+		yield frame.astype(np.uint16)
+
+class Camera(object):
+
+	def __init__(self, id=0, temperature=10.0):
+		self.id = id
+		self.reading = temperature
+
+	def temperature(self):
+		return self.reading
+
+class CalibrationTest(unittest.TestCase):
+
+	def setUp(self):
+		self.folder = tempfile.mkdtemp()
+		self.library = DarkLibrary(os.path.join(self.folder, "darks"))
+		self.max_memory = calibration.MAX_MEMORY
+
+	def tearDown(self):
+		calibration.MAX_MEMORY = self.max_memory
+		shutil.rmtree(self.folder)
+
+	def test_median_stack(self):
+		frames = list(darks(9))
+		entry = self.library.build(iter(frames + frames), 9, 5.0, 300, 10.4)	# Stops after 'count' frames
+		self.assertEqual(entry["file"], "dark_c0_e5.0_g300_t10.npy")
+		self.assertEqual(entry["frames"], 9)
+		master = np.load(os.path.join(self.library.folder, entry["file"]))
+		self.assertEqual(master.dtype, np.uint16)
+		self.assertTrue((master == np.median(frames, axis=0)).all())		# Odd count: no rounding
+		self.assertTrue(master.max() < 31000)							# The cosmic rays are gone
+		self.assertEqual(sorted(os.listdir(self.library.folder)), sorted([ calibration.INDEX_FILE, entry["file"] ]))
+
+		# A band of rows at a time comes to the same thing
+		calibration.MAX_MEMORY = 64 * 9 * 8 * 5 / (1024.0 * 1024.0)			# Five rows
+		entry = self.library.build(iter(frames), 9, 5.0, 300, 10.4)
+		self.assertTrue((np.load(os.path.join(self.library.folder, entry["file"])) == master).all())
+		self.assertEqual(len(self.library.index), 1)					# Replaced, not added again
+
+		self.assertRaises(ValueError, self.library.build, iter([]), 9, 5.0, 300)
+
+	def test_find(self):
+		for temperature in (0.0, 10.0, 20.0):
+			self.library.build(darks(3), 3, 5.0, 300, temperature)
+		self.library.build(darks(3), 3, 10.0, 300, None)
+		self.library.build(darks(3), 3, 5.0, 300, 10.0, camera=1)
+
+		library = DarkLibrary(self.library.folder)						# Read back from the index
+		def found(*args, **kwargs):
+			entry = library.find(*args, **kwargs)
+			return entry and (entry["exposure"], entry["temperature"], entry["camera"])
+		self.assertEqual(found(5.0, 300, 13.0), (5.0, 10.0, 0))
+		self.assertEqual(found(5.0, 300, 16.0), (5.0, 20.0, 0))
+		self.assertEqual(found(5.0, 300, 25.0), (5.0, 20.0, 0))
+		self.assertEqual(found(5.0, 300, 25.1), None)					# More than MAX_TEMPERATURE_DIFF out
+		self.assertEqual(found(5.0, 300, -3.0), (5.0, 0.0, 0))
+		self.assertEqual(found(5.0, 300, 12.0, camera=1), (5.0, 10.0, 1))
+		self.assertEqual(found(5.0, 200, 10.0), None)
+		self.assertEqual(found(6.0, 300, 10.0), None)
+		self.assertEqual(found(10.0, 300, 40.0), (10.0, None, 0))		# No temperature: matches any
+
+		self.assertEqual(library.settings(), [ (5.0, 300), (10.0, 300) ])
+		self.assertEqual(library.settings(temperature=30.0), [ (10.0, 300) ])
+		self.assertEqual(library.settings(camera=1), [ (5.0, 300) ])
+		self.assertTrue(library.master(5.0, 300, 11.0) is library.master(5.0, 300, 9.0))	# Loaded once
+
+	def test_subtract(self):
+		dark = np.array([ [ 100, 200 ], [ 300, 400 ] ], np.uint16)
+		frame = np.array([ [ 150, 100 ], [ 65535, 400 ] ], np.uint16)
+		result = calibration.subtract(frame, dark)
+		self.assertEqual(result.dtype, np.uint16)
+		self.assertEqual(result.tolist(), [ [ 50, 0 ], [ 65235, 0 ] ])
+		self.assertEqual(frame[0, 0], 150)								# A new array
+
+	def test_subtractor(self):
+		self.library.build(darks(5), 5, 5.0, 300, 10.0)
+		self.library.build(darks(5), 5, 10.0, 300, 10.0)
+		camera = Camera(temperature=12.0)
+		subtractor = DarkSubtractor(self.library, camera, 5.0, 300)
+		frame = next(darks(1, seed=7))
+		calibrated = subtractor.apply(frame)
+		self.assertFalse(subtractor.missing)
+		self.assertTrue(calibrated[::7, ::5].max() < 500)				# Hot pixels gone
+		self.assertEqual(subtractor.frames, 1)
+
+		# Not looked up again until the next temperature check, or new settings
+		camera.reading = 30.0
+		subtractor.apply(frame)
+		self.assertFalse(subtractor.missing)
+		subtractor.set_exposure(10.0, 300)
+		self.assertTrue(subtractor.apply(frame) is frame)
+		self.assertTrue(subtractor.missing)							# Too warm now for the 10s master
+
+		camera.reading = 12.0
+		subtractor.set_exposure(5.0, 300)
+		small = frame[:24]
+		self.assertTrue(subtractor.apply(small) is small)				# Wrong size: left alone
+		self.assertEqual(subtractor.frames, 2)
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,93 @@
+# Runs the meteor detector over synthetic frames: sky noise with a few stars, then the same sky with a streak drawn
+# across it, and checks the streak is found where it was drawn and written to events.jsonl with a crop.
+#
+#	python -m unittest discover -s tests
+
+import json, os, shutil, tempfile, unittest
+from datetime import datetime
+import numpy as np
+from PIL import Image
+import meteors
+
+SIZE = 480
+
+def sky(seed):
+	# Sky background with noise, and the same stars every time.
+	frame = np.random.RandomState(seed).normal(40, 3, (SIZE, SIZE))
+	stars = np.random.RandomState(0).randint(0, SIZE, (2, 60))
+	frame[stars[0], stars[1]] = 220
+	return frame.clip(0, 255).astype(np.uint8)
+
+def streak(frame, start, end, width=2, brightness=120):
+	frame = frame.astype(np.int16)
+	for t in np.linspace(0, 1, 2 * SIZE):
+		x = int(round(start[0] + t * (end[0] - start[0])))
+		y = int(round(start[1] + t * (end[1] - start[1])))
+		frame[y - width // 2:y + width // 2 + 1, x - width // 2:x + width // 2 + 1] = 40 + brightness
+	return frame.clip(0, 255).astype(np.uint8)
+
+class MeteorTest(unittest.TestCase):
+
+	def setUp(self):
+		self.capture_dir = tempfile.mkdtemp()
+		self.detector = meteors.MeteorDetector(self.capture_dir, max_queue=10)
+
+	def tearDown(self):
+		self.detector.stop()
+		shutil.rmtree(self.capture_dir)
+
+	def run_frames(self, frames):
+		for n, frame in enumerate(frames):
+			self.assertTrue(self.detector.add(frame, n + 1, datetime(2024, 3, 1, 2, 0, n)))
+		return self.detector.stop()
+
+	def events(self):
+		path = os.path.join(self.capture_dir, meteors.EVENTS_FILE)
+		if not os.path.exists(path):
+			return []
+		with open(path, 'r') as f:
+			return [ json.loads(line) for line in f ]
+
+	def test_streak(self):
+		start, end = (100, 120), (380, 300)
+		stats = self.run_frames([ sky(1), sky(2), sky(3), streak(sky(4), start, end), sky(5) ])
+		self.assertEqual((stats["checked"], stats["events"], stats["skipped"]), (5, 1, 0))
+		self.assertEqual(self.detector.failed, [])
+
+		event, = self.events()
+		self.assertEqual(event["frame"], 4)
+		self.assertEqual(event["time"], "2024-03-01T02:00:03")
+		found = sorted([ tuple(event["start"]), tuple(event["end"]) ])
+		for (x, y), (x0, y0) in zip(found, [ start, end ]):
+			self.assertTrue(abs(x - x0) <= 8 and abs(y - y0) <= 8, (found, start, end))
+		self.assertAlmostEqual(event["length"], np.hypot(280, 180), delta=16)
+
+		# The crop is the streak plus a margin all round
+		self.assertEqual(event["crop"], meteors.CROP_PREFIX + "00004_0.jpg")
+		width, height = Image.open(os.path.join(self.capture_dir, event["crop"])).size
+		self.assertAlmostEqual(width, 280 + 2 * meteors.CROP_MARGIN, delta=16)
+		self.assertAlmostEqual(height, 180 + 2 * meteors.CROP_MARGIN, delta=16)
+
+	def test_nothing_new(self):
+		stats = self.run_frames([ sky(n) for n in range(6) ])
+		self.assertEqual((stats["checked"], stats["events"], stats["crowded"]), (6, 0, 0))
+		self.assertEqual(self.events(), [])
+
+	def test_crowded_frame_is_not_searched(self):
+		cloud = sky(4)
+		cloud[:SIZE // 3] += 80										# Too much of the frame to search, too little to raise the noise
+		stats = self.run_frames([ sky(1), sky(2), sky(3), streak(cloud, (100, 120), (380, 300)) ])
+		self.assertEqual((stats["events"], stats["crowded"]), (0, 1))
+
+	def test_find_lines(self):
+		xs = np.arange(10, 40)
+		lines = meteors.find_lines(np.concatenate((xs, [ 5, 60, 33 ])), np.concatenate((xs + 5, [ 50, 3, 70 ])))
+		(x1, y1), (x2, y2), points = lines[0]
+		self.assertEqual(sorted([ (x1, y1), (x2, y2) ]), [ (10, 15), (39, 44) ])
+		self.assertEqual(points, 30)
+
+		gappy = np.concatenate((np.arange(0, 8), np.arange(30, 38)))	# Two short dashes aren't a streak
+		self.assertEqual(meteors.find_lines(gappy, gappy), [])
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,89 @@
+# Runs the last seconds of a night through start_capture() with two simulated cameras on a virtual clock, checking
+# that each camera gets its own subfolder, manifest and capture_settings.json.
+#
+#	python -m unittest discover -s tests
+
+import json, os, shutil, tempfile, unittest
+from datetime import datetime, timedelta
+import pytz
+import sky_capture, skycam, skylog, sunpos, clock, manifest
+
+LATITUDE = 45.0
+LONGITUDE = -75.0
+
+class TwoCameraTest(unittest.TestCase):
+
+	def setUp(self):
+		self.folder = tempfile.mkdtemp()
+		self.saved_cache = sunpos.CACHE_DIR
+		sunpos.CACHE_DIR = self.folder
+		sunpos._tables.clear()
+		skylog.configure(echo=False)
+
+		sky_capture.BASEDIR = os.path.join(self.folder, "images", "")
+		os.makedirs(sky_capture.BASEDIR)
+		sky_capture.LOCALTZ = pytz.utc								# Only used to format times in the log
+		sky_capture.LATITUDE = LATITUDE
+		sky_capture.LONGITUDE = LONGITUDE
+		sky_capture.EXPOSURE_TIME = 1.0
+		sky_capture.GAIN = 100
+		sky_capture.GAMMA = 50
+		sky_capture.WAIT_BETWEEN = 0
+		sky_capture.CADENCE = 1.0
+		sky_capture.FILE_EXT = ".jpg"
+		sky_capture.CLEAN_UP = False
+		sky_capture.ARCHIVE_INDEX = False
+		sky_capture.USE_PUSHOVER = False
+		sky_capture.CAMERAS = [ { "id": 0, "name": "camera0" }, { "id": 1, "name": "camera1", "gain": 200 } ]
+		for n in range(2):
+			sky_capture.OPEN_CAMERAS[n] = skycam.open_camera(n, True, "camera" + str(n), width=64, height=48, readout=0.0,
+															 time_scale=0.0)
+
+		# Start the virtual clock 20 s before the end of the night, so there's only 20 s (2 s at 10x) to capture:
+		start, self.end = sunpos.twilight_time(sky_capture.NAUTICAL, LATITUDE, LONGITUDE, pytz.utc.localize(datetime(2024, 3, 1, 12)))
+		self.night_dir = sky_capture.BASEDIR + start.strftime("%Y%m%d") + "/"
+		clock.install(clock.VirtualClock(self.end - timedelta(seconds=20), 10))
+
+	def tearDown(self):
+		clock.install(clock.Clock())
+		skylog.close()
+		skylog.configure(echo=True)
+		sky_capture.CAMERAS = []
+		sky_capture.OPEN_CAMERAS.clear()
+		sunpos.CACHE_DIR = self.saved_cache
+		sunpos._tables.clear()
+		shutil.rmtree(self.folder)
+
+	def read_json(self, path):
+		with open(path, 'r') as f:
+			return json.load(f)
+
+	def test_each_camera_gets_its_own_folder(self):
+		self.assertEqual(sky_capture.start_capture(sky_capture.NAUTICAL), self.night_dir)
+		folders = sky_capture.capture_folders(self.night_dir)
+		self.assertEqual(folders, [ self.night_dir + "camera0/", self.night_dir + "camera1/" ])
+
+		total = 0
+		for n, folder in enumerate(folders):
+			rows = manifest.read(folder)
+			self.assertGreater(len(rows), 10)
+			self.assertEqual([ int(row["index"]) for row in rows ], range(1, len(rows) + 1))
+			for row in rows:
+				self.assertTrue(os.path.isfile(folder + row["filename"]))
+			self.assertEqual(sorted(x for x in os.listdir(folder) if x.endswith(".jpg")), [ row["filename"] for row in rows ])
+
+			settings = self.read_json(folder + "capture_settings.json")
+			self.assertEqual(settings["camera"], "camera" + str(n))
+			self.assertEqual(settings["camera_id"], n)
+			self.assertEqual(settings["gain"], [ 100, 200 ][n])
+			self.assertEqual(settings["cadence"], 1.0)
+			self.assertEqual(settings["frames"], len(rows))
+			total += len(rows)
+
+		settings = self.read_json(self.night_dir + "capture_settings.json")
+		self.assertEqual(settings["cameras"], [ "camera0", "camera1" ])
+		self.assertEqual(settings["frames"], total)
+		self.assertFalse(manifest.exists(self.night_dir))		# Frames only go in the camera folders
+
+if __name__ == "__main__":
+	unittest.main()
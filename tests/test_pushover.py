@@ -0,0 +1,117 @@
+# Runs the Pushover client against a local HTTP stand-in for the API: coalescing, backing off on 429 and 5xx
+# responses, and carrying undelivered alerts over a restart in the queue file.
+#
+#	python -m unittest discover -s tests
+
+import json, os, shutil, tempfile, threading, time, unittest, urlparse
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+import pushover
+
+class StandIn(BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1"							# Keep-alive, like the real API
+
+	def do_POST(self):
+		body = self.rfile.read(int(self.headers["Content-Length"]))
+		server = self.server
+		server.requests.append((time.time(), dict(urlparse.parse_qsl(body))))
+		status = server.statuses.pop(0) if server.statuses else server.default_status
+		reply = json.dumps({ "status": 1 if status == 200 else 0 })
+		self.send_response(status)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(reply)))
+		self.end_headers()
+		self.wfile.write(reply)
+
+	def log_message(self, *args):
+		pass
+
+class Server(ThreadingMixIn, HTTPServer):
+	daemon_threads = True									# Don't wait for the client's kept-alive connection
+
+class PushoverTest(unittest.TestCase):
+
+	def setUp(self):
+		self.folder = tempfile.mkdtemp()
+		self.queue_file = os.path.join(self.folder, "pushover_queue.json")
+		self.server = Server(("127.0.0.1", 0), StandIn)
+		self.server.requests = []
+		self.server.statuses = []
+		self.server.default_status = 200
+		self.thread = threading.Thread(target=self.server.serve_forever)
+		self.thread.daemon = True
+		self.thread.start()
+		pushover.PO_TOKEN = "app"
+		pushover.PO_USER = "user"
+		pushover._conn = None
+		pushover.configure(host="127.0.0.1", port=self.server.server_address[1], https=False, queue_file=self.queue_file,
+						   coalesce_window=0.3, retry_wait=0.2)
+
+	def tearDown(self):
+		pushover.shutdown()
+		if pushover._conn is not None:
+			pushover._conn.close()
+			pushover._conn = None
+		self.server.shutdown()
+		self.server.server_close()
+		shutil.rmtree(self.folder)
+
+	def test_alerts_close_together_are_coalesced(self):
+		pushover.sendPushoverAlert("One", "first")
+		pushover.sendPushoverAlert("Two", "second", priority=0)
+		pushover.sendPushoverAlert("Three", "third")
+		self.assertTrue(pushover.flush(10))
+		self.assertEqual(len(self.server.requests), 1)
+		sent = self.server.requests[0][1]
+		self.assertEqual(sent["title"], "One (+2 more)")
+		self.assertEqual(sent["message"], "One: first\n\nTwo: second\n\nThree: third")
+		self.assertEqual(sent["priority"], "0")
+		self.assertEqual((sent["token"], sent["user"]), ("app", "user"))
+		self.assertFalse(os.path.exists(self.queue_file))
+
+	def test_backs_off_on_rate_limit_and_server_errors(self):
+		self.server.statuses = [ 429, 503, 200 ]
+		pushover.sendPushoverAlert("Title", "message")
+		self.assertTrue(pushover.flush(10))
+		times = [ x[0] for x in self.server.requests ]
+		self.assertEqual(len(times), 3)
+		self.assertGreaterEqual(times[1] - times[0], 0.2)
+		self.assertGreaterEqual(times[2] - times[1], 0.4)		# Twice as long the second time
+		self.assertEqual(pushover.last_error, "Pushover API returned 503")
+
+	def test_flush_waits_for_each_alert(self):
+		pushover.configure(coalesce_window=0)
+		for n in range(20):
+			pushover.sendPushoverAlert("Alert " + str(n), "message")
+			self.assertTrue(pushover.flush(10))
+			self.assertEqual(len(self.server.requests), n + 1)
+		self.assertEqual(pushover.undelivered(), 0)
+
+	def test_rejected_alerts_are_dropped(self):
+		self.server.statuses = [ 400 ]
+		pushover.sendPushoverAlert("Bad", "message")
+		self.assertTrue(pushover.flush(10))
+		self.assertEqual(len(self.server.requests), 1)
+		self.assertFalse(os.path.exists(self.queue_file))
+
+	def test_undelivered_alerts_are_sent_after_a_restart(self):
+		# Nothing gets through before shutdown, so the alert is saved...
+		self.server.default_status = 503
+		pushover.sendPushoverAlert("Saved", "for later")
+		deadline = time.time() + 10
+		while not self.server.requests and time.time() < deadline:
+			time.sleep(0.05)
+		pushover.shutdown()
+		with open(self.queue_file, 'r') as f:
+			self.assertEqual([ x["title"] for x in json.load(f) ], [ "Saved" ])
+
+		# ...and goes out, ahead of anything new, once the thread starts again.
+		self.server.default_status = 200
+		del self.server.requests[:]
+		pushover.sendPushoverAlert("New", "alert")
+		self.assertTrue(pushover.flush(10))
+		self.assertEqual([ x[1]["title"] for x in self.server.requests ], [ "Saved", "New" ])
+		self.assertFalse(os.path.exists(self.queue_file))
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,112 @@
+# Builds a few night folders and checks what retention does to them: expiry, then pruning and deleting in the right
+# order (uploaded nights first, raw frames before products), never touching tonight, with and without the archive
+# index.
+#
+#	python -m unittest discover -s tests
+
+import os, shutil, tempfile, unittest
+from datetime import datetime
+import archive, manifest, retention, uploader
+
+def touch(path, size=8192):
+	with open(path, 'wb') as f:
+		f.write(b"x" * size)
+
+class RetentionTest(unittest.TestCase):
+
+	TONIGHT = "20240319"
+	TODAY = datetime(2024, 3, 20, 9, 0)
+
+	def setUp(self):
+		self.base_dir = tempfile.mkdtemp() + "/"
+		self.make_night("20240301", uploaded=True)
+		self.make_night("20240310", uploaded=True)
+		self.make_night("20240311", uploaded=False)
+		self.make_night("20240312", uploaded=True)
+		self.make_night(self.TONIGHT, uploaded=False)
+
+	def tearDown(self):
+		shutil.rmtree(self.base_dir)
+
+	def make_night(self, night, uploaded):
+		path = self.base_dir + night + "/"
+		os.makedirs(path)
+		names = [ "00001.jpg", "00002.jpg", "00003.jpg", "capture_log_" + night + ".log" ]
+		for name in names:
+			touch(path + name)
+		if uploaded:
+			with open(path + uploader.STATE_FILE, 'w') as f:
+				f.write("\n".join(names) + "\n")
+
+	def files(self, night):
+		path = self.base_dir + night
+		return sorted(os.listdir(path)) if os.path.isdir(path) else None
+
+	def test_expired_nights_go_but_never_tonight(self):
+		actions = retention.Retention(self.base_dir, days_to_keep=9).enforce(self.TONIGHT, self.TODAY)
+		self.assertEqual([ x[:2] for x in actions ], [ ("20240301", "expired"), ("20240310", "expired"), ("20240311", "expired") ])
+		self.assertEqual(self.files("20240301"), None)
+
+		actions = retention.Retention(self.base_dir, days_to_keep=0).enforce(self.TONIGHT, self.TODAY)
+		self.assertEqual([ x[0] for x in actions ], [ "20240312" ])
+		self.assertEqual(len(self.files(self.TONIGHT)), 4)
+
+	def test_eviction_order(self):
+		actions = retention.Retention(self.base_dir, max_bytes=0).enforce(self.TONIGHT, self.TODAY)
+		self.assertEqual([ x[:2] for x in actions ], [
+			("20240301", "raw frames removed"),
+			("20240310", "raw frames removed"),
+			("20240312", "raw frames removed"),
+			("20240311", "raw frames removed before upload"),
+			("20240301", "deleted"),
+			("20240310", "deleted"),
+			("20240312", "deleted"),
+			("20240311", "deleted before upload") ])
+		self.assertEqual(actions[0][2], 3 * 8192)				# Just the frames...
+		self.assertTrue(0 < actions[4][2] < 3 * 8192)			# ...then what was left
+		self.assertEqual(sorted(os.listdir(self.base_dir)), [ self.TONIGHT, retention.INDEX_FILE ])
+		self.assertEqual(len(self.files(self.TONIGHT)), 4)
+
+	def test_pruning_stops_once_under_budget(self):
+		budget = retention.Retention(self.base_dir).scan(self.TONIGHT)
+		total = sum(x["raw_bytes"] + x["summary_bytes"] for x in budget.values())
+		actions = retention.Retention(self.base_dir, max_bytes=total - 1).enforce(self.TONIGHT, self.TODAY)
+		self.assertEqual([ x[:2] for x in actions ], [ ("20240301", "raw frames removed") ])
+		self.assertEqual(self.files("20240301"), [ manifest.SKIP_FILE, "capture_log_20240301.log", uploader.STATE_FILE ])
+
+	def test_check_counts_frames_as_they_are_added(self):
+		keep = retention.Retention(self.base_dir, max_bytes=10 ** 9)
+		self.assertEqual(keep.check(self.TONIGHT), [])
+		total = keep.total_bytes()
+
+		# No more scanning: a new frame only counts once it's added
+		touch(self.base_dir + self.TONIGHT + "/00004.jpg")
+		keep.max_bytes = total
+		self.assertEqual(keep.check(self.TONIGHT), [])
+		keep.add(self.TONIGHT, self.base_dir + self.TONIGHT + "/00004.jpg")
+		self.assertEqual(keep.total_bytes(), total + 8192)
+		self.assertEqual([ x[:2] for x in keep.check(self.TONIGHT) ], [ ("20240301", "raw frames removed") ])
+
+	def test_archive_index(self):
+		index = archive.open_index(self.base_dir)				# Imports the nights that are already there
+		shutil.rmtree(self.base_dir + "20240312")				# Gone behind our back
+		keep = retention.Retention(self.base_dir, days_to_keep=15, archive=index)
+		actions = keep.enforce(self.TONIGHT, self.TODAY)
+		self.assertEqual([ x[:2] for x in actions ], [ ("20240301", "expired") ])
+		self.assertFalse(os.path.exists(self.base_dir + retention.INDEX_FILE))
+		self.assertEqual(index.nights(), [ "20240310", "20240311", self.TONIGHT ])
+		self.assertEqual(index.nights("deleted"), [ "20240301", "20240312" ])
+
+		sizes = retention.Retention(self.base_dir, archive=index).index	# Sizes are kept in the index
+		self.assertEqual(sorted(sizes), [ "20240310", "20240311", self.TONIGHT ])
+		self.assertEqual(sizes["20240310"]["raw_bytes"], 3 * 8192)
+		self.assertTrue(sizes["20240310"]["uploaded"])
+		self.assertFalse(sizes["20240311"]["uploaded"])
+
+		keep.max_bytes = 0
+		keep.enforce(self.TONIGHT, self.TODAY)
+		self.assertEqual(index.nights("pruned"), [])				# Pruned, then deleted
+		self.assertEqual(index.nights(), [ self.TONIGHT ])
+
+if __name__ == "__main__":
+	unittest.main()
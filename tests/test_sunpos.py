@@ -0,0 +1,83 @@
+# Checks the ephemeris table in sunpos against the ephem solver it replaced, around the high-latitude dates where a
+# twilight phase stops or starts happening each year - the nights where it's easiest to pick the wrong one.
+#
+# The solver stops within 0.1 s of each time, so times worked out from the start of the night (as the table does)
+# and from the time asked about (as the old code did) can come out either side of a whole second.  They're allowed
+# to differ by a second.
+#
+#	python -m unittest discover -s tests
+
+import os, shutil, tempfile, unittest
+from datetime import datetime, timedelta
+from math import pi
+import ephem, pytz
+import sunpos
+
+def old_twilight_time(twilight, lat, lon, date):
+	# sunpos.twilight_time() before the ephemeris table, less its warnings.  'date' is naive UTC.
+	sun = ephem.Sun()
+	o = ephem.Observer()
+	o.lat = lat*pi/180
+	o.lon = lon*pi/180
+	o.date = date
+	o.horizon = sunpos.TWILIGHT[twilight]*pi/180
+	try:
+		start = o.next_setting(sun)
+		end = o.next_rising(sun)
+		if start > end:
+			start = o.previous_setting(sun)
+		start = ephem.localtime(start).replace(microsecond=0)
+		end = ephem.localtime(end).replace(microsecond=0)
+	except ephem.AlwaysUpError:
+		start = None
+		end = None
+	return [start, end]
+
+# (latitude, longitude, phase, a date the phase comes back or goes away)
+SEASON_EDGES = [
+	(53.5, -113.5, 3, datetime(2026, 7, 30)),
+	(53.5, -113.5, 3, datetime(2026, 5, 14)),
+	(69.6, 18.9, 0, datetime(2026, 7, 25)),
+	(69.6, 18.9, 0, datetime(2026, 5, 18)),
+	(69.6, 18.9, 1, datetime(2026, 8, 6)),
+	(69.6, 18.9, 2, datetime(2026, 8, 25)),
+	(60.0, 25.0, 3, datetime(2026, 8, 1)),
+]
+
+class SeasonEdgeTest(unittest.TestCase):
+
+	def setUp(self):
+		self.cache_dir = tempfile.mkdtemp()
+		self.saved = sunpos.CACHE_DIR
+		sunpos.CACHE_DIR = self.cache_dir
+		sunpos._tables.clear()
+
+	def tearDown(self):
+		sunpos.CACHE_DIR = self.saved
+		sunpos._tables.clear()
+		shutil.rmtree(self.cache_dir)
+
+	def test_matches_old_solver(self):
+		for lat, lon, phase, edge in SEASON_EDGES:
+			for hour in range(-4 * 24, 4 * 24, 1):
+				date = edge + timedelta(hours=hour, minutes=7)
+				expected = old_twilight_time(phase, lat, lon, date)
+				actual = sunpos.twilight_time(phase, lat, lon, pytz.utc.localize(date))
+				message = "%s, %s phase %d at %s UTC: %s, expected %s" % (lat, lon, phase, date, actual, expected)
+				if expected[0] is None:
+					self.assertEqual(actual, expected, message)
+					continue
+				self.assertIsNotNone(actual[0], message)
+				for time, old_time in zip(actual, expected):
+					self.assertLessEqual(abs((time - old_time).total_seconds()), 1, message)
+
+	def test_upcoming_sessions_start_with_tonight(self):
+		for lat, lon, phase, edge in SEASON_EDGES:
+			for hour in range(-2 * 24, 2 * 24, 3):
+				date = pytz.utc.localize(edge + timedelta(hours=hour))
+				sessions = sunpos.upcoming_sessions(3, phase, lat, lon, date)
+				self.assertEqual(len(sessions), 3)
+				self.assertEqual(sessions[0], sunpos.twilight_time(phase, lat, lon, date))
+
+if __name__ == "__main__":
+	unittest.main()
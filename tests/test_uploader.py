@@ -0,0 +1,127 @@
+# Uploads to a local directory (an empty server name), checking that uploaded.txt carries over a restart, that the
+# previews go too, and that the night folder's own files follow the cameras' on a night with several.
+#
+#	python -m unittest discover -s tests
+
+import os, shutil, tempfile, unittest
+from datetime import datetime
+from distutils.spawn import find_executable
+import uploader, manifest, sky_capture, skylog
+
+def touch(path, text="x"):
+	with open(path, 'w') as f:
+		f.write(text)
+
+@unittest.skipUnless(find_executable("rsync"), "needs rsync")
+class LocalUploadTest(unittest.TestCase):
+
+	def setUp(self):
+		self.folder = tempfile.mkdtemp()
+		self.night_dir = os.path.join(self.folder, "images", "20240301")
+		self.remote = os.path.join(self.folder, "remote")
+		os.makedirs(self.night_dir)
+		for n in range(1, 5):
+			touch(os.path.join(self.night_dir, "%05d.jpg" % n))
+
+	def tearDown(self):
+		shutil.rmtree(self.folder)
+
+	def sent(self):
+		night = os.path.join(self.remote, "20240301")
+		return sorted(os.listdir(night)) if os.path.isdir(night) else []
+
+	def state(self):
+		with open(os.path.join(self.night_dir, uploader.STATE_FILE), 'r') as f:
+			return [ line.strip() for line in f ]
+
+	def test_frames_during_capture(self):
+		up = uploader.Uploader(self.night_dir, "", self.remote, batch_size=2, batch_wait=60).start()
+		self.assertEqual(up.destination(), self.remote + "/20240301/")
+		for name in ("00001.jpg", "00002.jpg", "00003.jpg"):
+			up.add(name)
+		self.assertTrue(up.flush())
+		up.close()
+		self.assertEqual(self.sent(), [ "00001.jpg", "00002.jpg", "00003.jpg" ])
+		self.assertEqual(sorted(self.state()), [ "00001.jpg", "00002.jpg", "00003.jpg" ])
+
+	def test_restart_picks_up_where_it_left_off(self):
+		up = uploader.Uploader(self.night_dir, "", self.remote).start()
+		up.add("00001.jpg")
+		up.add("00002.jpg")
+		up.close()
+
+		# Start again, as after a crash.  Whatever was confirmed is never sent again, even if it's gone from the other end.
+		os.remove(os.path.join(self.remote, "20240301", "00001.jpg"))
+		touch(os.path.join(self.night_dir, "capture_log.log"))
+		touch(os.path.join(self.night_dir, "star_trails.npy"))
+		up = uploader.Uploader(self.night_dir, "", self.remote).start()
+		self.assertEqual(up.uploaded, set([ "00001.jpg", "00002.jpg" ]))
+		up.add("00001.jpg")
+		up.add("00003.jpg")
+		up.close()
+		self.assertEqual(self.sent(), [ "00002.jpg", "00003.jpg" ])
+
+		# The end of the night sends the rest, but not the working files or uploaded.txt.  Logs always go again.
+		up = uploader.Uploader(self.night_dir, "", self.remote)
+		self.assertEqual(up.finish(), 2)
+		self.assertEqual(self.sent(), [ "00002.jpg", "00003.jpg", "00004.jpg", "capture_log.log" ])
+		self.assertEqual(up.finish(), 1)
+		self.assertEqual(self.state().count("00001.jpg"), 1)
+
+	def test_previews_are_sent_at_the_end(self):
+		os.makedirs(os.path.join(self.night_dir, "preview_2"))
+		touch(os.path.join(self.night_dir, "preview_2", "00001.jpg"))
+		touch(os.path.join(self.night_dir, "preview_2", ".00002.jpg.tmp"))	# Still being written
+		up = uploader.Uploader(self.night_dir, "", self.remote)
+		self.assertEqual(up.finish(), 5)
+		self.assertEqual(sorted(os.listdir(os.path.join(self.remote, "20240301", "preview_2"))), [ "00001.jpg" ])
+		self.assertIn("preview_2/00001.jpg", self.state())
+
+		up = uploader.Uploader(self.night_dir, "", self.remote)
+		self.assertEqual(up.finish(), 0)
+
+
+@unittest.skipUnless(find_executable("rsync"), "needs rsync")
+class SeveralCamerasTest(unittest.TestCase):
+
+	def setUp(self):
+		self.folder = tempfile.mkdtemp()
+		self.remote = os.path.join(self.folder, "remote")
+		self.saved = dict((x, getattr(sky_capture, x)) for x in ("BASEDIR", "REMOTE_SERVER", "REMOTE_PATH", "ARCHIVE_INDEX"))
+		sky_capture.BASEDIR = os.path.join(self.folder, "images", "")
+		sky_capture.REMOTE_SERVER = ""
+		sky_capture.REMOTE_PATH = self.remote
+		sky_capture.ARCHIVE_INDEX = False
+		skylog.configure(echo=False)
+
+		self.night_dir = sky_capture.BASEDIR + "20240301/"
+		for camera in ("camera0", "camera1"):
+			folder = self.night_dir + camera + "/"
+			os.makedirs(folder)
+			frames = manifest.Manifest(folder)
+			for n in range(1, 3):
+				touch(folder + frames.next_filename())
+				frames.add(datetime(2024, 3, 1, 22, 0, n), 1.0, 100, frames.next_filename())
+			frames.close()
+		touch(self.night_dir + "capture_log_20240301.log")
+		touch(self.night_dir + "capture_settings.json", "{}")
+
+	def tearDown(self):
+		skylog.close()
+		skylog.configure(echo=True)
+		for name, value in self.saved.items():
+			setattr(sky_capture, name, value)
+		shutil.rmtree(self.folder)
+
+	def test_night_folder_files_follow_the_cameras(self):
+		sky_capture.process_night(self.night_dir)
+		night = os.path.join(self.remote, "20240301")
+		self.assertEqual(sorted(os.listdir(night)), [ "camera0", "camera1", "capture_log_20240301.log", "capture_settings.json" ])
+		for camera in ("camera0", "camera1"):
+			self.assertEqual(sorted(os.listdir(os.path.join(night, camera))),
+							 [ "00001.jpg", "00002.jpg", "file_info.json", "manifest.csv" ])
+		with open(self.night_dir + uploader.STATE_FILE, 'r') as f:
+			self.assertEqual(sorted(line.strip() for line in f), [ "capture_log_20240301.log", "capture_settings.json" ])
+
+if __name__ == "__main__":
+	unittest.main()
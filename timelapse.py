@@ -0,0 +1,271 @@
+# Timelapse encoding with ffmpeg.
+#
+# TimelapseStream keeps one ffmpeg process open for the whole night and pipes each frame into it as raw video while
+# it is being captured, so the timelapse is finished a few seconds after capture ends instead of being built from
+# the JPEGs the next morning.
+#
+# encode() builds the timelapse from a finished night.  The frames are split into segments that are encoded at the
+# same time, one ffmpeg each, so decoding the frames (which ffmpeg does on a single core) is spread over all of them.
+# The segments are then joined with the concat demuxer, copying the video rather than encoding it again.
+#
+# Either way, every rendition in the "timelapse_renditions" setting (e.g. a 4K master and a 720p web version) comes
+# out of the same ffmpeg: each frame is decoded once, then split, scaled and encoded for each rendition.  A rendition
+# is a dictionary with:
+#
+#	"name"		=	output file name, without the extension ('timelapse' for timelapse.mp4)
+#	"size"		=	frame size, as understood by ffmpeg ('hd1080', 'hd720', '3840x2160', ...)
+#	"codec"		=	video codec, default 'h264'
+#	"crf"		=	constant quality setting for the codec (optional)
+#	"preset"	=	encoder speed preset (optional)
+
+import subprocess, os
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+import numpy as np
+from workers import WorkerPool
+
+# ffmpeg pixel formats for the frame types the camera gives us
+PIXEL_FORMATS = { (np.dtype(np.uint8), 3): "rgb24",
+				  (np.dtype(np.uint8), 1): "gray",
+				  (np.dtype(np.uint16), 1): "gray16le" }
+
+DEFAULT_RENDITIONS = [ { "name": "timelapse", "size": "hd1080", "codec": "h264" } ]
+EXTENSION = ".mp4"
+MIN_SEGMENT = 50											# Frames - shorter segments aren't worth an ffmpeg of their own
+
+class TimelapseStream(object):
+
+	def __init__(self, folder, rate=25, renditions=None, max_queue=8):
+		# 'folder'	=	Where the videos go.  We encode to temporary files and rename them once ffmpeg finishes cleanly.
+		# 'rate'	=	Frame rate of the videos
+		self.outputs = [ os.path.join(folder, x) for x in output_names(renditions) ]
+		self.output = self.outputs[0]
+		self.temp_outputs = [ part_name(x) for x in self.outputs ]
+		self.rate = rate
+		self.renditions = renditions or DEFAULT_RENDITIONS
+		self.process = None
+		self.stderr_log = None
+		self.shape = None
+		self.frames = 0
+		self.failed = False
+		self.error = None
+		self.pool = WorkerPool(self._feed, 1, max_queue, "timelapse", self._fail).start()
+
+	def write(self, frame):
+		# Queue a frame for the encoder.  Returns False once the encoder has failed, so the caller can fall back to
+		# building the timelapse from the saved frames.
+		if self.failed:
+			return False
+		self.pool.put(frame)
+		return True
+
+	def close(self):
+		# Finish the videos.  Returns True if every rendition was written successfully.
+		self.pool.stop()
+		if self.process is not None:
+			try:
+				self.process.stdin.close()
+			except IOError:
+				pass
+			if self.process.wait() != 0 and not self.failed:
+				self._fail(None, RuntimeError("ffmpeg exited with status " + str(self.process.returncode)))
+			self.stderr_log.close()
+
+		if self.failed or self.frames == 0:
+			for temp_output in self.temp_outputs:
+				if os.path.exists(temp_output):
+					os.remove(temp_output)
+			return False
+		for temp_output, output in zip(self.temp_outputs, self.outputs):
+			os.rename(temp_output, output)
+		return True
+
+	def _start(self, frame):
+		self.shape = frame.shape
+		cmd = [ 'ffmpeg', '-y', '-loglevel', 'error' ] + raw_input_args(frame, self.rate)
+		cmd += output_args(self.renditions, self.temp_outputs, self.rate)
+		self.stderr_log = open(os.path.splitext(self.output)[0] + "_ffmpeg.log", 'w')
+		self.process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stderr=self.stderr_log)
+
+	def _feed(self, frame):
+		if self.failed:
+			return
+		if self.process is None:
+			self._start(frame)
+		if frame.shape != self.shape:
+			raise ValueError("Frame size changed from " + str(self.shape) + " to " + str(frame.shape))
+		self.process.stdin.write(np.ascontiguousarray(frame).tostring())
+		self.frames += 1
+
+	def _fail(self, frame, error):
+		# The encoder died (or we couldn't start it) - stop feeding it and leave the batch path to build the video.
+		self.failed = True
+		self.error = str(error)
+		if self.process is not None and self.process.poll() is None:
+			self.process.kill()
+
+
+class FileFrames(object):
+	# Frames saved as image files, in capture order, for encode().
+
+	pipe = False
+
+	def __init__(self, folder, files, rate):
+		self.folder = folder
+		self.files = files
+		self.rate = rate
+
+	def __len__(self):
+		return len(self.files)
+
+	def input_args(self, name, start, end):
+		# Each segment reads its frames from its own concat demuxer list.
+		path = os.path.join(self.folder, name + ".txt")
+		duration = 1.0 / float(self.rate)
+		with open(path, 'w') as f:
+			f.write("ffconcat version 1.0\n")
+			for filename in self.files[start:end]:
+				f.write("file '" + filename + "'\n")
+				f.write("duration " + str(duration) + "\n")
+		return [ '-f', 'concat', '-safe', '0', '-i', os.path.basename(path) ]
+
+
+class StoreFrames(object):
+	# Raw frames from a framestore.FrameStore, piped into ffmpeg - no image files needed.
+
+	pipe = True
+
+	def __init__(self, store, rate):
+		self.store = store
+		self.rate = rate
+
+	def __len__(self):
+		return len(self.store)
+
+	def input_args(self, name, start, end):
+		return raw_input_args(self.store.frame(start), self.rate)
+
+	def feed(self, stdin, start, end):
+		# A chunk at a time, so each chunk file is only opened once.
+		n = start
+		while n < end:
+			chunk_index, offset = divmod(n, self.store.chunk_frames)
+			first = chunk_index * self.store.chunk_frames
+			for frame in self.store.read_chunk(chunk_index)[offset:end - first]:
+				stdin.write(np.ascontiguousarray(frame).tostring())
+			n = first + self.store.chunk_frames
+
+
+def encode(folder, frames, rate=25, renditions=None, segments=None):
+	# Builds every rendition of the timelapse in 'folder' from 'frames' (FileFrames or StoreFrames), encoding up to
+	# 'segments' parts at once (default: one per core).  Returns the output file names.  Raises RuntimeError if
+	# ffmpeg fails, leaving any existing videos alone.
+	renditions = renditions or DEFAULT_RENDITIONS
+	names = output_names(renditions)
+	ranges = segment_ranges(len(frames), segments or cpu_count())
+	if not ranges:
+		raise RuntimeError("No frames to encode")
+	work = []
+	try:
+		if len(ranges) == 1:							# Nothing to join - encode straight to the outputs
+			outputs = [ part_name(x) for x in names ]
+			work += outputs
+			_encode_segment(folder, frames, "timelapse.part", ranges[0], renditions, outputs, rate, work)
+		else:
+			segment_outputs = [ [ part_name(x, n) for x in names ] for n in range(len(ranges)) ]
+			for outputs in segment_outputs:
+				work += outputs
+			pool = ThreadPool(len(ranges))
+			try:
+				pool.map(lambda n: _encode_segment(folder, frames, "timelapse.part." + str(n), ranges[n], renditions,
+												   segment_outputs[n], rate, work), range(len(ranges)))
+			finally:
+				pool.close()
+				pool.join()
+			for i, name in enumerate(names):
+				parts = [ outputs[i] for outputs in segment_outputs ]
+				work.append(part_name(name))
+				_join(folder, parts, part_name(name), work)
+		for name in names:
+			os.rename(os.path.join(folder, part_name(name)), os.path.join(folder, name))
+	finally:
+		for filename in work:
+			path = os.path.join(folder, filename)
+			if os.path.exists(path):
+				os.remove(path)
+	return names
+
+def _encode_segment(folder, frames, name, span, renditions, outputs, rate, work):
+	start, end = span
+	work.append(name + ".txt")
+	cmd = [ 'ffmpeg', '-y', '-loglevel', 'error' ] + frames.input_args(name, start, end)
+	cmd += output_args(renditions, outputs, rate)
+	log_file = os.path.join(folder, name + "_ffmpeg.log")
+	with open(log_file, 'w') as log:
+		process = subprocess.Popen(cmd, cwd=folder, stdin=subprocess.PIPE if frames.pipe else None, stderr=log)
+		if frames.pipe:
+			try:
+				frames.feed(process.stdin, start, end)
+				process.stdin.close()
+			except IOError:									# ffmpeg gave up - its exit status says why
+				pass
+		status = process.wait()
+	if status != 0:
+		with open(log_file, 'r') as log:
+			message = log.read().strip().splitlines()
+		raise RuntimeError("ffmpeg returned " + str(status) + " for frames " + str(start + 1) + "-" + str(end) +
+						   (": " + message[-1] if message else ""))
+	work.append(os.path.basename(log_file))					# Only kept if something went wrong
+
+def _join(folder, parts, output, work):
+	# Joins the segments of one rendition, copying the video stream as it is.
+	list_file = output + ".txt"
+	work.append(list_file)
+	with open(os.path.join(folder, list_file), 'w') as f:
+		f.write("ffconcat version 1.0\n")
+		for part in parts:
+			f.write("file '" + part + "'\n")
+	cmd = [ 'ffmpeg', '-y', '-loglevel', 'error', '-f', 'concat', '-safe', '0', '-i', list_file, '-c', 'copy', output ]
+	status = subprocess.call(cmd, cwd=folder)
+	if status != 0:
+		raise RuntimeError("ffmpeg returned " + str(status) + " joining segments of " + output)
+
+def output_args(renditions, outputs, rate):
+	# ffmpeg output options that make every rendition from one decode: the frames are split into a copy for each
+	# rendition, which is scaled and encoded on its own.
+	n = len(renditions)
+	graph = "[0:v]format=rgb24,split=" + str(n) + "".join("[s" + str(i) + "]" for i in range(n))
+	for i, rendition in enumerate(renditions):
+		graph += ";[s" + str(i) + "]scale=s=" + rendition.get("size", "hd1080") + "[v" + str(i) + "]"
+	args = [ '-filter_complex', graph ]
+	for i, (rendition, output) in enumerate(zip(renditions, outputs)):
+		args += [ '-map', "[v" + str(i) + "]", '-r', str(rate), '-vcodec', rendition.get("codec", "h264") ]
+		if rendition.get("crf") is not None:
+			args += [ '-crf', str(rendition["crf"]) ]
+		if rendition.get("preset") is not None:
+			args += [ '-preset', rendition["preset"] ]
+		args.append(output)
+	return args
+
+def raw_input_args(frame, rate):
+	channels = frame.shape[2] if frame.ndim == 3 else 1
+	pix_fmt = PIXEL_FORMATS.get((frame.dtype, channels))
+	if pix_fmt is None:
+		raise ValueError("Unsupported frame format: " + str(frame.dtype) + " x " + str(channels))
+	return [ '-f', 'rawvideo', '-pix_fmt', pix_fmt, '-s', str(frame.shape[1]) + 'x' + str(frame.shape[0]),
+			 '-r', str(rate), '-i', '-' ]
+
+def segment_ranges(count, segments):
+	# Splits 'count' frames into up to 'segments' runs of at least MIN_SEGMENT frames.  Returns (start, end) pairs.
+	segments = max(1, min(segments, count // MIN_SEGMENT))
+	bounds = [ count * n // segments for n in range(segments + 1) ]
+	return [ (bounds[n], bounds[n + 1]) for n in range(segments) if bounds[n + 1] > bounds[n] ]
+
+def output_names(renditions=None):
+	return [ x["name"] + EXTENSION for x in renditions or DEFAULT_RENDITIONS ]
+
+def part_name(filename, segment=None):
+	# Temporary name for an output while it's being made ('timelapse.part.mp4'), or for one segment of it
+	# ('timelapse.part.3.mp4').
+	base, ext = os.path.splitext(filename)
+	return base + ".part" + ("." + str(segment) if segment is not None else "") + ext
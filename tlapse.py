@@ -5,32 +5,95 @@ DIR = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
 activate_this = DIR + "/venv/bin/activate_this.py"
 execfile(activate_this, dict(__file__=activate_this))
 
-import sky_capture, json
-
-def subdirs(path):
-	output = []
-	dirlist = os.listdir(path)
-	for entry in dirlist:
-		if os.path.isdir(path + "/" + entry):
-			output.append(entry)
-#	if output == []:
-#			output = None
-	return output
+import sky_capture, json, manifest, timelapse, archive
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 
 def process_folder(folder):
-	isDone = os.path.isfile(folder + "/timelapse.mp4")
-	skipFolder = os.path.isfile(folder + "/.skip")
+	isDone = all(os.path.isfile(os.path.join(folder, x)) for x in timelapse.output_names(sky_capture.TIMELAPSE_RENDITIONS))
+	skipFolder = os.path.isfile(os.path.join(folder, manifest.SKIP_FILE))
 	if not isDone and not skipFolder:
 		return True
 	else:
 		return False
 
-def build_timelapses():
+def frame_count(folder):
+	frames = manifest.frame_files(folder)
+	if frames is not None:
+		return len(frames)
+	try:
+		return sky_capture.read_data('file_info.json', folder)['image_count']
+	except (IOError, ValueError, KeyError):
+		return None
+
+def night_frames(folders):
+	counts = [ frame_count(x) for x in folders ]
+	return sum(counts) if None not in counts else None
+
+def build_timelapses(jobs=None):
+	# Builds a timelapse for every night in the image folder that doesn't have one yet, up to 'jobs' at once.  Each
+	# one is encoded in segments, one per core unless 'timelapse_segments' says otherwise, so with several jobs the
+	# cores are shared out between them rather than every job starting an ffmpeg per core.
+	#
+	# The nights come from the archive index (see archive.py), which also remembers the ones we've already finished
+	# (or skipped) along with the folder's mtime, so re-runs pass over unchanged folders without looking inside them.
+	# Nights that reached the image folder some other way are added when the next night starts, or with
+	# 'archive.py import'.  Nights captured with several cameras get a timelapse for each camera, and count as done
+	# once they all have one.
+	sky_capture.load_settings()
 	this_folder = os.path.abspath(os.path.dirname(__file__))
 	with open(this_folder + "/" + 'settings.json', 'r') as f:
 		data = json.load(f)
 	root_dir = data['image_folder']
-	for folder in subdirs(root_dir):
-		this_folder = root_dir + "/" + folder + "/"
-		if process_folder(this_folder):
-			sky_capture.generate_timelapse(this_folder)
\ No newline at end of file
+	if jobs is None:
+		jobs = sky_capture.TIMELAPSE_JOBS
+	jobs = max(1, jobs)
+	if sky_capture.TIMELAPSE_SEGMENTS is None:
+		sky_capture.TIMELAPSE_SEGMENTS = max(1, cpu_count() // jobs)
+
+	index = archive.open_index(root_dir)
+	todo = []
+	remaining = {}											# Folders still to build for each night
+	for night in index.nights():
+		night_dir = root_dir + "/" + night + "/"
+		if not os.path.isdir(night_dir):
+			continue
+		mtime = os.stat(night_dir).st_mtime
+		entry = index.night(night)
+		if entry["timelapse"] is not None and entry["timelapse_mtime"] == mtime:
+			continue										# Nothing has changed since last time
+		folders = sky_capture.capture_folders(night_dir)
+		pending = [ x for x in folders if process_folder(x) ]
+		if pending:
+			todo.extend(pending)
+			remaining[night] = len(pending)
+		else:
+			skipped = all(os.path.isfile(os.path.join(x, manifest.SKIP_FILE)) for x in folders)
+			index.set_timelapse(night, "skip" if skipped else "done", mtime, night_frames(folders))
+
+	def build(folder):
+		try:
+			result = sky_capture.generate_timelapse(folder)
+		except (IOError, OSError, ValueError, KeyError) as e:
+			sky_capture.logmsg("** Could not build timelapse for " + folder + ": " + str(e))
+			result = None
+		return folder, result
+
+	pool = ThreadPool(jobs)
+	try:
+		for folder, result in pool.imap_unordered(build, todo):
+			if result is None:
+				continue
+			night = os.path.relpath(folder, root_dir).split(os.sep)[0]
+			remaining[night] -= 1
+			if remaining[night] == 0:
+				night_dir = root_dir + "/" + night + "/"
+				index.set_timelapse(night, "done", os.stat(night_dir).st_mtime, night_frames(sky_capture.capture_folders(night_dir)))
+	finally:
+		pool.close()
+		pool.join()
+
+	return todo
+
+if __name__ == "__main__":
+	build_timelapses()
@@ -0,0 +1,168 @@
+# Incremental upload of a night's frames while capture is still running.
+#
+# Frames are queued as soon as they have been written.  A background thread collects them into batches and sends each
+# batch with a single rsync over a persistent ssh connection (ControlMaster), so the connection is only set up once.
+# Every file rsync confirms is appended to 'uploaded.txt' in the night folder, so a restart never sends it again and
+# by morning only the summary products (timelapse, star trails, logs, previews...) are left to send.
+#
+# If no server is given the destination is a local directory, which is handy for testing.
+
+import os, subprocess, threading, time
+from Queue import Queue, Empty
+import manifest, preview
+
+STATE_FILE = manifest.UPLOAD_STATE_FILE
+UPDATED = ( ".log", ".json", ".csv" )							# Files that keep changing after they're first sent - always resend (rsync skips them if unchanged)
+SSH = "ssh -o ControlMaster=auto -o ControlPath=/tmp/skycam-ssh-%r@%h:%p -o ControlPersist=600"
+MAX_RETRY_WAIT = 600										# Longest we'll back off between attempts after a failure (seconds)
+
+_FLUSH = object()
+
+class Uploader(object):
+
+	def __init__(self, night_dir, server, remote_path, batch_size=50, batch_wait=60):
+		# 'night_dir'	=	Local folder for tonight
+		# 'server'	=	user@host to upload to, or None to copy to a local directory
+		# 'remote_path'	=	Base folder on the server - the night is uploaded to a subfolder of the same name
+		# 'batch_size'	=	Send a batch once this many frames are waiting...
+		# 'batch_wait'	=	...or once the oldest waiting frame is this many seconds old
+		self.night_dir = os.path.normpath(night_dir)
+		self.night = os.path.basename(self.night_dir)
+		self.server = server
+		self.remote_path = remote_path
+		self.batch_size = batch_size
+		self.batch_wait = batch_wait
+		self.state_path = os.path.join(self.night_dir, STATE_FILE)
+		self.uploaded = set()
+		self.pending = []
+		self.failures = 0
+		self.last_error = None
+		self.queue = Queue()
+		self.thread = None
+		self.lock = threading.Lock()
+
+		if os.path.isfile(self.state_path):
+			with open(self.state_path, 'r') as f:
+				self.uploaded = set(line.strip() for line in f if line.strip())
+
+	def destination(self):
+		path = self.remote_path.rstrip("/") + "/" + self.night + "/"
+		if self.server:
+			return self.server + ":" + path
+		return path
+
+	def start(self):
+		self.thread = threading.Thread(target=self._run, name="uploader")
+		self.thread.daemon = True
+		self.thread.start()
+		return self
+
+	def add(self, filename):
+		# Queue a finished file (name relative to the night folder) for upload.
+		if filename not in self.uploaded:
+			self.queue.put(filename)
+
+	def flush(self):
+		# Send everything queued so far and wait for it to finish.  Returns True if it all went.
+		done = threading.Event()
+		self.queue.put((_FLUSH, done))
+		done.wait()
+		return len(self.pending) == 0
+
+	def close(self):
+		if self.thread is not None:
+			self.flush()
+			self.queue.put(None)
+			self.thread.join()
+			self.thread = None
+
+	def finish(self):
+		# End of the night: send anything in the night folder that hasn't been confirmed yet (usually just the summary
+		# products).  Returns the number of files sent.
+		if self.thread is not None:
+			self.flush()
+		files = [ x for x in self.files() if (x not in self.uploaded or x.endswith(UPDATED)) and self.uploadable(x) ]
+		if files and self.send(files):
+			return len(files)
+		return 0
+
+	def files(self):
+		# Everything in the night folder, including its previews ('preview_2/00001.jpg' and so on) but not the
+		# subfolders of any cameras.
+		files = []
+		for name in sorted(os.listdir(self.night_dir)):
+			path = os.path.join(self.night_dir, name)
+			if preview.is_preview_folder(name) and os.path.isdir(path):
+				files.extend(name + "/" + x for x in sorted(os.listdir(path)))
+			else:
+				files.append(name)
+		return files
+
+	def uploadable(self, filename):
+		return (filename not in manifest.LOCAL_ONLY and ".part." not in filename and not os.path.basename(filename).startswith(".")
+				and os.path.isfile(os.path.join(self.night_dir, filename)))
+
+	def send(self, files):
+		# rsync a list of files in one go.  Returns True once the files are confirmed on the other end.
+		cmd = [ 'rsync', '-a', '--files-from=-' ]
+		if self.server:
+			cmd += [ '-e', SSH ]
+		else:
+			if not os.path.exists(self.destination()):
+				os.makedirs(self.destination())
+		cmd += [ self.night_dir + "/", self.destination() ]
+		try:
+			process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+			out, err = process.communicate("\n".join(files) + "\n")
+		except OSError as e:
+			self.last_error = str(e)
+			return False
+		if process.returncode != 0:
+			self.last_error = err.strip()
+			return False
+		self.confirm(files)
+		return True
+
+	def confirm(self, files):
+		with self.lock:
+			with open(self.state_path, 'a') as f:
+				for name in files:
+					f.write(name + "\n")
+			self.uploaded.update(files)
+
+	def _run(self):
+		retry_wait = self.batch_wait
+		oldest = None										# When the oldest pending frame was queued
+		next_attempt = 0
+		while True:
+			try:
+				item = self.queue.get(timeout=1)
+			except Empty:
+				item = False
+
+			flush = None
+			if item is None:
+				return
+			elif isinstance(item, tuple):
+				flush = item[1]
+			elif item is not False:
+				if item not in self.pending:
+					self.pending.append(item)
+				if oldest is None:
+					oldest = time.time()
+
+			due = len(self.pending) >= self.batch_size or (oldest is not None and time.time() - oldest >= self.batch_wait)
+			if self.pending and (flush is not None or (due and time.time() >= next_attempt)):
+				batch = self.pending[:]
+				if self.send(batch):
+					self.pending = self.pending[len(batch):]
+					oldest = time.time() if self.pending else None
+					retry_wait = self.batch_wait
+				else:
+					# Back off and try again later - the frames stay in the pending list
+					self.failures += 1
+					next_attempt = time.time() + retry_wait
+					retry_wait = min(retry_wait * 2, MAX_RETRY_WAIT)
+
+			if flush is not None:
+				flush.set()
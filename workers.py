@@ -0,0 +1,81 @@
+# Small pool of background worker threads fed from a bounded queue.
+#
+# Used wherever the capture loop needs to hand work off (encoding, writing, etc.) without waiting for it.  When the
+# queue is full, put() blocks - that's the backpressure that stops a slow SD card or network from eating all the RAM.
+
+import threading, time
+from Queue import Queue, Full
+
+_STOP = object()
+
+class WorkerPool(object):
+
+	def __init__(self, handler, threads=1, max_queue=0, name="worker", on_error=None):
+		# 'handler'	=	function called with each queued item
+		# 'threads'	=	number of worker threads
+		# 'max_queue'	=	maximum number of items waiting in the queue, 0 for unlimited
+		# 'on_error'	=	optional function called with (item, exception) when the handler fails
+		self.handler = handler
+		self.num_threads = max(1, threads)
+		self.queue = Queue(max_queue)
+		self.name = name
+		self.on_error = on_error
+		self.threads = []
+		self.processed = 0									# Items handled so far
+		self.errors = 0										# Items where the handler raised
+		self.blocked = 0.0									# Total seconds producers spent waiting on a full queue
+		self.max_depth = 0									# Deepest the queue has been
+		self._lock = threading.Lock()
+
+	def start(self):
+		for n in range(self.num_threads):
+			t = threading.Thread(target=self._run, name=self.name + "-" + str(n))
+			t.daemon = True
+			t.start()
+			self.threads.append(t)
+		return self
+
+	def put(self, item):
+		# Queue an item for the workers.  Returns the number of seconds we had to wait for space in the queue.
+		try:
+			self.queue.put_nowait(item)
+			waited = 0.0
+		except Full:
+			start = time.time()
+			self.queue.put(item)
+			waited = time.time() - start
+			with self._lock:
+				self.blocked += waited
+		depth = self.queue.qsize()
+		if depth > self.max_depth:
+			self.max_depth = depth
+		return waited
+
+	def depth(self):
+		return self.queue.qsize()
+
+	def stop(self):
+		# Let the workers finish everything already queued, then shut them down.
+		for t in self.threads:
+			self.queue.put(_STOP)
+		for t in self.threads:
+			t.join()
+		self.threads = []
+
+	def _run(self):
+		while True:
+			item = self.queue.get()
+			if item is _STOP:
+				self.queue.task_done()
+				break
+			try:
+				self.handler(item)
+				with self._lock:
+					self.processed += 1
+			except Exception as e:
+				with self._lock:
+					self.errors += 1
+				if self.on_error is not None:
+					self.on_error(item, e)
+			finally:
+				self.queue.task_done()